@@ -2,9 +2,9 @@ import eventlet
 eventlet.monkey_patch()
 
 import os
+import hmac
 import logging
 from datetime import datetime
-from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
 from dotenv import load_dotenv
 from flask_limiter import Limiter
@@ -13,12 +13,34 @@ from flask_limiter.util import get_remote_address
 # ЗАГРУЖАЕМ ПЕРЕМЕННЫЕ ИЗ .env ПЕРВЫМ ДЕЛОМ
 load_dotenv()
 
-from flask import Flask, render_template, request, jsonify, session, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, session
 from flask_socketio import SocketIO, emit, join_room, leave_room, disconnect
 from flask_login import LoginManager, login_required, current_user, login_user, logout_user
-from models import db, User, Chat, Message, Contact, ChatMember, File, UserSettings, MessageReaction, ChatSettings, Notification
+from models import db, User, Chat, Message, Contact, ChatMember, File, UploadSession, UserSettings, MessageReaction, ChatSettings, Notification
 from auth import login_manager, register_user, authenticate_user, update_user_online_status
 from encryption import encryption_manager
+from messaging import (
+    list_chats, record_message_sent, record_message_changed, mark_chat_read, read_cursors,
+    fetch_history, HISTORY_PAGE_SIZE, message_text, reply_preview, reply_previews,
+    encrypted_content, set_message_text
+)
+import search_index
+from membership import require_member, get_membership, invalidate_members
+from cluster import socketio_options, create_registry, cluster_bus, user_room
+from presence import presence
+from typing_indicators import typing_aggregator
+from write_pipeline import write_pipeline
+from reencryption import legacy_reencryption
+from sqlite_storage import sqlite_storage
+from sql_profiler import sql_profiler
+from metrics import metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from media import send_upload
+import images
+from images import attachment_variants, avatar_variants, schedule_variants, variant_source, is_image
+from uploads import (
+    store_file, link_existing, release_file, file_in_use, file_url,
+    create_session, append_chunk, complete_session, cleanup_expired_sessions, UPLOAD_CHUNK_SIZE
+)
 from config import Config
 from flask_cors import CORS
 
@@ -52,6 +74,9 @@ CORS(app, supports_credentials=True, resources={
 
 # Инициализация расширений
 db.init_app(app)
+sqlite_storage.init_app(app, db)
+sql_profiler.init_app(app, db, [sqlite_storage.reader] if sqlite_storage.reader else [])
+metrics.init_app(app, db, [sqlite_storage.reader] if sqlite_storage.reader else [])
 login_manager.init_app(app)
 
 # Настройка rate limiting
@@ -70,6 +95,9 @@ except Exception as e:
             def decorator(f):
                 return f
             return decorator
+        
+        def exempt(self, f):
+            return f
     limiter = DummyLimiter()
 
 # Настройка SocketIO с ограниченными источниками
@@ -79,16 +107,25 @@ socketio = SocketIO(
     async_mode='eventlet',
     logger=False,
     engineio_logger=False,
-    cookie=True
+    cookie=True,
+    **socketio_options(app.config['SOCKETIO_MESSAGE_QUEUE'])
 )
 
-# In-memory map for signaling: user_id -> sid (last connected)
-user_id_to_sid = {}
+# Подключения пользователей всех процессов: user_id -> множество sid (несколько устройств).
+# Адресные события идут в комнату user_<id>, которую слушают все устройства пользователя.
+connections = create_registry(app.config['SOCKETIO_MESSAGE_QUEUE'])
+cluster_bus.start(app.config['SOCKETIO_MESSAGE_QUEUE'], socketio.start_background_task)
+presence.init_app(app, socketio, connections)
+images.init_app(app)
+typing_aggregator.init_app(socketio)
+write_pipeline.init_app(app, socketio)
+legacy_reencryption.init_app(app, socketio)
 
 # Создание папок
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'avatars'), exist_ok=True)
 os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'files'), exist_ok=True)
+os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'blobs'), exist_ok=True)
 
 # Разрешенные расширения файлов
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'mp3', 'mp4', 'avi'}
@@ -237,6 +274,7 @@ def get_user_profile():
                 'email': current_user.email,
                 'bio': current_user.bio,
                 'avatar': current_user.avatar,
+                'avatar_variants': avatar_variants(current_user.avatar),
                 'is_online': current_user.is_online
             }
         })
@@ -288,43 +326,7 @@ def update_user_profile():
 def get_chats():
     """Получение списка чатов пользователя"""
     try:
-        user_chats = Chat.query.join(ChatMember).filter(
-            ChatMember.user_id == current_user.id
-        ).all()
-        
-        chats_data = []
-        for chat in user_chats:
-            try:
-                last_message = Message.query.filter_by(chat_id=chat.id).order_by(
-                    Message.created_at.desc()
-                ).first()
-                
-                last_message_content = ''
-                if last_message:
-                    try:
-                        last_message_content = encryption_manager.decrypt_message(last_message.content) if last_message.is_encrypted else last_message.content
-                    except Exception:
-                        last_message_content = '[Зашифрованное сообщение]'
-                
-                chat_data = {
-                    'id': chat.id,
-                    'name': chat.name,
-                    'is_group': chat.is_group,
-                    'avatar': chat.avatar,
-                    'last_message': {
-                        'content': last_message_content,
-                        'sender_id': last_message.sender_id if last_message else None,
-                        'created_at': last_message.created_at.isoformat() if last_message else None
-                    } if last_message else None,
-                    'unread_count': Message.query.filter_by(
-                        chat_id=chat.id, 
-                        is_read=False
-                    ).filter(Message.sender_id != current_user.id).count()
-                }
-                chats_data.append(chat_data)
-            except Exception as e:
-                logger.error(f"Error processing chat {chat.id}: {str(e)}")
-                continue
+        chats_data = list_chats(current_user.id)
         
         return jsonify({'status': 'success', 'chats': chats_data})
         
@@ -338,69 +340,60 @@ def get_chat_messages(chat_id):
     """Получение сообщений чата"""
     try:
         # Проверяем, что пользователь является участником чата
-        membership = ChatMember.query.filter_by(
-            chat_id=chat_id, 
-            user_id=current_user.id
-        ).first()
-        
-        if not membership:
+        if not require_member(chat_id):
             return jsonify({'status': 'error', 'message': 'Доступ запрещен'}), 403
         
-        page = request.args.get('page', 1, type=int)
-        per_page = 50
+        before_id = request.args.get('before_id', type=int)
+        after_id = request.args.get('after_id', type=int)
+        page = request.args.get('page', type=int)
+        per_page = HISTORY_PAGE_SIZE
+        
+        if page and not (before_id or after_id):
+            # Устаревший режим с OFFSET, без подсчета общего количества
+            rows = Message.query.filter_by(chat_id=chat_id).order_by(
+                Message.created_at.desc(), Message.id.desc()
+            ).offset((page - 1) * per_page).limit(per_page + 1).all()
+            page_info = {'has_next': len(rows) > per_page, 'has_prev': page > 1}
+            messages = rows[:per_page][::-1]
+        else:
+            history = fetch_history(chat_id, before_id=before_id, after_id=after_id, limit=per_page)
+            if history is None:
+                return jsonify({'status': 'error', 'message': 'Сообщение не найдено'}), 404
+            messages, next_cursor, prev_cursor = history
+            page_info = {'next_cursor': next_cursor, 'prev_cursor': prev_cursor}
+        
+        # Квитанции о прочтении вычисляются по курсорам участников
+        own_cursor, peers_cursor = read_cursors(chat_id, current_user.id)
         
-        messages = Message.query.filter_by(chat_id=chat_id).order_by(
-            Message.created_at.desc()
-        ).paginate(page=page, per_page=per_page, error_out=False)
+        replies = reply_previews(messages, chat_id)
         
         messages_data = []
-        for message in messages.items:
-            try:
-                decrypted_content = encryption_manager.decrypt_message(message.content) if message.is_encrypted else message.content
-            except Exception:
-                decrypted_content = '[Ошибка расшифровки]'
+        for message in messages:
+            decrypted_content = message_text(message)
             
-            # Формируем данные для ответа (reply_to), если есть
-            reply_data = None
-            if message.reply_to_id:
-                try:
-                    original = Message.query.get(message.reply_to_id)
-                    if original and original.chat_id == chat_id:
-                        try:
-                            original_content = encryption_manager.decrypt_message(original.content) if original.is_encrypted else original.content
-                        except Exception:
-                            original_content = '[Ошибка расшифровки]'
-                        reply_data = {
-                            'id': original.id,
-                            'sender_id': original.sender_id,
-                            'content': original_content[:120]
-                        }
-                except Exception:
-                    reply_data = None
-
             messages_data.append({
                 'id': message.id,
                 'content': decrypted_content,
                 'content_type': message.content_type,
                 'sender_id': message.sender_id,
                 'is_encrypted': message.is_encrypted,
-                'is_read': message.is_read,
+                'is_read': message.id <= (peers_cursor if message.sender_id == current_user.id else own_cursor),
                 'created_at': message.created_at.isoformat(),
                 'file_path': message.file_path,
-                'reply_to': reply_data
+                'file_variants': attachment_variants(message.file_path),
+                'reply_to': replies.get(message.reply_to_id)
             })
         
-        # Помечаем сообщения как прочитанные
-        Message.query.filter_by(chat_id=chat_id, is_read=False).filter(
-            Message.sender_id != current_user.id
-        ).update({'is_read': True})
+        # Помечаем сообщения как прочитанные (сдвиг курсора участника)
+        cursor = mark_chat_read(chat_id, current_user.id)
         db.session.commit()
+        if cursor is not None:
+            emit_messages_read(chat_id, current_user.id, cursor)
         
         return jsonify({
             'status': 'success',
-            'messages': messages_data[::-1],  # Возвращаем в правильном порядке
-            'has_next': messages.has_next,
-            'has_prev': messages.has_prev
+            'messages': messages_data,
+            **page_info
         })
         
     except Exception as e:
@@ -408,6 +401,34 @@ def get_chat_messages(chat_id):
         db.session.rollback()
         return jsonify({'status': 'error', 'message': 'Ошибка получения сообщений'}), 500
 
+@app.route('/api/chats/<int:chat_id>/read', methods=['POST'])
+@login_required
+def mark_messages_read(chat_id):
+    """Отметка сообщений чата как прочитанных"""
+    try:
+        data = request.get_json(silent=True) or {}
+        message_id = data.get('message_id')
+        
+        if not require_member(chat_id):
+            return jsonify({'status': 'error', 'message': 'Доступ запрещен'}), 403
+        
+        cursor = mark_chat_read(chat_id, current_user.id, int(message_id) if message_id else None)
+        db.session.commit()
+        if cursor is not None:
+            emit_messages_read(chat_id, current_user.id, cursor)
+        
+        member = ChatMember.query.filter_by(chat_id=chat_id, user_id=current_user.id).first()
+        return jsonify({
+            'status': 'success',
+            'last_read_message_id': member.last_read_message_id,
+            'unread_count': member.unread_count
+        })
+        
+    except Exception as e:
+        logger.error(f"Mark read error: {str(e)}")
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': 'Ошибка отметки прочтения'}), 500
+
 @app.route('/api/chats/<int:chat_id>/send', methods=['POST'])
 @login_required
 @limiter.limit("30 per minute")
@@ -428,68 +449,57 @@ def send_message(chat_id):
             return jsonify({'status': 'error', 'message': 'Сообщение слишком длинное'}), 400
         
         # Проверяем, что пользователь является участником чата
-        membership = ChatMember.query.filter_by(
-            chat_id=chat_id, 
-            user_id=current_user.id
-        ).first()
-        
-        if not membership:
+        if not require_member(chat_id):
             return jsonify({'status': 'error', 'message': 'Доступ запрещен'}), 403
         
         # Шифруем сообщение
-        encrypted_content = encryption_manager.encrypt_message(content)
-        
-        message = Message(
-            chat_id=chat_id,
-            sender_id=current_user.id,
-            content=encrypted_content,
-            content_type=content_type,
-            is_encrypted=True
-        )
-
+        encrypted_columns = encrypted_content(content)
+        
         # Если есть ответ на сообщение, валидируем принадлежность к чату
+        original = None
         if reply_to_id:
             original = Message.query.get(reply_to_id)
             if not original or original.chat_id != chat_id:
                 return jsonify({'status': 'error', 'message': 'Неверный идентификатор сообщения для ответа'}), 400
-            message.reply_to_id = reply_to_id
         
-        db.session.add(message)
-        db.session.commit()
+        # Данные для reply_to в событии (до записи, пока оригинал загружен)
+        reply_payload = reply_preview(original) if original else None
+        sender_id = current_user.id
+        
+        def write_message():
+            message = Message(
+                chat_id=chat_id,
+                sender_id=sender_id,
+                content_type=content_type,
+                reply_to_id=reply_to_id if original else None,
+                **encrypted_columns
+            )
+            db.session.add(message)
+            db.session.flush()
+            record_message_sent(message, content)
+            search_index.index_message(message, content)
+            return message.id, message.created_at
+        
+        # Запись попадает в общую транзакцию с соседними отправителями (если включено);
+        # возврат - после commit, поэтому событие уходит только для сохраненного сообщения
+        message_id, created_at = write_pipeline.submit(write_message)
+        typing_aggregator.stop(chat_id, current_user.id)
         
         # Отправляем через WebSocket
-        # Данные для reply_to в событии
-        reply_payload = None
-        if message.reply_to_id:
-            try:
-                original = Message.query.get(message.reply_to_id)
-                if original:
-                    try:
-                        original_content = encryption_manager.decrypt_message(original.content) if original.is_encrypted else original.content
-                    except Exception:
-                        original_content = '[Ошибка расшифровки]'
-                    reply_payload = {
-                        'id': original.id,
-                        'sender_id': original.sender_id,
-                        'content': original_content[:120]
-                    }
-            except Exception:
-                reply_payload = None
-
         socketio.emit('new_message', {
-            'id': message.id,
+            'id': message_id,
             'content': content,
             'content_type': content_type,
             'sender_id': current_user.id,
             'sender_name': current_user.first_name,
             'chat_id': chat_id,
-            'created_at': message.created_at.isoformat(),
+            'created_at': created_at.isoformat(),
             'reply_to': reply_payload
         }, room=f'chat_{chat_id}')
         
         logger.info(f"Message sent by {current_user.username} to chat {chat_id}")
         
-        return jsonify({'status': 'success', 'message_id': message.id})
+        return jsonify({'status': 'success', 'message_id': message_id})
         
     except Exception as e:
         logger.error(f"Send message error: {str(e)}")
@@ -510,33 +520,13 @@ def upload_file():
             return jsonify({'status': 'error', 'message': 'Файл не выбран'}), 400
         
         if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-            filename = timestamp + filename
-            
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'files', filename)
-            file.save(file_path)
-            
-            # Сохраняем информацию о файле в БД
-            file_record = File(
-                filename=filename,
-                file_path=file_path,
-                file_size=os.path.getsize(file_path),
-                mime_type=file.content_type,
-                uploaded_by=current_user.id
-            )
-            
-            db.session.add(file_record)
+            file_record = store_file(file.stream, file.filename, file.content_type, current_user.id)
             db.session.commit()
+            schedule_file_variants(file_record)
             
-            logger.info(f"File uploaded by {current_user.username}: {filename}")
+            logger.info(f"File uploaded by {current_user.username}: {file_record.filename}")
             
-            return jsonify({
-                'status': 'success',
-                'file_id': file_record.id,
-                'filename': filename,
-                'file_path': f'/uploads/files/{filename}'
-            })
+            return jsonify(file_payload(file_record))
         
         return jsonify({'status': 'error', 'message': 'Недопустимый тип файла'}), 400
         
@@ -545,32 +535,232 @@ def upload_file():
         db.session.rollback()
         return jsonify({'status': 'error', 'message': 'Ошибка загрузки файла'}), 500
 
+def file_payload(file_record, **extra):
+    """Ответ API для сохраненного файла"""
+    url = file_url(file_record)
+    return {
+        'status': 'success',
+        'file_id': file_record.id,
+        'filename': file_record.filename,
+        'file_path': url,
+        'variants': attachment_variants(url) if file_record.blob else None,
+        **extra
+    }
+
+def schedule_file_variants(file_record, avatar=False):
+    """Фоновое построение превью для изображения из хранилища блобов"""
+    if file_record.blob:
+        schedule_variants(file_record.file_path, file_record.blob.name, avatar=avatar)
+
+# Возобновляемая загрузка: создание сессии, части по смещению, статус, завершение
+@app.route('/api/uploads', methods=['POST'])
+@login_required
+@limiter.limit("10 per minute")
+def create_upload_session():
+    """Создание сессии возобновляемой загрузки"""
+    try:
+        data = request.get_json()
+        valid, error = validate_input(data, ['filename', 'size'])
+        if not valid:
+            return jsonify({'status': 'error', 'message': error}), 400
+        
+        filename = data.get('filename')
+        total_size = int(data.get('size'))
+        
+        if not allowed_file(filename):
+            return jsonify({'status': 'error', 'message': 'Недопустимый тип файла'}), 400
+        
+        if total_size <= 0 or total_size > app.config['MAX_CONTENT_LENGTH']:
+            return jsonify({'status': 'error', 'message': 'Файл слишком большой'}), 413
+        
+        if data.get('sha256'):
+            # Такое содержимое уже хранится - файл готов без передачи байтов
+            file_record = link_existing(
+                data['sha256'].lower(), total_size, filename, data.get('mime_type'), current_user.id
+            )
+            if file_record:
+                db.session.commit()
+                schedule_file_variants(file_record)
+                return jsonify(file_payload(file_record, sha256=file_record.blob_sha256))
+        
+        cleanup_expired_sessions()
+        
+        upload = create_session(current_user.id, filename, total_size, data.get('mime_type'))
+        db.session.commit()
+        
+        return jsonify(upload_status(upload, chunk_size=UPLOAD_CHUNK_SIZE))
+        
+    except Exception as e:
+        logger.error(f"Create upload session error: {str(e)}")
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': 'Ошибка создания загрузки'}), 500
+
+def upload_status(upload, **extra):
+    """Состояние сессии загрузки"""
+    return {
+        'status': 'success',
+        'upload_id': upload.id,
+        'offset': upload.received,
+        'size': upload.total_size,
+        'expires_at': upload.expires_at.isoformat(),
+        **extra
+    }
+
+def get_own_upload(upload_id):
+    upload = UploadSession.query.get(upload_id)
+    if not upload or upload.user_id != current_user.id or upload.expires_at < datetime.utcnow():
+        return None
+    return upload
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@login_required
+@limiter.exempt
+def get_upload_session(upload_id):
+    """Текущее смещение загрузки (для возобновления)"""
+    upload = get_own_upload(upload_id)
+    if not upload:
+        return jsonify({'status': 'error', 'message': 'Загрузка не найдена'}), 404
+    return jsonify(upload_status(upload))
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+@login_required
+@limiter.exempt
+def put_upload_chunk(upload_id):
+    """Прием части файла по смещению (?offset=N, тело - байты части)"""
+    try:
+        upload = get_own_upload(upload_id)
+        if not upload:
+            return jsonify({'status': 'error', 'message': 'Загрузка не найдена'}), 404
+        
+        offset = request.args.get('offset', type=int)
+        if offset != upload.received:
+            # Клиент должен продолжить с подтвержденного сервером смещения
+            return jsonify({**upload_status(upload), 'status': 'error', 'message': 'Неверное смещение'}), 409
+        
+        length = request.content_length
+        if not length or offset + length > upload.total_size:
+            return jsonify({'status': 'error', 'message': 'Неверный размер части'}), 400
+        
+        if append_chunk(upload, request.stream, offset, length) is None:
+            # Часть с этого смещения уже записывает или записал другой запрос
+            return jsonify({**upload_status(upload), 'status': 'error', 'message': 'Неверное смещение'}), 409
+        
+        return jsonify(upload_status(upload))
+        
+    except Exception as e:
+        logger.error(f"Upload chunk error: {str(e)}")
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': 'Ошибка загрузки части файла'}), 500
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_upload_session(upload_id):
+    """Завершение загрузки и создание записи файла"""
+    try:
+        upload = get_own_upload(upload_id)
+        if not upload:
+            return jsonify({'status': 'error', 'message': 'Загрузка не найдена'}), 404
+        
+        if upload.received != upload.total_size:
+            return jsonify({**upload_status(upload), 'status': 'error', 'message': 'Файл загружен не полностью'}), 409
+        
+        file_record, digest = complete_session(upload)
+        db.session.commit()
+        schedule_file_variants(file_record)
+        
+        logger.info(f"File uploaded by {current_user.username}: {file_record.filename}")
+        
+        return jsonify(file_payload(file_record, sha256=digest))
+        
+    except Exception as e:
+        logger.error(f"Complete upload error: {str(e)}")
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': 'Ошибка завершения загрузки'}), 500
+
+@app.route('/api/files/<int:file_id>', methods=['DELETE'])
+@login_required
+def delete_file(file_id):
+    """Удаление своего файла (содержимое удаляется с последней ссылкой)"""
+    try:
+        file_record = File.query.get(file_id)
+        if not file_record or file_record.uploaded_by != current_user.id:
+            return jsonify({'status': 'error', 'message': 'Файл не найден'}), 404
+        
+        # Удаление содержимого сломало бы вложения и аватары с этим адресом
+        if file_in_use(file_record):
+            return jsonify({'status': 'error', 'message': 'Файл используется в сообщениях или аватаре'}), 409
+        
+        release_file(file_record)
+        db.session.commit()
+        
+        return jsonify({'status': 'success', 'message': 'Файл удален'})
+        
+    except Exception as e:
+        logger.error(f"Delete file error: {str(e)}")
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': 'Ошибка удаления файла'}), 500
+
 @app.route('/uploads/<path:filename>')
 @login_required
 def uploaded_file(filename):
     """Отдача загруженных файлов"""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    response = send_upload(filename)
+    if response.status_code == 404:
+        # Вариант изображения еще не построен - временно отдаем оригинал без кэширования
+        original = variant_source(filename)
+        if original:
+            response = send_upload(original)
+            response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/user/avatar', methods=['POST'])
+@login_required
+@limiter.limit("10 per hour")
+def upload_avatar():
+    """Загрузка аватара с фоновым построением фиксированных размеров"""
+    try:
+        file = request.files.get('file')
+        if not file or not is_image(file.filename or ''):
+            return jsonify({'status': 'error', 'message': 'Нужно изображение'}), 400
+        
+        file_record = store_file(file.stream, file.filename, file.content_type, current_user.id)
+        current_user.avatar = file_url(file_record)
+        db.session.commit()
+        schedule_file_variants(file_record, avatar=True)
+        
+        return jsonify({
+            'status': 'success',
+            'avatar': current_user.avatar,
+            'avatar_variants': avatar_variants(current_user.avatar)
+        })
+        
+    except Exception as e:
+        logger.error(f"Avatar upload error: {str(e)}")
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': 'Ошибка загрузки аватара'}), 500
 
 @app.route('/api/contacts', methods=['GET'])
 @login_required
 def get_contacts():
     """Получение списка контактов"""
     try:
-        contacts = current_user.user_contacts.all()
+        # Пользователи контактов одним JOIN вместо запроса на каждый контакт
+        contacts = User.query.join(Contact, Contact.contact_id == User.id).filter(
+            Contact.user_id == current_user.id
+        ).order_by(Contact.id).all()
         
         contacts_data = []
-        for contact in contacts:
-            user = User.query.get(contact.contact_id)
-            if user:
-                contacts_data.append({
-                    'id': user.id,
-                    'username': user.username,
-                    'first_name': user.first_name,
-                    'last_name': user.last_name,
-                    'avatar': user.avatar,
-                    'is_online': user.is_online,
-                    'last_seen': user.last_seen.isoformat() if user.last_seen else None
-                })
+        for user in contacts:
+            contacts_data.append({
+                'id': user.id,
+                'username': user.username,
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'avatar': user.avatar,
+                'avatar_variants': avatar_variants(user.avatar),
+                'is_online': user.is_online,
+                'last_seen': user.last_seen.isoformat() if user.last_seen else None
+            })
         
         return jsonify({'status': 'success', 'contacts': contacts_data})
         
@@ -625,17 +815,30 @@ def add_contact():
         member2 = ChatMember(chat_id=chat.id, user_id=contact_user.id, role='member')
         db.session.add_all([member1, member2])
         
+        # После commit объекты сессии истекают: значения берем до него,
+        # чтобы не перечитывать пользователей и чат лишними запросами
+        user_id, username = current_user.id, current_user.username
+        contact_id, chat_id = contact_user.id, chat.id
         db.session.commit()
+        invalidate_members(user_id, contact_id)
         
-        logger.info(f"Contact added by {current_user.username}: {contact_user.username}")
+        logger.info(f"Contact added by {username}: {contact_username}")
         
-        return jsonify({'status': 'success', 'contact_id': contact_user.id, 'chat_id': chat.id})
+        return jsonify({'status': 'success', 'contact_id': contact_id, 'chat_id': chat_id})
         
     except Exception as e:
         logger.error(f"Add contact error: {str(e)}")
         db.session.rollback()
         return jsonify({'status': 'error', 'message': 'Ошибка добавления контакта'}), 500
 
+def emit_messages_read(chat_id, user_id, cursor):
+    """Рассылка квитанции о прочтении участникам чата"""
+    socketio.emit('messages_read', {
+        'chat_id': chat_id,
+        'user_id': user_id,
+        'last_read_message_id': cursor
+    }, room=f'chat_{chat_id}')
+
 # WebSocket обработчики
 @socketio.on('connect')
 def handle_connect(auth):
@@ -646,10 +849,8 @@ def handle_connect(auth):
         return False
     
     try:
-        update_user_online_status(current_user.id, True)
-        # Remember socket id
-        user_id_to_sid[current_user.id] = request.sid
-        emit('user_online', {'user_id': current_user.id}, broadcast=True)
+        join_room(user_room(current_user.id))
+        presence.connect(current_user.id, request.sid)
         logger.info(f"WebSocket connected: {current_user.username}")
     except Exception as e:
         logger.error(f"WebSocket connect error: {str(e)}")
@@ -659,14 +860,7 @@ def handle_disconnect():
     """Обработчик отключения WebSocket"""
     if current_user.is_authenticated:
         try:
-            update_user_online_status(current_user.id, False)
-            # Cleanup mapping
-            try:
-                if user_id_to_sid.get(current_user.id) == request.sid:
-                    user_id_to_sid.pop(current_user.id, None)
-            except Exception:
-                pass
-            emit('user_offline', {'user_id': current_user.id}, broadcast=True)
+            presence.disconnect(current_user.id, request.sid)
             logger.info(f"WebSocket disconnected: {current_user.username}")
         except Exception as e:
             logger.error(f"WebSocket disconnect error: {str(e)}")
@@ -684,12 +878,7 @@ def handle_join_chat(data):
             return
         
         # Проверяем, что пользователь является участником чата
-        membership = ChatMember.query.filter_by(
-            chat_id=chat_id, 
-            user_id=current_user.id
-        ).first()
-        
-        if not membership:
+        if not require_member(chat_id):
             return
         
         join_room(f'chat_{chat_id}')
@@ -716,19 +905,16 @@ def rtc_call_user(data):
 
         # Ensure both participants are members of the chat (security)
         if chat_id:
-            membership_caller = ChatMember.query.filter_by(chat_id=chat_id, user_id=current_user.id).first()
-            membership_callee = ChatMember.query.filter_by(chat_id=chat_id, user_id=to_user_id).first()
-            if not membership_caller or not membership_callee:
+            if not require_member(chat_id) or not get_membership(chat_id, to_user_id):
                 return
 
-        sid = user_id_to_sid.get(to_user_id)
-        if sid:
+        if connections.is_connected(to_user_id):
             emit('rtc_incoming_call', {
                 'from_user_id': current_user.id,
                 'from_username': current_user.first_name or current_user.username,
                 'chat_id': chat_id,
                 'type': call_type
-            }, to=sid)
+            }, to=user_room(to_user_id))
     except Exception as e:
         logger.error(f"rtc_call_user error: {str(e)}")
 
@@ -741,12 +927,10 @@ def rtc_signal(data):
     try:
         to_user_id = int(data.get('to_user_id'))
         signal = data.get('signal')
-        sid = user_id_to_sid.get(to_user_id)
-        if sid:
-            emit('rtc_signal', {
-                'from_user_id': current_user.id,
-                'signal': signal
-            }, to=sid)
+        emit('rtc_signal', {
+            'from_user_id': current_user.id,
+            'signal': signal
+        }, to=user_room(to_user_id))
     except Exception as e:
         logger.error(f"rtc_signal error: {str(e)}")
 
@@ -758,11 +942,9 @@ def rtc_end_call(data):
         return
     try:
         to_user_id = int(data.get('to_user_id'))
-        sid = user_id_to_sid.get(to_user_id)
-        if sid:
-            emit('rtc_end_call', {
-                'from_user_id': current_user.id
-            }, to=sid)
+        emit('rtc_end_call', {
+            'from_user_id': current_user.id
+        }, to=user_room(to_user_id))
     except Exception as e:
         logger.error(f"rtc_end_call error: {str(e)}")
 
@@ -787,22 +969,42 @@ def handle_leave_chat(data):
     except Exception as e:
         logger.error(f"Leave chat error: {str(e)}")
 
+@socketio.on('mark_read')
+def handle_mark_read(data):
+    """Сдвиг курсора прочтения из клиента"""
+    if not current_user.is_authenticated:
+        return
+    
+    try:
+        chat_id = data.get('chat_id')
+        message_id = data.get('message_id')
+        if not chat_id:
+            return
+        
+        if not require_member(chat_id):
+            return
+        
+        cursor = mark_chat_read(chat_id, current_user.id, int(message_id) if message_id else None)
+        db.session.commit()
+        if cursor is not None:
+            emit_messages_read(chat_id, current_user.id, cursor)
+        
+    except Exception as e:
+        logger.error(f"Mark read error: {str(e)}")
+        db.session.rollback()
+
 @socketio.on('typing_start')
 def handle_typing_start(data):
-    """Пользователь начал печатать"""
+    """Пользователь начал печатать (рассылка - агрегированным typing_update)"""
     if not current_user.is_authenticated:
         return
     
     try:
         chat_id = data.get('chat_id')
-        if not chat_id:
+        if not chat_id or not require_member(chat_id):
             return
         
-        emit('user_typing', {
-            'user_id': current_user.id,
-            'username': current_user.first_name or current_user.username,
-            'chat_id': chat_id
-        }, room=f"chat_{chat_id}", include_self=False)
+        typing_aggregator.start(int(chat_id), current_user.id, current_user.first_name or current_user.username)
         
     except Exception as e:
         logger.error(f"Typing start error: {str(e)}")
@@ -818,11 +1020,7 @@ def handle_typing_stop(data):
         if not chat_id:
             return
         
-        emit('user_stopped_typing', {
-            'user_id': current_user.id,
-            'username': current_user.first_name or current_user.username,
-            'chat_id': chat_id
-        }, room=f"chat_{chat_id}", include_self=False)
+        typing_aggregator.stop(int(chat_id), current_user.id)
         
     except Exception as e:
         logger.error(f"Typing stop error: {str(e)}")
@@ -850,11 +1048,11 @@ def edit_message(message_id):
             return jsonify({'status': 'error', 'message': 'Сообщение слишком старое для редактирования'}), 400
         
         new_content = data.get('content').strip()
-        encrypted_content = encryption_manager.encrypt_message(new_content)
-        
-        message.content = encrypted_content
+        set_message_text(message, new_content)
         message.is_edited = True
         message.updated_at = datetime.utcnow()
+        record_message_changed(message, new_content)
+        search_index.reindex_message(message, new_content)
         
         db.session.commit()
         
@@ -882,17 +1080,14 @@ def delete_message(message_id):
         # Проверяем права на удаление
         if message.sender_id != current_user.id:
             # Проверяем, является ли пользователь админом чата
-            membership = ChatMember.query.filter_by(
-                chat_id=message.chat_id,
-                user_id=current_user.id
-            ).first()
-            
-            if not membership or membership.role not in ['admin', 'owner']:
+            if not require_member(message.chat_id, role=('admin', 'owner')):
                 return jsonify({'status': 'error', 'message': 'Доступ запрещен'}), 403
         
         message.is_deleted = True
-        message.content = encryption_manager.encrypt_message('[Сообщение удалено]')
+        set_message_text(message, '[Сообщение удалено]')
         message.updated_at = datetime.utcnow()
+        record_message_changed(message, '[Сообщение удалено]')
+        search_index.remove_message(message.id)
         
         db.session.commit()
         
@@ -917,12 +1112,7 @@ def pin_message(message_id):
         message = Message.query.get_or_404(message_id)
         
         # Проверяем права на закрепление
-        membership = ChatMember.query.filter_by(
-            chat_id=message.chat_id,
-            user_id=current_user.id
-        ).first()
-        
-        if not membership or membership.role not in ['admin', 'owner']:
+        if not require_member(message.chat_id, role=('admin', 'owner')):
             return jsonify({'status': 'error', 'message': 'Недостаточно прав'}), 403
         
         message.is_pinned = True
@@ -1009,40 +1199,56 @@ def search_messages(chat_id):
             return jsonify({'status': 'error', 'message': 'Поисковый запрос не может быть пустым'}), 400
         
         # Проверяем доступ к чату
-        membership = ChatMember.query.filter_by(
-            chat_id=chat_id,
-            user_id=current_user.id
-        ).first()
-        
-        if not membership:
+        if not require_member(chat_id):
             return jsonify({'status': 'error', 'message': 'Доступ запрещен'}), 403
         
-        # Поиск сообщений (упрощенный поиск по содержимому)
-        messages = Message.query.filter(
-            Message.chat_id == chat_id,
-            Message.is_deleted == False
-        ).order_by(Message.created_at.desc()).limit(50).all()
+        before_id = request.args.get('before_id', type=int)
+        messages, next_cursor = search_index.search(
+            current_user.id, query, chat_id=chat_id, before_id=before_id
+        )
         
-        results = []
-        for message in messages:
-            try:
-                decrypted_content = encryption_manager.decrypt_message(message.content) if message.is_encrypted else message.content
-                if query.lower() in decrypted_content.lower():
-                    results.append({
-                        'id': message.id,
-                        'content': decrypted_content,
-                        'sender_id': message.sender_id,
-                        'created_at': message.created_at.isoformat()
-                    })
-            except Exception:
-                continue
-        
-        return jsonify({'status': 'success', 'results': results})
+        return jsonify({
+            'status': 'success',
+            'results': [search_result(message) for message in messages],
+            'next_cursor': next_cursor
+        })
         
     except Exception as e:
         logger.error(f"Search messages error: {str(e)}")
         return jsonify({'status': 'error', 'message': 'Ошибка поиска'}), 500
 
+@app.route('/api/search', methods=['GET'])
+@login_required
+def search_all_messages():
+    """Поиск сообщений по всем чатам пользователя"""
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'status': 'error', 'message': 'Поисковый запрос не может быть пустым'}), 400
+        
+        before_id = request.args.get('before_id', type=int)
+        messages, next_cursor = search_index.search(current_user.id, query, before_id=before_id)
+        
+        return jsonify({
+            'status': 'success',
+            'results': [search_result(message) for message in messages],
+            'next_cursor': next_cursor
+        })
+        
+    except Exception as e:
+        logger.error(f"Search all messages error: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'Ошибка поиска'}), 500
+
+def search_result(message):
+    """Представление найденного сообщения"""
+    return {
+        'id': message.id,
+        'chat_id': message.chat_id,
+        'content': message_text(message),
+        'sender_id': message.sender_id,
+        'created_at': message.created_at.isoformat()
+    }
+
 @app.route('/api/user/settings', methods=['GET'])
 @login_required
 def get_user_settings():
@@ -1135,31 +1341,23 @@ def create_group_chat():
         db.session.add(chat)
         db.session.flush()
         
-        # Добавляем создателя как владельца
-        owner_member = ChatMember(
-            chat_id=chat.id,
-            user_id=current_user.id,
-            role='owner'
-        )
-        db.session.add(owner_member)
-        
-        # Добавляем участников
-        for member_id in member_ids:
-            if member_id != current_user.id:  # Не добавляем создателя дважды
-                member = ChatMember(
-                    chat_id=chat.id,
-                    user_id=member_id,
-                    role='member'
-                )
-                db.session.add(member)
+        # Создатель - владелец, остальные участники без повторов;
+        # одна пакетная вставка вместо INSERT на каждого участника
+        user_id, username, chat_id = current_user.id, current_user.username, chat.id
+        members = [{'chat_id': chat_id, 'user_id': user_id, 'role': 'owner'}]
+        for member_id in dict.fromkeys(int(member_id) for member_id in member_ids):
+            if member_id != user_id:
+                members.append({'chat_id': chat_id, 'user_id': member_id, 'role': 'member'})
+        db.session.execute(ChatMember.__table__.insert(), members)
         
         db.session.commit()
+        invalidate_members(user_id, *[int(member_id) for member_id in member_ids])
         
-        logger.info(f"Group chat created by {current_user.username}: {name}")
+        logger.info(f"Group chat created by {username}: {name}")
         
         return jsonify({
             'status': 'success',
-            'chat_id': chat.id,
+            'chat_id': chat_id,
             'message': 'Групповой чат создан'
         })
         
@@ -1219,11 +1417,41 @@ def mark_notification_read(notification_id):
 def health_check():
     return jsonify({'status': 'healthy', 'message': 'Little Kitten Chat is running!'})
 
+# Метрики: обработчики событий оборачиваются после их регистрации выше
+metrics.instrument_socketio(socketio)
+sql_profiler.instrument_socketio(socketio)
+metrics.track_stats('write_pipeline', write_pipeline.stats, counters=('batches', 'writes', 'fallbacks'))
+metrics.track_stats('reencryption', legacy_reencryption.stats, counters=('messages', 'previews', 'failures'))
+metrics.track_stats('sqlite', sqlite_storage.stats, counters=('write_lock_waits', 'write_lock_wait_ms_total'))
+metrics.track_stats('decrypt_cache', encryption_manager.cache_stats,
+                    counters=('hits', 'misses', 'evictions', 'invalidations'))
+
+# Без METRICS_TOKEN метрики отдаются только локальному сборщику
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+@app.route('/metrics')
+@limiter.exempt
+def metrics_endpoint():
+    """Метрики процесса в формате Prometheus.
+
+    С METRICS_TOKEN - только с заголовком Authorization: Bearer <токен>,
+    без него - только с этой же машины.
+    """
+    token = app.config['METRICS_TOKEN']
+    if token:
+        allowed = hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    else:
+        allowed = request.remote_addr in LOCAL_ADDRESSES
+    if not allowed:
+        return jsonify({'status': 'error', 'message': 'Доступ запрещен'}), 403
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
 if __name__ == '__main__':
+    from migrations import run_migrations
     with app.app_context():
         try:
-            db.create_all()
-            logger.info("Database tables created successfully")
+            run_migrations()
+            logger.info("Database schema is up to date")
         except Exception as e:
             logger.error(f"Database initialization error: {str(e)}")
     
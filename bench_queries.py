@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Query Latency Benchmark for Little Kitten Chat
+Seeds a fresh database of each requested size with seed_data.py and times
+the read paths behind get_chats, get_chat_messages, search_messages and
+get_contacts on it, so it is visible how each one scales with the data.
+Reports latency percentiles and SQL queries per call as JSON
+
+    python bench_queries.py --sizes 10000,100000,1000000 --output bench.json
+    python bench_queries.py --measure   # only measure DATABASE_URL (already seeded)
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from loadtest import summarize, log
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Слова из словаря seed_data.py: частый префикс и запрос из двух слов
+SEARCH_QUERIES = ('кот', 'hello world')
+
+def measure(repeat, sample_users):
+    """Замеры на базе DATABASE_URL; вызывается в отдельном процессе"""
+    from sqlalchemy import func
+    from app import app, db, limiter
+    from models import User, Chat, ChatMember, Message
+    from seed_data import SEED_PASSWORD
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    limiter.enabled = False
+
+    with app.app_context():
+        # Самые активные чаты - худший случай для истории и поиска
+        busiest = db.session.query(Message.chat_id, func.count(Message.id)).group_by(
+            Message.chat_id
+        ).order_by(func.count(Message.id).desc()).limit(sample_users).all()
+        targets = []
+        for chat_id, count in busiest:
+            member = ChatMember.query.filter_by(chat_id=chat_id).order_by(ChatMember.id).first()
+            middle_id = db.session.query(Message.id).filter_by(chat_id=chat_id).order_by(
+                Message.id
+            ).offset(count // 2).limit(1).scalar()
+            username = db.session.get(User, member.user_id).username
+            targets.append((username, chat_id, middle_id))
+        dataset = {
+            'users': User.query.count(),
+            'chats': Chat.query.count(),
+            'messages': Message.query.count(),
+            'busiest_chat_messages': busiest[0][1] if busiest else 0,
+        }
+
+    operations = {}
+
+    def timed(operation, client, path):
+        started = time.perf_counter()
+        response = client.get(path)
+        duration = time.perf_counter() - started
+        if response.status_code != 200:
+            raise RuntimeError(f'{operation}: HTTP {response.status_code}')
+        durations, queries = operations.setdefault(operation, ([], []))
+        durations.append(duration)
+        queries.append(int(response.headers.get('X-Query-Count', 0)))
+
+    for username, chat_id, middle_id in targets:
+        client = app.test_client()
+        client.post('/api/login', json={'username': username, 'password': SEED_PASSWORD})
+        for _ in range(repeat):
+            timed('get_chats', client, '/api/chats')
+            timed('get_chat_messages', client, f'/api/chats/{chat_id}/messages')
+            timed('get_chat_messages_deep', client, f'/api/chats/{chat_id}/messages?before_id={middle_id}')
+            for query in SEARCH_QUERIES:
+                timed('search_messages', client, f'/api/chats/{chat_id}/search?q={query}')
+            timed('get_contacts', client, '/api/contacts')
+
+    return {
+        'dataset': dataset,
+        'operations': {
+            operation: summarize(durations, queries)
+            for operation, (durations, queries) in operations.items()
+        }
+    }
+
+def seed_arguments(messages, messages_per_user):
+    """Размер базы: пользователи и чаты растут вместе с числом сообщений"""
+    users = max(100, messages // messages_per_user)
+    return [
+        '--messages', str(messages),
+        '--users', str(users),
+        '--direct-chats', str(users * 3),
+        '--group-chats', str(max(10, users // 20)),
+    ]
+
+def run_size(messages, args, env):
+    work_dir = tempfile.mkdtemp(prefix='lkc_bench_')
+    env = {**env, 'DATABASE_URL': 'sqlite:///' + os.path.join(work_dir, 'bench.db')}
+    try:
+        log(f"Seeding {messages} messages")
+        started = time.time()
+        subprocess.run(
+            [sys.executable, os.path.join(BASE_DIR, 'seed_data.py'), *seed_arguments(messages, args.messages_per_user)],
+            env=env, cwd=BASE_DIR, check=True, stdout=subprocess.DEVNULL
+        )
+        seed_seconds = time.time() - started
+        log(f"Measuring ({seed_seconds:.0f}s to seed)")
+        output = subprocess.run(
+            [sys.executable, os.path.join(BASE_DIR, 'bench_queries.py'), '--measure',
+             '--repeat', str(args.repeat), '--sample-users', str(args.sample_users)],
+            env=env, cwd=BASE_DIR, check=True, stdout=subprocess.PIPE
+        ).stdout
+        result = json.loads(output)
+        result['seed_seconds'] = round(seed_seconds, 1)
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def print_table(results):
+    operations = sorted({operation for result in results.values() for operation in result['operations']})
+    log(f"\n{'operation':<24}{'messages':>10}{'p50 ms':>10}{'p95 ms':>10}{'queries':>9}")
+    for operation in operations:
+        for size, result in results.items():
+            stats = result['operations'].get(operation)
+            if stats:
+                log(f"{operation:<24}{size:>10}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['queries_mean']:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Query latency benchmark at several dataset sizes')
+    parser.add_argument('--sizes', default='10000,100000', help='comma-separated message counts')
+    parser.add_argument('--messages-per-user', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20, help='calls of each path per sampled user')
+    parser.add_argument('--sample-users', type=int, default=3, help='members of the busiest chats to measure as')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    parser.add_argument('--measure', action='store_true', help='measure the already seeded DATABASE_URL')
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.repeat, args.sample_users)))
+        return
+
+    env = {
+        **os.environ,
+        'PYTHONPATH': BASE_DIR,
+        'ENCRYPTION_KEY': os.environ.get('ENCRYPTION_KEY', 'bench-encryption-key'),
+        'SECRET_KEY': 'bench-secret',
+        'QUERY_COUNT_HEADER': 'True',
+        'RATELIMIT_ENABLED': 'False',
+        'LOG_LEVEL': 'WARNING',
+    }
+    results = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        results[size] = run_size(size, args, env)
+
+    print_table(results)
+    report = {
+        'config': {
+            'messages_per_user': args.messages_per_user,
+            'repeat': args.repeat,
+            'sample_users': args.sample_users,
+        },
+        'results': {str(size): result for size, result in results.items()},
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,3 @@
 #!/bin/bash
 pip install -r requirements.txt
-python -c "from app import app, db; with app.app_context(): db.create_all()"
+python migrate_db.py
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Multi-Worker Check for Little Kitten Chat
+Starts two worker processes on one fresh database (both run its migrations
+at startup) and a local message broker (local_broker.py) and checks that a message sent through worker A reaches a
+socket connected to worker B, that one user can be connected from several
+devices and that membership caches are invalidated across workers
+"""
+
+import http.cookiejar
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import simple_websocket
+
+from local_broker import start_broker
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+EVENT_TIMEOUT = 10
+# Сколько ждать пакет open перед подключением к пространству имен
+OPEN_TIMEOUT = 1
+# Время на отсрочку офлайна и пакетную запись присутствия в процессах
+PRESENCE_WAIT = 2
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class HttpClient:
+    """REST-клиент с cookie-сессией, привязанный к одному процессу"""
+
+    def __init__(self, port):
+        self.base = f'http://127.0.0.1:{port}'
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+
+    def request(self, method, path, payload=None):
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(self.base + path, data=data, method=method)
+        request.add_header('Content-Type', 'application/json')
+        with self.opener.open(request, timeout=EVENT_TIMEOUT) as response:
+            return json.loads(response.read())
+
+    def cookie_header(self):
+        return '; '.join(f'{cookie.name}={cookie.value}' for cookie in self.cookies)
+
+class SocketClient:
+    """Минимальный клиент Socket.IO (Engine.IO v4, только websocket)"""
+
+    def __init__(self, port, http_client):
+        self.ws = simple_websocket.Client(
+            f'ws://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket',
+            headers={'Cookie': http_client.cookie_header()}
+        )
+        # Пакет open, пришедший вместе с ответом на upgrade, simple_websocket
+        # иногда отдает только после следующих данных сервера - '40' шлем и без него
+        self.ws.receive(timeout=OPEN_TIMEOUT)
+        self.ws.send('40')
+        # Запоздавший open и события из обработчика connect могут прийти раньше подтверждения
+        packet = self.ws.receive(timeout=EVENT_TIMEOUT)
+        while packet and packet.startswith(('0', '42')):
+            packet = self.ws.receive(timeout=EVENT_TIMEOUT)
+        if not packet or not packet.startswith('40'):
+            raise RuntimeError(f'Socket connection rejected: {packet}')
+
+    def emit(self, event, data):
+        self.ws.send('42' + json.dumps([event, data]))
+
+    def wait_for(self, event, timeout=EVENT_TIMEOUT):
+        """Данные первого события с указанным именем или None по таймауту"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            packet = self.ws.receive(timeout=max(deadline - time.time(), 0.01))
+            if packet is None:
+                continue
+            if packet == '2':
+                self.ws.send('3')
+            elif packet.startswith('42'):
+                name, *args = json.loads(packet[2:])
+                if name == event:
+                    return args[0] if args else None
+        return None
+
+    def close(self):
+        self.ws.close()
+
+def start_worker(port, env):
+    return subprocess.Popen(
+        [sys.executable, os.path.join(BASE_DIR, 'wsgi.py')],
+        env={**env, 'PORT': str(port)},
+        cwd=BASE_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+def wait_until_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def check(name, condition):
+    print(f"{'✅' if condition else '❌'} {name}")
+    return condition
+
+def run_checks(port_a, port_b):
+    alice = HttpClient(port_a)
+    bob_b = HttpClient(port_b)
+    alice.request('POST', '/api/register', {'username': 'worker_alice', 'email': 'alice@workers.local', 'password': 'secret1'})
+    bob_b.request('POST', '/api/register', {'username': 'worker_bob', 'email': 'bob@workers.local', 'password': 'secret1'})
+
+    # Процесс B кэширует членство Боба (поиск по всем чатам) до появления чата
+    bob_b.request('GET', '/api/search?q=hello')
+
+    bob_socket_b = SocketClient(port_b, bob_b)
+    # Второе устройство Боба на процессе A с той же сессией
+    bob_a = HttpClient(port_a)
+    bob_a.request('POST', '/api/login', {'username': 'worker_bob', 'password': 'secret1'})
+    bob_socket_a = SocketClient(port_a, bob_a)
+
+    chat_id = alice.request('POST', '/api/contacts/add', {'username': 'worker_bob'})['chat_id']
+
+    # join_chat на B проходит только если B сбросил кэш членства после запроса на A
+    bob_socket_b.emit('join_chat', {'chat_id': chat_id})
+    joined = bob_socket_b.wait_for('user_joined')
+    results = [check('Membership cache invalidated on the other worker', bool(joined))]
+    bob_socket_a.emit('join_chat', {'chat_id': chat_id})
+    bob_socket_a.wait_for('user_joined')
+
+    alice.request('POST', f'/api/chats/{chat_id}/send', {'content': 'hello across workers'})
+    on_b = bob_socket_b.wait_for('new_message')
+    on_a = bob_socket_a.wait_for('new_message')
+    results.append(check('Message sent via worker A delivered to socket on worker B',
+                         bool(on_b) and on_b.get('content') == 'hello across workers'))
+    results.append(check('Same message delivered to the second device on worker A', bool(on_a)))
+
+    # Закрытие одного устройства не выводит пользователя из сети
+    bob_socket_b.close()
+    time.sleep(PRESENCE_WAIT)
+    contacts = alice.request('GET', '/api/contacts')['contacts']
+    results.append(check('User stays online while another device is connected',
+                         any(c['username'] == 'worker_bob' and c['is_online'] for c in contacts)))
+
+    bob_socket_a.close()
+    time.sleep(PRESENCE_WAIT)
+    contacts = alice.request('GET', '/api/contacts')['contacts']
+    results.append(check('User goes offline with the last device',
+                         any(c['username'] == 'worker_bob' and not c['is_online'] for c in contacts)))
+    return all(results)
+
+def check_multiworker():
+    broker, queue_url = start_broker()
+    work_dir = tempfile.mkdtemp(prefix='lkc_workers_')
+    env = {
+        **os.environ,
+        'DATABASE_URL': 'sqlite:///' + os.path.join(work_dir, 'workers.db'),
+        'SOCKETIO_MESSAGE_QUEUE': queue_url,
+        # Все процессы должны разделять ключи сессий и шифрования
+        'SECRET_KEY': 'multiworker-check-secret',
+        'ENCRYPTION_KEY': 'multiworker-check-encryption-key',
+        'PYTHONPATH': BASE_DIR,
+        # Без отсрочки офлайна и с частой записью присутствия, чтобы не ждать
+        'PRESENCE_GRACE_SECONDS': '0',
+        'PRESENCE_FLUSH_SECONDS': '0.5',
+    }
+    # База пустая: оба процесса одновременно применяют миграции при старте
+    port_a, port_b = free_port(), free_port()
+    workers = [start_worker(port_a, env), start_worker(port_b, env)]
+    try:
+        if not (wait_until_ready(port_a) and wait_until_ready(port_b)):
+            print("❌ Workers did not start")
+            return False
+        return run_checks(port_a, port_b)
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+        broker.shutdown()
+
+if __name__ == "__main__":
+    if check_multiworker():
+        print("\n✅ Workers share rooms, connections and caches")
+    else:
+        print("\n❌ Multi-worker checks failed")
+        sys.exit(1)
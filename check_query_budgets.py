@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Query Budget Guard for Little Kitten Chat
+Runs the hot API paths and socket events against a scratch SQLite database
+with several contacts, chats, replies and notifications, and fails if any of
+them issues more SQL statements than its budget or repeats one statement
+shape (N+1), so such regressions fail CI
+"""
+
+import os
+import sys
+import tempfile
+
+# Отдельная временная база, чтобы не трогать instance/messenger.db
+_db_dir = tempfile.mkdtemp(prefix='lkc_budgets_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_db_dir, 'budgets.db')
+
+from app import app, db, limiter, socketio
+from sql_profiler import assert_query_budget
+
+# Контакты и сообщения: больше порога повторов, чтобы N+1 было видно
+CONTACTS = 5
+MESSAGES = 12
+
+# Бюджеты SQL-запросов на вызов (текущие значения: рост - повод разобраться)
+BUDGETS = {
+    'add_contact': 7,
+    'create_group': 3,
+    'get_user': 1,
+    'get_chats': 2,
+    'get_chat_messages': 7,
+    'get_chat_messages_before': 7,
+    'send_message': 7,
+    'send_reply': 8,
+    'mark_read': 6,
+    'search_messages': 3,
+    'search_all': 3,
+    'get_contacts': 2,
+    'get_notifications': 2,
+    'get_user_settings': 4,
+    'socket_join_chat': 1,
+    'socket_mark_read': 4,
+}
+
+def register(username):
+    client = app.test_client()
+    client.post('/api/register', json={
+        'username': username, 'email': f'{username}@budgets.local', 'password': 'secret1'
+    })
+    return client
+
+def prepare():
+    """alice с CONTACTS личными чатами, ответами и уведомлениями"""
+    alice = register('budget_alice')
+    peers = [register(f'budget_user_{index}') for index in range(CONTACTS)]
+    register('budget_extra')
+    chat_ids = [
+        alice.post('/api/contacts/add', json={'username': f'budget_user_{index}'}).get_json()['chat_id']
+        for index in range(CONTACTS)
+    ]
+    contact_ids = [contact['id'] for contact in alice.get('/api/contacts').get_json()['contacts']]
+
+    chat_id = chat_ids[0]
+    message_ids = []
+    for number in range(MESSAGES):
+        sender = alice if number % 2 else peers[0]
+        payload = {'content': f'hello world {number}'}
+        if message_ids:
+            payload['reply_to_id'] = message_ids[number // 2]
+        message_ids.append(sender.post(f'/api/chats/{chat_id}/send', json=payload).get_json()['message_id'])
+    for peer, peer_chat_id in zip(peers[1:], chat_ids[1:]):
+        peer.post(f'/api/chats/{peer_chat_id}/send', json={'content': 'hello world'})
+    return alice, chat_id, message_ids, contact_ids
+
+def hot_paths(alice, chat_id, message_ids, contact_ids):
+    """(название, функция выполнения запроса)"""
+    socket = socketio.test_client(app, flask_test_client=alice)
+    return [
+        ('add_contact', lambda: alice.post('/api/contacts/add', json={'username': 'budget_extra'})),
+        ('create_group', lambda: alice.post('/api/chats/create-group', json={
+            'name': 'budget group', 'members': contact_ids
+        })),
+        ('get_user', lambda: alice.get('/api/user')),
+        ('get_chats', lambda: alice.get('/api/chats')),
+        ('get_chat_messages', lambda: alice.get(f'/api/chats/{chat_id}/messages')),
+        ('get_chat_messages_before', lambda: alice.get(
+            f'/api/chats/{chat_id}/messages?before_id={message_ids[-1]}'
+        )),
+        ('send_message', lambda: alice.post(f'/api/chats/{chat_id}/send', json={'content': 'budget'})),
+        ('send_reply', lambda: alice.post(f'/api/chats/{chat_id}/send', json={
+            'content': 'budget reply', 'reply_to_id': message_ids[0]
+        })),
+        ('mark_read', lambda: alice.post(f'/api/chats/{chat_id}/read', json={'message_id': message_ids[-1]})),
+        ('search_messages', lambda: alice.get(f'/api/chats/{chat_id}/search?q=hello')),
+        ('search_all', lambda: alice.get('/api/search?q=hello')),
+        ('get_contacts', lambda: alice.get('/api/contacts')),
+        ('get_notifications', lambda: alice.get('/api/notifications')),
+        ('get_user_settings', lambda: alice.get('/api/user/settings')),
+        ('socket_join_chat', lambda: socket.emit('join_chat', {'chat_id': chat_id})),
+        ('socket_mark_read', lambda: socket.emit('mark_read', {'chat_id': chat_id, 'message_id': message_ids[-1]})),
+    ]
+
+def check_query_budgets():
+    """Проверка бюджетов запросов горячих путей"""
+    app.config['WTF_CSRF_ENABLED'] = False
+    limiter.enabled = False
+
+    with app.app_context():
+        db.create_all()
+
+    failures = []
+    for name, run in hot_paths(*prepare()):
+        try:
+            with assert_query_budget(BUDGETS[name], name) as profile:
+                response = run()
+            if response is not None and response.status_code >= 400:
+                failures.append(f'{name}: HTTP {response.status_code}')
+            print(f"{name:<26}{profile.count:>4} / {BUDGETS[name]}")
+        except AssertionError as e:
+            failures.append(str(e))
+
+    for failure in failures:
+        print(f"\n{failure}")
+    return not failures
+
+if __name__ == "__main__":
+    if check_query_budgets():
+        print("\n✅ Hot paths are within their query budgets")
+    else:
+        print("\n❌ Query budget regressions found")
+        sys.exit(1)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Query Plan Guard for Little Kitten Chat
+Runs the hot API paths against a scratch SQLite database, captures every
+statement they issue and fails if EXPLAIN QUERY PLAN shows a full table scan
+"""
+
+import os
+import sys
+import tempfile
+
+# Отдельная временная база, чтобы не трогать instance/messenger.db
+_db_dir = tempfile.mkdtemp(prefix='lkc_plans_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_db_dir, 'plans.db')
+
+from sqlalchemy import event
+
+from app import app, db, limiter
+from presence import presence
+from sqlite_storage import sqlite_storage
+
+# Планы, которые не считаются регрессией
+ALLOWED_SCANS = ('SCAN CONSTANT ROW',)
+
+def is_regression(detail):
+    """Полный проход по таблице или индексу вместо поиска по ключу"""
+    return detail.startswith('SCAN ') and not detail.startswith(ALLOWED_SCANS)
+
+def hot_paths(alice, bob):
+    """Горячие маршруты API: (название, функция выполнения запроса)"""
+    state = {}
+
+    def send():
+        response = alice.post(f"/api/chats/{state['chat_id']}/send", json={'content': 'hello world'})
+        state['message_id'] = response.get_json()['message_id']
+
+    def presence_audience():
+        with app.app_context():
+            presence.audience(1)
+
+    def reply():
+        alice.post(f"/api/chats/{state['chat_id']}/send", json={
+            'content': 'reply', 'reply_to_id': state['message_id']
+        })
+
+    return [
+        ('add_contact', lambda: state.update(
+            chat_id=alice.post('/api/contacts/add', json={'username': 'plan_bob'}).get_json()['chat_id']
+        )),
+        ('send_message', send),
+        ('send_reply', reply),
+        ('get_chats', lambda: bob.get('/api/chats')),
+        ('get_chat_messages', lambda: bob.get(f"/api/chats/{state['chat_id']}/messages")),
+        ('get_chat_messages_before', lambda: bob.get(
+            f"/api/chats/{state['chat_id']}/messages?before_id={state['message_id'] + 1}"
+        )),
+        ('mark_read', lambda: bob.post(f"/api/chats/{state['chat_id']}/read", json={'message_id': state['message_id']})),
+        ('edit_message', lambda: alice.put(f"/api/messages/{state['message_id']}/edit", json={'content': 'hello there'})),
+        ('search_messages', lambda: bob.get(f"/api/chats/{state['chat_id']}/search?q=hel")),
+        ('search_all', lambda: bob.get('/api/search?q=hel')),
+        ('get_contacts', lambda: alice.get('/api/contacts')),
+        ('get_notifications', lambda: alice.get('/api/notifications')),
+        ('presence_audience', presence_audience),
+        ('delete_message', lambda: alice.delete(f"/api/messages/{state['message_id']}/delete")),
+    ]
+
+def check_query_plans():
+    """Сбор и проверка планов запросов горячих путей"""
+    app.config['WTF_CSRF_ENABLED'] = False
+    limiter.enabled = False
+
+    # Запросы тестового клиента идут вне общего app context,
+    # иначе пользователи клиентов смешиваются через flask.g
+    with app.app_context():
+        db.create_all()
+        engine = db.engine
+
+    alice = app.test_client()
+    bob = app.test_client()
+    alice.post('/api/register', json={'username': 'plan_alice', 'email': 'alice@plans.local', 'password': 'secret1'})
+    bob.post('/api/register', json={'username': 'plan_bob', 'email': 'bob@plans.local', 'password': 'secret1'})
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            captured.append((statement, parameters))
+
+    # GET-запросы идут через пул читателей - слушаем и его
+    engines = [engine]
+    if sqlite_storage.reader is not None:
+        engines.append(sqlite_storage.reader)
+
+    failures = []
+    checked = 0
+    for name, run in hot_paths(alice, bob):
+        captured.clear()
+        for listened in engines:
+            event.listen(listened, 'before_cursor_execute', capture)
+        try:
+            run()
+        finally:
+            for listened in engines:
+                event.remove(listened, 'before_cursor_execute', capture)
+
+        with engine.connect() as conn:
+            for statement, parameters in captured:
+                plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+                details = [row[-1] for row in plan]
+                checked += 1
+                bad = [detail for detail in details if is_regression(detail)]
+                if bad:
+                    failures.append((name, ' '.join(statement.split()), bad))
+
+    print(f"Checked {checked} statements on hot paths")
+    for name, statement, bad in failures:
+        print(f"\n[{name}] {statement}")
+        for detail in bad:
+            print(f"    {detail}")
+
+    return not failures
+
+if __name__ == "__main__":
+    if check_query_plans():
+        print("\n✅ No full table scans on hot paths")
+    else:
+        print("\n❌ Query plan regressions found")
+        sys.exit(1)
@@ -0,0 +1,164 @@
+"""
+Общее состояние нескольких процессов приложения.
+
+При SOCKETIO_MESSAGE_QUEUE (redis://...) события Socket.IO расходятся между
+процессами через очередь, реестр подключений хранит user_id -> множество sid
+в Redis, а локальные кэши (например, членство в чатах) сбрасываются во всех
+процессах через канал CLUSTER_CHANNEL. Без очереди все живет в памяти
+одного процесса.
+"""
+
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+REDIS_SCHEMES = ('redis://', 'rediss://', 'unix://')
+# Ключи реестра подключений и канал служебных сообщений
+SIDS_KEY = 'lkc:sids:{}'
+CLUSTER_CHANNEL = 'lkc:cluster'
+# Множество sid пользователя живет не дольше суток без новых подключений
+# (страховка от sid процессов, завершившихся аварийно)
+SIDS_TTL = 24 * 3600
+
+def is_redis_url(url):
+    return bool(url) and url.startswith(REDIS_SCHEMES)
+
+def user_room(user_id):
+    """Комната всех устройств пользователя"""
+    return f'user_{user_id}'
+
+def socketio_options(url):
+    """Параметры SocketIO для очереди сообщений между процессами"""
+    return {'message_queue': url} if url else {}
+
+class MemoryRegistry:
+    """Реестр подключений одного процесса: user_id -> множество sid"""
+
+    def __init__(self):
+        self._sids = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def add(self, user_id, sid):
+        """Регистрация подключения; возвращает число подключений пользователя"""
+        with self._lock:
+            self._sids[user_id].add(sid)
+            return len(self._sids[user_id])
+
+    def remove(self, user_id, sid):
+        """Удаление подключения; возвращает оставшееся число подключений"""
+        with self._lock:
+            sids = self._sids.get(user_id)
+            if sids is None:
+                return 0
+            sids.discard(sid)
+            if not sids:
+                del self._sids[user_id]
+            return len(sids)
+
+    def sids(self, user_id):
+        with self._lock:
+            return set(self._sids.get(user_id, ()))
+
+    def is_connected(self, user_id):
+        with self._lock:
+            return bool(self._sids.get(user_id))
+
+class RedisRegistry:
+    """Реестр подключений всех процессов в Redis (множество sid на пользователя)"""
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+
+    def add(self, user_id, sid):
+        key = SIDS_KEY.format(user_id)
+        self.redis.sadd(key, sid)
+        self.redis.expire(key, SIDS_TTL)
+        return self.redis.scard(key)
+
+    def remove(self, user_id, sid):
+        key = SIDS_KEY.format(user_id)
+        self.redis.srem(key, sid)
+        return self.redis.scard(key)
+
+    def sids(self, user_id):
+        return {sid.decode() for sid in self.redis.smembers(SIDS_KEY.format(user_id))}
+
+    def is_connected(self, user_id):
+        return self.redis.scard(SIDS_KEY.format(user_id)) > 0
+
+def create_registry(url):
+    if is_redis_url(url):
+        return RedisRegistry(url)
+    if url:
+        logger.warning("Connection registry needs a Redis message queue, falling back to process memory")
+    return MemoryRegistry()
+
+class ClusterBus:
+    """Служебные сообщения между процессами (сброс локальных кэшей).
+
+    Обработчики вызываются и в процессе-отправителе, и во всех остальных.
+    """
+
+    def __init__(self):
+        self._handlers = {}
+        self._redis = None
+        self.host_id = uuid.uuid4().hex
+
+    def on(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def start(self, url, start_background_task):
+        """Подписка на канал; без Redis сообщения остаются внутри процесса"""
+        if not is_redis_url(url):
+            return False
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        start_background_task(self._listen)
+        return True
+
+    def publish(self, kind, payload):
+        self._dispatch(kind, payload)
+        if self._redis is not None:
+            message = {'host_id': self.host_id, 'kind': kind, 'payload': payload}
+            try:
+                self._redis.publish(CLUSTER_CHANNEL, json.dumps(message))
+            except Exception as e:
+                logger.error(f"Cluster publish error: {str(e)}")
+
+    def _dispatch(self, kind, payload):
+        handler = self._handlers.get(kind)
+        if handler:
+            handler(payload)
+
+    def _listen(self):
+        retry_sleep = 1
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CLUSTER_CHANNEL)
+                retry_sleep = 1
+                for message in pubsub.listen():
+                    self._receive(message['data'])
+            except Exception as e:
+                # Пока канал недоступен, кэши других процессов могут устареть
+                logger.error(f"Cluster channel error, retrying in {retry_sleep}s: {str(e)}")
+                time.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 60)
+
+    def _receive(self, raw):
+        try:
+            data = json.loads(raw)
+            if data.get('host_id') != self.host_id:
+                self._dispatch(data['kind'], data['payload'])
+        except Exception as e:
+            logger.error(f"Cluster message error: {str(e)}")
+
+cluster_bus = ClusterBus()
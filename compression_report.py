@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Message Compression Report for Little Kitten Chat
+Encrypts a representative corpus of messages (short chat lines, pasted code
+from this repository, server logs, JSON) the way the app stores them and
+reports stored bytes, I/O per history page and encrypt/decrypt time for the
+old Fernet tokens, the binary format without compression and with it, for
+several compression thresholds. Output is JSON plus a table on stderr
+
+    python compression_report.py --count 20000 --output compression.json
+    python compression_report.py --database   # corpus from DATABASE_URL messages
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+from encryption import EncryptionManager, FLAG_ZLIB, MESSAGE_HEADER, COMPRESS_MIN_BYTES
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Лимит длины сообщения в send_message
+MAX_MESSAGE_LENGTH = 4000
+# Сообщений на странице истории (HISTORY_PAGE_SIZE)
+PAGE_SIZE = 50
+DEFAULT_MIX = 'chat=0.8,code=0.08,logs=0.07,json=0.05'
+
+WORDS = (
+    'привет как дела котик мурчит спит ест играет окно солнце дождь завтра сегодня вечером '
+    'встреча работа проект релиз база запрос индекс кэш сервер клиент сообщение фото видео '
+    'hello world cat kitten meow coffee lunch deploy review merge branch ticket fix bug '
+    'weekend music movie book travel photo link call later thanks sure okay'
+).split()
+LEVELS = ('INFO', 'INFO', 'INFO', 'DEBUG', 'WARNING', 'ERROR')
+PATHS = ('/api/chats', '/api/chats/{}/messages', '/api/chats/{}/send', '/api/contacts', '/api/search?q=cat')
+
+class Corpus:
+    """Генераторы сообщений разных видов с фиксированным зерном"""
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.sources = []
+        for path in sorted(glob.glob(os.path.join(BASE_DIR, '*.py'))):
+            with open(path, encoding='utf-8') as f:
+                self.sources.append(f.read().splitlines())
+
+    def chat(self):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(self.rng.randint(1, 25)))
+
+    def code(self):
+        lines = self.rng.choice(self.sources)
+        start = self.rng.randrange(max(len(lines) - 10, 1))
+        return '\n'.join(lines[start:start + self.rng.randint(10, 80)])
+
+    def logs(self):
+        second = self.rng.randrange(86400)
+        lines = []
+        for _ in range(self.rng.randint(5, 50)):
+            second += self.rng.randint(0, 3)
+            path = self.rng.choice(PATHS).format(self.rng.randint(1, 5000))
+            lines.append(
+                f'2026-10-{self.rng.randint(1, 28):02d} {second // 3600 % 24:02d}:{second // 60 % 60:02d}:'
+                f'{second % 60:02d},{self.rng.randrange(1000):03d} {self.rng.choice(LEVELS)} app '
+                f'127.0.0.1 - - "GET {path} HTTP/1.1" {self.rng.choice((200, 200, 200, 304, 404, 500))} '
+                f'{self.rng.randint(100, 90000)} {self.rng.random():.6f}'
+            )
+        return '\n'.join(lines)
+
+    def json(self):
+        items = [{
+            'id': self.rng.randint(1, 10 ** 6),
+            'name': self.chat()[:40],
+            'tags': self.rng.sample(WORDS, 3),
+            'active': self.rng.random() < 0.5,
+            'score': round(self.rng.random() * 100, 2)
+        } for _ in range(self.rng.randint(1, 20))]
+        return json.dumps({'status': 'success', 'items': items}, ensure_ascii=False, indent=2)
+
+    def generate(self, count, mix):
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        return [(kind, getattr(self, kind)()[:MAX_MESSAGE_LENGTH])
+                for kind in self.rng.choices(kinds, weights=weights, k=count)]
+
+def database_corpus(limit):
+    """Тексты сообщений из DATABASE_URL (расшифровываются ключом ENCRYPTION_KEY)"""
+    from sqlalchemy import create_engine, text
+    from encryption import encryption_manager
+
+    engine = create_engine(os.environ.get('DATABASE_URL', 'sqlite:///instance/messenger.db'))
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            'SELECT content, content_blob, is_encrypted FROM message WHERE is_deleted = :deleted '
+            'ORDER BY id DESC LIMIT :limit'
+        ), {'deleted': False, 'limit': limit}).all()
+    corpus = []
+    for content, content_blob, is_encrypted in rows:
+        stored = content_blob if content_blob is not None else content
+        if not is_encrypted and content_blob is None:
+            corpus.append(('database', content))
+            continue
+        try:
+            corpus.append(('database', encryption_manager.decrypt_message(stored)))
+        except Exception:
+            continue
+    return corpus
+
+def measure(corpus, encrypt, decrypt, binary=True):
+    """Хранимые байты и время шифрования/расшифровки по видам сообщений"""
+    stats = {}
+    for kind, text in corpus:
+        started = time.perf_counter()
+        stored = encrypt(text)
+        encrypted = time.perf_counter()
+        decrypt(stored)
+        decrypted = time.perf_counter()
+        entry = stats.setdefault(kind, {'messages': 0, 'plaintext_bytes': 0, 'stored_bytes': 0,
+                                        'compressed': 0, 'encrypt_s': 0.0, 'decrypt_s': 0.0})
+        entry['messages'] += 1
+        entry['plaintext_bytes'] += len(text.encode())
+        entry['stored_bytes'] += len(stored)
+        if binary and stored[1] & FLAG_ZLIB:
+            entry['compressed'] += 1
+        entry['encrypt_s'] += encrypted - started
+        entry['decrypt_s'] += decrypted - encrypted
+
+    total = {key: sum(entry[key] for entry in stats.values())
+             for key in ('messages', 'plaintext_bytes', 'stored_bytes', 'compressed', 'encrypt_s', 'decrypt_s')}
+    return {kind: summarize(entry) for kind, entry in {**stats, 'total': total}.items()}
+
+def summarize(entry):
+    messages = max(entry['messages'], 1)
+    return {
+        'messages': entry['messages'],
+        'compressed_share': round(entry['compressed'] / messages, 3),
+        'plaintext_bytes': entry['plaintext_bytes'],
+        'stored_bytes': entry['stored_bytes'],
+        'stored_per_plaintext': round(entry['stored_bytes'] / max(entry['plaintext_bytes'], 1), 3),
+        'page_read_bytes': round(entry['stored_bytes'] / messages * PAGE_SIZE),
+        'encrypt_us': round(entry['encrypt_s'] / messages * 1e6, 1),
+        'decrypt_us': round(entry['decrypt_s'] / messages * 1e6, 1),
+    }
+
+def run(corpus, thresholds):
+    key = 'compression-report-key'
+    fernet = EncryptionManager(key)
+    variants = {
+        'fernet': measure(corpus, lambda text: fernet.encrypt_legacy(text).encode(),
+                          lambda token: fernet._decrypt(token.decode()), binary=False),
+    }
+    for threshold in thresholds:
+        manager = EncryptionManager(key, compress_min_bytes=threshold)
+        name = 'binary' if threshold == 0 else f'binary_zlib_{threshold}'
+        variants[name] = measure(corpus, manager.encrypt_message, manager._decrypt)
+    return variants
+
+def print_table(variants):
+    baseline = variants.get('binary', {}).get('total')
+    log(f"\n{'variant':<20}{'kind':<10}{'msgs':>7}{'zlib %':>8}{'stored/plain':>14}"
+        f"{'page KB':>9}{'saved %':>9}{'enc us':>8}{'dec us':>8}")
+    for name, kinds in variants.items():
+        for kind, stats in kinds.items():
+            saved = ''
+            if baseline and kind == 'total':
+                saved = f"{(1 - stats['stored_bytes'] / baseline['stored_bytes']) * 100:.1f}"
+            log(f"{name:<20}{kind:<10}{stats['messages']:>7}{stats['compressed_share'] * 100:>8.1f}"
+                f"{stats['stored_per_plaintext']:>14}{stats['page_read_bytes'] / 1024:>9.1f}{saved:>9}"
+                f"{stats['encrypt_us']:>8}{stats['decrypt_us']:>8}")
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        kind, share = part.split('=')
+        if kind not in ('chat', 'code', 'logs', 'json'):
+            raise argparse.ArgumentTypeError(f'unknown message kind: {kind}')
+        mix[kind] = float(share)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description='Storage and CPU effect of message compression')
+    parser.add_argument('--count', type=int, default=20000, help='messages in the synthetic corpus')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'default: {DEFAULT_MIX}')
+    parser.add_argument('--thresholds', default=f'128,{COMPRESS_MIN_BYTES},512,1024',
+                        help='compression thresholds in bytes to compare (0 = no compression is always added)')
+    parser.add_argument('--database', action='store_true', help='use the latest --count messages of DATABASE_URL')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+
+    corpus = database_corpus(args.count) if args.database else Corpus(args.seed).generate(args.count, args.mix)
+    if not corpus:
+        log("No messages to measure")
+        sys.exit(1)
+    thresholds = [0] + [int(value) for value in args.thresholds.split(',') if int(value) > 0]
+    variants = run(corpus, thresholds)
+
+    print_table(variants)
+    report = {
+        'config': {
+            'messages': len(corpus),
+            'source': 'database' if args.database else args.mix,
+            'envelope_overhead_bytes': MESSAGE_HEADER.size + 12 + 16,
+            'page_size': PAGE_SIZE,
+        },
+        'variants': variants,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import os
 from datetime import timedelta
 import secrets
+from sqlite_storage import engine_options
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -12,14 +13,26 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'instance', 'messenger.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_ENGINE_OPTIONS = {
-        'pool_pre_ping': True,
-        'pool_recycle': 300,
-    }
+    # Режим SQLite (sqlite_storage.py): WAL, пул читателей, один писатель
+    SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'True').lower() == 'true'
+    SQLITE_READ_POOL_SIZE = int(os.environ.get('SQLITE_READ_POOL_SIZE', 8))
+    # Ожидание чужой блокировки внутри драйвера (другие процессы)
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    # Для SQLite - свои настройки соединений
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI, SQLITE_BUSY_TIMEOUT_MS)
     
     # Настройки загрузки файлов
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     UPLOAD_FOLDER = os.path.join(basedir, 'static', 'uploads')
+    # Незавершенные загрузки - вне UPLOAD_FOLDER: папка отдается как статика,
+    # а части файлов лежат на диске в открытом виде до завершения загрузки
+    UPLOAD_SESSIONS_FOLDER = os.environ.get('UPLOAD_SESSIONS_FOLDER') or \
+        os.path.join(basedir, 'instance', 'upload_sessions')
+    # Разгрузка отдачи файлов на прокси: '', 'x-accel-redirect' (nginx) или 'x-sendfile'
+    MEDIA_SENDFILE = os.environ.get('MEDIA_SENDFILE', '')
+    MEDIA_ACCEL_PREFIX = os.environ.get('MEDIA_ACCEL_PREFIX', '/protected-uploads/')
+    # Сколько изображений одновременно обрабатывается в фоне (images.py)
+    IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
     
     # Настройки сессии
     PERMANENT_SESSION_LIFETIME = timedelta(days=7)
@@ -32,9 +45,41 @@ class Config:
     
     # Настройки шифрования
     ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY') or secrets.token_hex(32)
+    # Шифровать загружаемые файлы потоковым форматом (хранятся как *.enc)
+    ENCRYPT_UPLOADS = os.environ.get('ENCRYPT_UPLOADS', 'False').lower() == 'true'
+    
+    # Групповая фиксация отправки сообщений: одна транзакция на пачку отправителей
+    WRITE_PIPELINE = os.environ.get('WRITE_PIPELINE', 'False').lower() == 'true'
+    WRITE_PIPELINE_MAX_BATCH = int(os.environ.get('WRITE_PIPELINE_MAX_BATCH', 64))
+    WRITE_PIPELINE_MAX_DELAY_MS = float(os.environ.get('WRITE_PIPELINE_MAX_DELAY_MS', 5))
+    
+    # Фоновое перешифрование старых Fernet-сообщений в бинарный формат (reencryption.py)
+    REENCRYPT_LEGACY = os.environ.get('REENCRYPT_LEGACY', 'True').lower() == 'true'
+    REENCRYPT_BATCH_SIZE = int(os.environ.get('REENCRYPT_BATCH_SIZE', 200))
+    REENCRYPT_PAUSE_SECONDS = float(os.environ.get('REENCRYPT_PAUSE_SECONDS', 1))
+    
+    # Присутствие (presence.py): отсрочка офлайна и период пакетной записи в базу
+    PRESENCE_GRACE_SECONDS = float(os.environ.get('PRESENCE_GRACE_SECONDS', 15))
+    PRESENCE_FLUSH_SECONDS = float(os.environ.get('PRESENCE_FLUSH_SECONDS', 5))
+    
+    # Очередь сообщений Socket.IO между процессами (redis://...); пусто - один процесс
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE', '')
     
     # Настройки rate limiting
     RATELIMIT_STORAGE_URL = os.environ.get('REDIS_URL', 'memory://')
+    # Отключается для нагрузочного теста (loadtest.py)
+    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', 'True').lower() == 'true'
+    
+    # Токен доступа к /metrics (Authorization: Bearer ...); пусто - только с localhost
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+    
+    # Заголовок X-Query-Count с числом SQL-запросов в ответе (sql_profiler.py)
+    QUERY_COUNT_HEADER = os.environ.get('QUERY_COUNT_HEADER', 'False').lower() == 'true'
+    
+    # Профилировщик SQL (sql_profiler.py): заголовок Server-Timing и N+1 в лог,
+    # если одинаковый запрос выполнен SQL_PROFILE_REPEAT_THRESHOLD и больше раз
+    SQL_PROFILE = os.environ.get('SQL_PROFILE', 'False').lower() == 'true'
+    SQL_PROFILE_REPEAT_THRESHOLD = int(os.environ.get('SQL_PROFILE_REPEAT_THRESHOLD', 3))
     
     # Настройки безопасности
     WTF_CSRF_ENABLED = True
@@ -1,52 +1,406 @@
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from collections import OrderedDict
 import base64
+import hashlib
+import hmac
 import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from metrics import metrics
+
+# Потоковый формат файлов: заголовок + кадры AES-GCM фиксированного размера.
+# Заголовок: MAGIC | версия (1 байт) | размер блока (4 байта) | соль файла (16 байт).
+# Кадр i: шифротекст блока + тег 16 байт; nonce = i (11 байт) | флаг последнего кадра,
+# заголовок идет как AAD. Ключ кадров выводится из соли, поэтому nonce не повторяются,
+# а флаг последнего кадра не дает незаметно обрезать файл.
+STREAM_MAGIC = b'LKCS'
+STREAM_VERSION = 1
+STREAM_HEADER = struct.Struct('>4sBI16s')
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_TAG_SIZE = 16
+
+# Бинарный формат сообщений: заголовок + nonce 12 байт + шифротекст с тегом 16 байт.
+# Заголовок: версия формата (1 байт) | флаги (1 байт) | id ключа (1 байт), идет как AAD.
+# Id ключа: поколение ключа (старшие 4 бита) | алгоритм (младшие 4 бита). Поколение 0
+# выводится из ENCRYPTION_KEY, 1-15 - ключи связки MESSAGE_KEYS, поэтому ни смена
+# MESSAGE_CIPHER, ни ротация ключа не ломают чтение уже записанных сообщений.
+# Накладные расходы - 31 байт вместо base64 (x1.37) и 57 байт у Fernet.
+MESSAGE_FORMAT = 1
+MESSAGE_HEADER = struct.Struct('>BBB')
+MESSAGE_NONCE_SIZE = 12
+KEY_GENERATIONS = 16
+# Флаги формата: текст сжат zlib перед шифрованием
+FLAG_ZLIB = 0x01
+KNOWN_FLAGS = FLAG_ZLIB
+
+# Шифры сообщений: имя -> (id алгоритма, класс AEAD, info для HKDF)
+MESSAGE_CIPHERS = {
+    'aes-gcm': (1, AESGCM, b'messenger_message_aes_gcm'),
+    'chacha20': (2, ChaCha20Poly1305, b'messenger_message_chacha20'),
+}
+
+# Короткие сообщения zlib не сжимает (заголовок и словарь дороже выигрыша)
+COMPRESS_MIN_BYTES = 256
+COMPRESS_LEVEL = 6
+
+def parse_message_keys(value):
+    """MESSAGE_KEYS "3:секрет,2:секрет" -> [(поколение, секрет)], первый ключ - текущий"""
+    keys = []
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        generation, _, secret = item.partition(':')
+        if not generation.isdigit() or not 0 < int(generation) < KEY_GENERATIONS or not secret:
+            raise ValueError(f'Неверный ключ MESSAGE_KEYS: ожидается <1-{KEY_GENERATIONS - 1}>:<секрет>')
+        keys.append((int(generation), secret))
+    if len({generation for generation, _ in keys}) != len(keys):
+        raise ValueError('Повторяющееся поколение ключа в MESSAGE_KEYS')
+    return keys
+
+def _derive_key(secret):
+    return PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=b'messenger_salt',
+        iterations=100000,
+    ).derive(secret.encode())
+
+class MessageCipher:
+    """AEAD-шифр сообщений с id ключа в заголовке"""
+    
+    def __init__(self, key_id, aead):
+        self.key_id = key_id
+        self.aead = aead
+    
+    def encrypt(self, plaintext, flags=0):
+        header = MESSAGE_HEADER.pack(MESSAGE_FORMAT, flags, self.key_id)
+        nonce = os.urandom(MESSAGE_NONCE_SIZE)
+        return header + nonce + self.aead.encrypt(nonce, plaintext, header)
+    
+    def decrypt(self, data):
+        header = data[:MESSAGE_HEADER.size]
+        nonce = data[MESSAGE_HEADER.size:MESSAGE_HEADER.size + MESSAGE_NONCE_SIZE]
+        return self.aead.decrypt(nonce, data[MESSAGE_HEADER.size + MESSAGE_NONCE_SIZE:], header)
+
+class DecryptCache:
+    """LRU-кэш расшифрованных сообщений с ограничением по объему в байтах.
+
+    Ключ - дайджест шифротекста, поэтому новая версия сообщения (новый токен)
+    никогда не попадает на устаревший текст.
+    """
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    @staticmethod
+    def key(encrypted_message):
+        if isinstance(encrypted_message, str):
+            encrypted_message = encrypted_message.encode()
+        return hashlib.blake2b(encrypted_message, digest_size=16).digest()
+    
+    @staticmethod
+    def _size(key, plaintext):
+        return len(key) + sys.getsizeof(plaintext)
+    
+    def get(self, key):
+        with self._lock:
+            plaintext = self._entries.get(key)
+            if plaintext is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return plaintext
+    
+    def put(self, key, plaintext):
+        size = self._size(key, plaintext)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= self._size(key, previous)
+            self._entries[key] = plaintext
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                old_key, old_plaintext = self._entries.popitem(last=False)
+                self.bytes -= self._size(old_key, old_plaintext)
+                self.evictions += 1
+    
+    def invalidate(self, key):
+        with self._lock:
+            plaintext = self._entries.pop(key, None)
+            if plaintext is not None:
+                self.bytes -= self._size(key, plaintext)
+                self.invalidations += 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes
+            }
 
 class EncryptionManager:
-    def __init__(self, key):
-        self.key = base64.urlsafe_b64encode(
-            PBKDF2HMAC(
-                algorithm=hashes.SHA256(),
-                length=32,
-                salt=b'messenger_salt',
-                iterations=100000,
-            ).derive(key.encode())
-        )
+    def __init__(self, key, cache_bytes=0, message_cipher='aes-gcm', compress_min_bytes=COMPRESS_MIN_BYTES,
+                 message_keys=()):
+        """message_keys - связка ключей сообщений [(поколение, секрет)], первый - текущий;
+        без нее сообщения шифруются ключом поколения 0 из key"""
+        master_key = _derive_key(key)
+        self.key = base64.urlsafe_b64encode(master_key)
+        # Fernet - старый формат сообщений, только для чтения и перешифрования
         self.fernet = Fernet(self.key)
+        keyring = {0: master_key}
+        for generation, secret in message_keys:
+            keyring[generation] = _derive_key(secret)
+        # id ключа -> шифр: все поколения связки читаются, пишется только текущее
+        self.message_ciphers = {}
+        for generation, generation_key in keyring.items():
+            for cipher_id, aead, info in MESSAGE_CIPHERS.values():
+                key_id = generation << 4 | cipher_id
+                cipher_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info).derive(generation_key)
+                self.message_ciphers[key_id] = MessageCipher(key_id, aead(cipher_key))
+        if message_cipher not in MESSAGE_CIPHERS:
+            raise ValueError(f'Неизвестный шифр сообщений: {message_cipher}')
+        current_generation = message_keys[0][0] if message_keys else 0
+        self.message_cipher = self.message_ciphers[current_generation << 4 | MESSAGE_CIPHERS[message_cipher][0]]
+        # Сжатие перед шифрованием; 0 - выключено
+        self.compress_min_bytes = compress_min_bytes
+        self.cache = DecryptCache(cache_bytes) if cache_bytes > 0 else None
+        # Отдельный ключ для слепого индекса поиска
+        self.index_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'messenger_search_index',
+        ).derive(base64.urlsafe_b64decode(self.key))
+        # Ключ, из которого выводятся ключи потокового шифрования файлов
+        self.stream_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'messenger_file_stream',
+        ).derive(base64.urlsafe_b64decode(self.key))
+    
+    def compress(self, plaintext):
+        """(данные, флаги): zlib только для длинных текстов и только если он выигрывает"""
+        if self.compress_min_bytes and len(plaintext) >= self.compress_min_bytes:
+            compressed = zlib.compress(plaintext, COMPRESS_LEVEL)
+            if len(compressed) < len(plaintext):
+                return compressed, FLAG_ZLIB
+        return plaintext, 0
     
     def encrypt_message(self, message):
-        """Шифрование сообщения"""
-        return self.fernet.encrypt(message.encode()).decode()
+        """Шифрование сообщения в бинарный формат (bytes)"""
+        started = time.perf_counter()
+        encrypted_message = self.message_cipher.encrypt(*self.compress(message.encode()))
+        metrics.crypto.observe(time.perf_counter() - started, ('encrypt',))
+        if self.cache:
+            # Свежие сообщения читаются сразу после отправки
+            self.cache.put(DecryptCache.key(encrypted_message), message)
+        return encrypted_message
     
     def decrypt_message(self, encrypted_message):
-        """Дешифрование сообщения"""
-        return self.fernet.decrypt(encrypted_message.encode()).decode()
+        """Дешифрование сообщения: bytes - бинарный формат, str - старый Fernet-токен"""
+        if not self.cache:
+            return self._decrypt(encrypted_message)
+        
+        key = DecryptCache.key(encrypted_message)
+        message = self.cache.get(key)
+        if message is None:
+            message = self._decrypt(encrypted_message)
+            self.cache.put(key, message)
+        return message
+    
+    def _decrypt(self, encrypted_message):
+        started = time.perf_counter()
+        if isinstance(encrypted_message, str):
+            message = self.fernet.decrypt(encrypted_message.encode()).decode()
+        else:
+            message = self._decrypt_binary(bytes(encrypted_message)).decode()
+        metrics.crypto.observe(time.perf_counter() - started, ('decrypt',))
+        return message
+    
+    def _decrypt_binary(self, data):
+        if len(data) < MESSAGE_HEADER.size + MESSAGE_NONCE_SIZE:
+            raise ValueError('Поврежденное зашифрованное сообщение')
+        version, flags, key_id = MESSAGE_HEADER.unpack_from(data)
+        cipher = self.message_ciphers.get(key_id)
+        if version != MESSAGE_FORMAT or cipher is None or flags & ~KNOWN_FLAGS:
+            raise ValueError('Неизвестный формат зашифрованного сообщения')
+        plaintext = cipher.decrypt(data)
+        if flags & FLAG_ZLIB:
+            plaintext = zlib.decompress(plaintext)
+        return plaintext
+    
+    def reencrypt(self, token):
+        """Fernet-токен -> бинарный формат, мимо кэша (фоновое перешифрование)"""
+        self.invalidate(token)
+        return self.message_cipher.encrypt(*self.compress(self.fernet.decrypt(token.encode())))
+    
+    def encrypt_legacy(self, message):
+        """Fernet-токен (str) - для шагов миграций, пишущих в старые текстовые колонки"""
+        return self.fernet.encrypt(message.encode()).decode()
+    
+    def blind_index(self, term):
+        """Детерминированный токен поискового индекса (HMAC-SHA256, 128 бит)"""
+        return hmac.new(self.index_key, term.encode(), hashlib.sha256).hexdigest()[:32]
+    
+    def invalidate(self, encrypted_message):
+        """Удаление расшифрованного текста из кэша (после правки/удаления)"""
+        if self.cache and encrypted_message:
+            self.cache.invalidate(DecryptCache.key(encrypted_message))
+    
+    def cache_stats(self):
+        """Счетчики кэша расшифровки"""
+        return self.cache.stats() if self.cache else None
+    
+    def _stream_cipher(self, salt):
+        file_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            info=b'messenger_file_frame',
+        ).derive(self.stream_key)
+        return AESGCM(file_key)
+    
+    @staticmethod
+    def _frame_nonce(index, final):
+        return index.to_bytes(11, 'big') + (b'\x01' if final else b'\x00')
+    
+    def encrypt_stream(self, source, destination, chunk_size=STREAM_CHUNK_SIZE):
+        """Потоковое шифрование: читает source блоками, пишет кадры в destination.
+        
+        Память - O(chunk_size). Возвращает размер открытых данных.
+        """
+        salt = os.urandom(16)
+        header = STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, chunk_size, salt)
+        cipher = self._stream_cipher(salt)
+        destination.write(header)
+        
+        total = 0
+        index = 0
+        chunk = source.read(chunk_size)
+        while True:
+            # Читаем на блок вперед, чтобы знать, какой кадр последний
+            next_chunk = source.read(chunk_size) if len(chunk) == chunk_size else b''
+            final = not next_chunk
+            destination.write(cipher.encrypt(self._frame_nonce(index, final), chunk, header))
+            total += len(chunk)
+            if final:
+                return total
+            chunk = next_chunk
+            index += 1
+    
+    def _read_stream_header(self, file):
+        header = file.read(STREAM_HEADER.size)
+        if len(header) != STREAM_HEADER.size:
+            raise ValueError('Поврежденный зашифрованный файл')
+        magic, version, chunk_size, salt = STREAM_HEADER.unpack(header)
+        if magic != STREAM_MAGIC or version != STREAM_VERSION:
+            raise ValueError('Неизвестный формат зашифрованного файла')
+        return header, chunk_size, salt
+    
+    @staticmethod
+    def is_stream_file(path):
+        """Файл в потоковом формате (а не старый Fernet-токен)"""
+        with open(path, 'rb') as file:
+            return file.read(len(STREAM_MAGIC)) == STREAM_MAGIC
+    
+    def stream_salt(self, path):
+        """Соль из заголовка файла (уникальна для каждого шифрования)"""
+        with open(path, 'rb') as file:
+            return self._read_stream_header(file)[2]
+    
+    def stream_plaintext_size(self, path):
+        """Размер открытых данных по размеру зашифрованного файла, без расшифровки"""
+        with open(path, 'rb') as file:
+            _, chunk_size, _ = self._read_stream_header(file)
+        body = os.path.getsize(path) - STREAM_HEADER.size
+        frame_size = chunk_size + STREAM_TAG_SIZE
+        frames = max(1, -(-body // frame_size))
+        return body - frames * STREAM_TAG_SIZE
+    
+    def decrypt_stream(self, path, start=0, end=None):
+        """Генератор открытых данных диапазона [start, end) с произвольным доступом.
+        
+        Читаются и расшифровываются только кадры, покрывающие диапазон.
+        """
+        plaintext_size = self.stream_plaintext_size(path)
+        end = plaintext_size if end is None else min(end, plaintext_size)
+        
+        with open(path, 'rb') as file:
+            header, chunk_size, salt = self._read_stream_header(file)
+            cipher = self._stream_cipher(salt)
+            frame_size = chunk_size + STREAM_TAG_SIZE
+            last_index = max(0, -(-plaintext_size // chunk_size) - 1)
+            
+            index = start // chunk_size
+            while True:
+                if index > last_index:
+                    break
+                file.seek(STREAM_HEADER.size + index * frame_size)
+                frame = file.read(frame_size)
+                chunk = cipher.decrypt(self._frame_nonce(index, index == last_index), frame, header)
+                chunk_start = index * chunk_size
+                piece = chunk[max(start - chunk_start, 0):end - chunk_start]
+                if piece:
+                    yield piece
+                if chunk_start + chunk_size >= end:
+                    break
+                index += 1
     
     def encrypt_file(self, file_path):
         """Шифрование файла"""
-        with open(file_path, 'rb') as file:
-            file_data = file.read()
-        encrypted_data = self.fernet.encrypt(file_data)
-        
         encrypted_path = file_path + '.enc'
-        with open(encrypted_path, 'wb') as file:
-            file.write(encrypted_data)
+        with open(file_path, 'rb') as source, open(encrypted_path, 'wb') as destination:
+            self.encrypt_stream(source, destination)
         
         return encrypted_path
     
     def decrypt_file(self, encrypted_path, output_path):
         """Дешифрование файла"""
-        with open(encrypted_path, 'rb') as file:
-            encrypted_data = file.read()
-        decrypted_data = self.fernet.decrypt(encrypted_data)
+        if not self.is_stream_file(encrypted_path):
+            # Старый формат: файл целиком в одном Fernet-токене
+            with open(encrypted_path, 'rb') as file:
+                encrypted_data = file.read()
+            with open(output_path, 'wb') as file:
+                file.write(self.fernet.decrypt(encrypted_data))
+            return output_path
         
         with open(output_path, 'wb') as file:
-            file.write(decrypted_data)
+            for chunk in self.decrypt_stream(encrypted_path):
+                file.write(chunk)
         
         return output_path
 
 # Создание менеджера шифрования
 encryption_key = os.environ.get('ENCRYPTION_KEY') or 'default-encryption-key-change-in-production'
-encryption_manager = EncryptionManager(encryption_key)
\ No newline at end of file
+decrypt_cache_bytes = int(os.environ.get('DECRYPT_CACHE_BYTES', 16 * 1024 * 1024))
+message_cipher = os.environ.get('MESSAGE_CIPHER', 'aes-gcm')
+compress_min_bytes = int(os.environ.get('MESSAGE_COMPRESS_MIN_BYTES', COMPRESS_MIN_BYTES))
+message_keys = parse_message_keys(os.environ.get('MESSAGE_KEYS', ''))
+encryption_manager = EncryptionManager(encryption_key, cache_bytes=decrypt_cache_bytes, message_cipher=message_cipher,
+                                       compress_min_bytes=compress_min_bytes, message_keys=message_keys)
\ No newline at end of file
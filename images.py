@@ -0,0 +1,149 @@
+"""
+Производные изображений: превью, WebP и фиксированные размеры аватаров.
+
+Варианты строятся вне обработки запроса: задачи ставятся в зеленый пул,
+а декодирование и масштабирование выполняются в потоках ОС (eventlet.tpool),
+чтобы не блокировать цикл событий. Имя варианта детерминировано:
+<имя оригинала>.<вариант>.webp, поэтому адрес известен сразу, а пока вариант
+не готов, вместо него отдается оригинал.
+"""
+
+import io
+import logging
+import os
+import uuid
+import eventlet
+from eventlet import tpool
+from PIL import Image, ImageOps
+from flask import current_app
+from encryption import encryption_manager
+
+logger = logging.getLogger(__name__)
+
+# Вписываются в квадрат заданного размера с сохранением пропорций
+ATTACHMENT_VARIANTS = {
+    'thumb': 320,
+    'preview': 1280,
+}
+# Квадратные аватары с обрезкой по центру
+AVATAR_VARIANTS = {
+    'avatar48': 48,
+    'avatar96': 96,
+    'avatar256': 256,
+}
+VARIANT_FORMAT = 'webp'
+WEBP_QUALITY = 80
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+
+# Одновременно обрабатываемых изображений; размер задает init_app (IMAGE_WORKERS)
+_pool = eventlet.GreenPool(2)
+
+def init_app(app):
+    _pool.resize(app.config['IMAGE_WORKERS'])
+
+def is_image(name):
+    return '.' in name and name.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+def variant_name(name, variant):
+    return f'{name}.{variant}.{VARIANT_FORMAT}'
+
+def variant_source(name):
+    """Имя оригинала для имени варианта или None"""
+    for variant in (*ATTACHMENT_VARIANTS, *AVATAR_VARIANTS):
+        suffix = f'.{variant}.{VARIANT_FORMAT}'
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return None
+
+def _variant_urls(url, variants):
+    if not url or not url.startswith('/uploads/') or not is_image(url):
+        return None
+    return {variant: variant_name(url, variant) for variant in variants}
+
+def attachment_variants(url):
+    """Адреса превью вложения или None, если это не изображение"""
+    return _variant_urls(url, ATTACHMENT_VARIANTS)
+
+def avatar_variants(url):
+    """Адреса аватара фиксированных размеров или None"""
+    return _variant_urls(url, AVATAR_VARIANTS)
+
+def _variant_path(upload_folder, name, variant):
+    return os.path.join(upload_folder, variant_name(name, variant))
+
+def _read_original(path):
+    if path.endswith('.enc'):
+        return b''.join(encryption_manager.decrypt_stream(path))
+    with open(path, 'rb') as file:
+        return file.read()
+
+def _write_variant(path, data, encrypt):
+    # Запись через временный файл: читатель не увидит недописанный вариант
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'wb') as destination:
+        if encrypt:
+            encryption_manager.encrypt_stream(io.BytesIO(data), destination)
+        else:
+            destination.write(data)
+    os.replace(temp_path, path + ('.enc' if encrypt else ''))
+
+def _render(image, size, square):
+    if square:
+        resized = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    else:
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.LANCZOS)
+    output = io.BytesIO()
+    # Метаданные (EXIF, GPS) не переносятся: сохраняются только пиксели
+    resized.save(output, VARIANT_FORMAT.upper(), quality=WEBP_QUALITY, method=4)
+    return output.getvalue()
+
+def render_variants(source_path, upload_folder, name, variants, square=False):
+    """Построение недостающих вариантов (блокирующая работа, выполняется в потоке ОС)"""
+    encrypt = source_path.endswith('.enc')
+    missing = {
+        variant: size for variant, size in variants.items()
+        if not os.path.exists(_variant_path(upload_folder, name, variant) + ('.enc' if encrypt else ''))
+    }
+    if not missing:
+        return 0
+
+    with Image.open(io.BytesIO(_read_original(source_path))) as original:
+        # Ориентация из EXIF применяется к пикселям до удаления метаданных
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+        for variant, size in missing.items():
+            _write_variant(_variant_path(upload_folder, name, variant), _render(image, size, square), encrypt)
+    return len(missing)
+
+def _run(source_path, upload_folder, name, variants, square):
+    try:
+        tpool.execute(render_variants, source_path, upload_folder, name, variants, square)
+    except Exception as e:
+        logger.error(f"Image derivatives error for {name}: {str(e)}")
+
+def schedule_variants(source_path, name, avatar=False):
+    """Постановка построения вариантов в фоновый пул.
+
+    name - имя оригинала относительно папки загрузок, source_path - файл на диске.
+    """
+    if not is_image(name):
+        return False
+    variants = AVATAR_VARIANTS if avatar else ATTACHMENT_VARIANTS
+    _pool.spawn_n(_run, source_path, current_app.config['UPLOAD_FOLDER'], name, variants, avatar)
+    return True
+
+def wait_variants():
+    """Ожидание завершения всех поставленных задач (для скриптов)"""
+    _pool.waitall()
+
+def remove_variants(upload_folder, name):
+    """Удаление всех вариантов оригинала"""
+    for variant in (*ATTACHMENT_VARIANTS, *AVATAR_VARIANTS):
+        for suffix in ('', '.enc'):
+            try:
+                os.remove(_variant_path(upload_folder, name, variant) + suffix)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Load Test for Little Kitten Chat
+Starts the app (wsgi.py) against a fresh database and simulates users over
+HTTP and real Socket.IO connections: login, joining chats, typing, sending
+messages and scrolling history. Reports throughput, latency percentiles
+(send -> new_message delivery, /api/chats, /api/chats/<id>/messages) and
+SQL queries per operation as JSON, so runs can be compared
+
+Works locally without network access. Settings of the app under test
+(WRITE_PIPELINE, SQLITE_PROFILE, ...) are taken from the environment.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from check_multiworker import HttpClient, SocketClient, free_port, start_worker, wait_until_ready
+
+# Сколько ждать доставки последних сообщений после окончания отправки
+DELIVERY_TIMEOUT = 10
+# Настройки приложения, попадающие в отчет
+REPORTED_SETTINGS = ('WRITE_PIPELINE', 'SQLITE_PROFILE', 'SQLITE_READ_POOL_SIZE', 'ENCRYPT_UPLOADS')
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+def percentile(values, share):
+    """Перцентиль методом ближайшего ранга"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(share * len(ordered)) - 1, 0)]
+
+def summarize(durations, queries=(), errors=0):
+    milliseconds = [value * 1000 for value in durations]
+    summary = {
+        'count': len(milliseconds),
+        'errors': errors,
+        'mean_ms': round(sum(milliseconds) / len(milliseconds), 2) if milliseconds else None,
+        'max_ms': round(max(milliseconds), 2) if milliseconds else None,
+    }
+    for name, share in (('p50_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+        value = percentile(milliseconds, share)
+        summary[name] = round(value, 2) if value is not None else None
+    if queries:
+        summary['queries_mean'] = round(sum(queries) / len(queries), 2)
+        summary['queries_max'] = max(queries)
+    return summary
+
+class Recorder:
+    """Замеры всех пользователей (потокобезопасно)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.queries = {}
+        self.errors = {}
+        self.sent_at = {}
+        self.delivered_at = {}
+
+    def record(self, operation, duration, query_count):
+        with self.lock:
+            self.durations.setdefault(operation, []).append(duration)
+            if query_count is not None:
+                self.queries.setdefault(operation, []).append(query_count)
+
+    def error(self, operation):
+        with self.lock:
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def sent(self, content, started):
+        with self.lock:
+            self.sent_at[content] = started
+
+    def delivered(self, content, received):
+        with self.lock:
+            self.delivered_at.setdefault(content, received)
+
+    def report(self):
+        with self.lock:
+            operations = {
+                operation: summarize(self.durations.get(operation, []), self.queries.get(operation, ()),
+                                     self.errors.get(operation, 0))
+                for operation in sorted(set(self.durations) | set(self.errors))
+            }
+            latencies = [
+                self.delivered_at[content] - started
+                for content, started in self.sent_at.items() if content in self.delivered_at
+            ]
+            delivery = summarize(latencies)
+            delivery['lost'] = len(self.sent_at) - len(latencies)
+        return operations, delivery
+
+class LoadClient(HttpClient):
+    """HTTP-клиент с замером времени и числа SQL-запросов (X-Query-Count)"""
+
+    def __init__(self, port, recorder):
+        super().__init__(port)
+        self.recorder = recorder
+
+    def call(self, operation, method, path, payload=None):
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(self.base + path, data=data, method=method)
+        request.add_header('Content-Type', 'application/json')
+        started = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                body = json.loads(response.read())
+                query_count = response.headers.get('X-Query-Count')
+        except (urllib.error.URLError, OSError, ValueError):
+            self.recorder.error(operation)
+            return None
+        self.recorder.record(operation, time.perf_counter() - started,
+                             int(query_count) if query_count is not None else None)
+        return body
+
+class SocketListener(threading.Thread):
+    """Чтение событий сокета пользователя: время прихода чужих сообщений"""
+
+    def __init__(self, socket_client, username, recorder):
+        super().__init__(daemon=True)
+        self.socket = socket_client
+        self.username = username
+        self.recorder = recorder
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                packet = self.socket.ws.receive(timeout=0.5)
+            except Exception:
+                return
+            if packet is None:
+                continue
+            if packet == '2':
+                self.socket.ws.send('3')
+            elif packet.startswith('42'):
+                name, *args = json.loads(packet[2:])
+                content = args[0].get('content', '') if name == 'new_message' and args else ''
+                # Собственные сообщения отправителя в задержку доставки не входят
+                if content and not content.startswith(f'{self.username}:'):
+                    self.recorder.delivered(content, time.perf_counter())
+
+    def stop(self):
+        self.running = False
+
+def prepare_users(port, users, recorder):
+    """Регистрация, кольцо контактов (у каждого два личных чата), вход и сокеты"""
+    names = [f'load_user_{index}' for index in range(users)]
+    for name in names:
+        HttpClient(port).request('POST', '/api/register', {
+            'username': name, 'email': f'{name}@load.local', 'password': 'secret1'
+        })
+
+    clients = []
+    for name in names:
+        client = LoadClient(port, recorder)
+        client.call('login', 'POST', '/api/login', {'username': name, 'password': 'secret1'})
+        clients.append(client)
+
+    for index, client in enumerate(clients):
+        client.call('add_contact', 'POST', '/api/contacts/add', {'username': names[(index + 1) % users]})
+
+    sessions = []
+    for name, client in zip(names, clients):
+        chats = client.call('chats', 'GET', '/api/chats') or {}
+        chat_ids = [chat['id'] for chat in chats.get('chats', [])]
+        socket_client = SocketClient(port, client)
+        for chat_id in chat_ids:
+            socket_client.emit('join_chat', {'chat_id': chat_id})
+        listener = SocketListener(socket_client, name, recorder)
+        listener.start()
+        sessions.append((name, client, socket_client, listener, chat_ids))
+    return sessions
+
+def user_workload(session, messages, history_pages, recorder):
+    name, client, socket_client, _, chat_ids = session
+    if not chat_ids:
+        return
+    for number in range(messages):
+        chat_id = chat_ids[number % len(chat_ids)]
+        socket_client.emit('typing_start', {'chat_id': chat_id})
+        content = f'{name}:{number}'
+        recorder.sent(content, time.perf_counter())
+        client.call('send', 'POST', f'/api/chats/{chat_id}/send', {'content': content})
+
+        # Периодически - список чатов и прокрутка истории, как в клиенте
+        if number % 5 == 4:
+            client.call('chats', 'GET', '/api/chats')
+            page = client.call('history', 'GET', f'/api/chats/{chat_id}/messages')
+            for _ in range(history_pages - 1):
+                cursor = (page or {}).get('next_cursor')
+                if not cursor:
+                    break
+                page = client.call('history', 'GET', f'/api/chats/{chat_id}/messages?before_id={cursor}')
+
+def wait_for_delivery(recorder, timeout=DELIVERY_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with recorder.lock:
+            if len(recorder.delivered_at) >= len(recorder.sent_at):
+                return
+        time.sleep(0.1)
+
+def run_load(port, users, messages, history_pages):
+    recorder = Recorder()
+    log(f"Preparing {users} users")
+    sessions = prepare_users(port, users, recorder)
+    time.sleep(1)  # join_chat обрабатывается асинхронно
+
+    log(f"Sending {users * messages} messages")
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user_workload, args=(session, messages, history_pages, recorder))
+               for session in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    wait_for_delivery(recorder)
+
+    for _, _, socket_client, listener, _ in sessions:
+        listener.stop()
+        socket_client.close()
+
+    operations, delivery = recorder.report()
+    sent = operations.get('send', {}).get('count', 0)
+    requests_total = sum(
+        len(recorder.durations.get(operation, [])) for operation in ('send', 'chats', 'history')
+    )
+    return {
+        'duration_s': round(elapsed, 3),
+        'throughput': {
+            'messages_per_s': round(sent / elapsed, 2) if elapsed else None,
+            'requests_per_s': round(requests_total / elapsed, 2) if elapsed else None,
+        },
+        'operations': operations,
+        'delivery': delivery,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test for Little Kitten Chat')
+    parser.add_argument('--users', type=int, default=20, help='simulated users (at least 3)')
+    parser.add_argument('--messages', type=int, default=20, help='messages sent by each user')
+    parser.add_argument('--history-pages', type=int, default=3, help='history pages per scroll')
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    args = parser.parse_args()
+    if args.users < 3:
+        parser.error('--users must be at least 3')
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    work_dir = tempfile.mkdtemp(prefix='lkc_load_')
+    env = {
+        **os.environ,
+        'DATABASE_URL': 'sqlite:///' + os.path.join(work_dir, 'load.db'),
+        'SECRET_KEY': 'load-test-secret',
+        'ENCRYPTION_KEY': 'load-test-encryption-key',
+        'PYTHONPATH': base_dir,
+        'RATELIMIT_ENABLED': 'False',
+        'QUERY_COUNT_HEADER': 'True',
+        'LOG_LEVEL': 'WARNING',
+    }
+    port = free_port()
+    worker = start_worker(port, env)
+    try:
+        if not wait_until_ready(port):
+            log("App did not start")
+            sys.exit(1)
+        result = run_load(port, args.users, args.messages, args.history_pages)
+    finally:
+        worker.terminate()
+        worker.wait()
+
+    report = {
+        'config': {
+            'users': args.users,
+            'messages_per_user': args.messages,
+            'history_pages': args.history_pages,
+            'settings': {name: os.environ[name] for name in REPORTED_SETTINGS if name in os.environ},
+        },
+        **result,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+if __name__ == "__main__":
+    main()
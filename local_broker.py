@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Local Message Broker for Little Kitten Chat
+Minimal stand-in for Redis (RESP protocol: pub/sub and sets) for running
+several workers on one machine without a Redis server - development and
+the multi-worker check only, data lives in memory
+"""
+
+import argparse
+import socketserver
+import threading
+from collections import defaultdict
+
+# Ответ уже отправлен обработчиком команды
+NO_REPLY = object()
+
+class BrokerState:
+    """Состояние брокера: множества и подписчики каналов"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sets = defaultdict(set)
+        self.channels = defaultdict(set)
+
+def encode(value):
+    """Ответ в формате RESP"""
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, str):
+        return b'+' + value.encode() + b'\r\n'
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    if isinstance(value, Exception):
+        return b'-ERR ' + str(value).encode() + b'\r\n'
+    return b'*%d\r\n' % len(value) + b''.join(encode(item) for item in value)
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """Одно подключение клиента Redis"""
+
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+        self.subscriptions = set()
+
+    def send(self, data):
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        state = self.server.state
+        try:
+            while True:
+                command = self.read_command()
+                if command is None:
+                    break
+                if command:
+                    reply = self.execute(state, command[0].upper().decode(), command[1:])
+                    if reply is not NO_REPLY:
+                        self.send(encode(reply))
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            with state.lock:
+                for channel in self.subscriptions:
+                    state.channels[channel].discard(self)
+
+    def execute(self, state, name, args):
+        if name == 'PING':
+            return 'PONG'
+        if name in ('CLIENT', 'SELECT'):
+            return 'OK'
+        if name == 'PUBLISH':
+            with state.lock:
+                subscribers = list(state.channels[args[0]])
+            message = encode([b'message', args[0], args[1]])
+            for subscriber in subscribers:
+                try:
+                    subscriber.send(message)
+                except OSError:
+                    pass
+            return len(subscribers)
+        if name in ('SUBSCRIBE', 'UNSUBSCRIBE'):
+            # На каждый канал отдельный ответ
+            replies = []
+            with state.lock:
+                for channel in args:
+                    if name == 'SUBSCRIBE':
+                        self.subscriptions.add(channel)
+                        state.channels[channel].add(self)
+                    else:
+                        self.subscriptions.discard(channel)
+                        state.channels[channel].discard(self)
+                    replies.append(encode([name.lower().encode(), channel, len(self.subscriptions)]))
+            self.send(b''.join(replies))
+            return NO_REPLY
+        with state.lock:
+            if name == 'SADD':
+                before = len(state.sets[args[0]])
+                state.sets[args[0]].update(args[1:])
+                return len(state.sets[args[0]]) - before
+            if name == 'SREM':
+                before = len(state.sets[args[0]])
+                state.sets[args[0]].difference_update(args[1:])
+                return before - len(state.sets[args[0]])
+            if name == 'SCARD':
+                return len(state.sets.get(args[0], ()))
+            if name == 'SMEMBERS':
+                return list(state.sets.get(args[0], ()))
+            if name == 'EXPIRE':
+                # Время жизни ключей не поддерживается: данные живут до остановки брокера
+                return int(args[0] in state.sets)
+            if name == 'DEL':
+                return sum(1 for key in args if state.sets.pop(key, None) is not None)
+        return Exception(f"unknown command '{name}'")
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, BrokerHandler)
+        self.state = BrokerState()
+
+def start_broker(host='127.0.0.1', port=0):
+    """Запуск брокера в фоновом потоке; возвращает (сервер, redis-URL)"""
+    server = BrokerServer((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, f'redis://{host}:{port}/0'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local Redis stand-in for several workers')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args()
+
+    server = BrokerServer((args.host, args.port))
+    print(f"Local broker listening on redis://{args.host}:{args.port}/0")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
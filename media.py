@@ -0,0 +1,123 @@
+import mimetypes
+import os
+import re
+from datetime import datetime, timezone
+from flask import Response, current_app, request, send_file
+from werkzeug.http import is_resource_modified
+from werkzeug.utils import safe_join
+from encryption import encryption_manager
+
+# Имена файлов, адресуемых по содержимому (SHA-256), можно кэшировать навсегда
+CONTENT_ADDRESSED_RE = re.compile(r'^[0-9a-f]{64}(\.[A-Za-z0-9]+)*$')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+def is_content_addressed(filename):
+    return bool(CONTENT_ADDRESSED_RE.match(os.path.basename(filename)))
+
+def _cache_control(response, filename):
+    # Файлы доступны только после входа, поэтому кэш всегда private
+    if is_content_addressed(filename):
+        response.headers['Cache-Control'] = f'private, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _file_etag(filename, stat):
+    if is_content_addressed(filename):
+        # Полное имя: у вариантов изображения тот же хэш, что у оригинала
+        return os.path.basename(filename)
+    return f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+def _not_modified(etag, last_modified, filename):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return _cache_control(response, filename)
+
+def _byte_range(size, etag):
+    """Запрошенный диапазон: (start, stop), None - весь файл, False - диапазон за концом файла.
+
+    Несколько диапазонов (multipart/byteranges) не поддерживаются - отдается весь файл.
+    If-Range с другим ETag означает, что у клиента устаревшая копия - тоже весь файл.
+    """
+    requested = request.range
+    if requested is None or requested.units != 'bytes' or len(requested.ranges) != 1:
+        return None
+    if 'If-Range' in request.headers and request.if_range.etag != etag:
+        return None
+    return requested.range_for_length(size) or False
+
+def _range_not_satisfiable(size):
+    response = Response(status=416)
+    response.headers['Content-Range'] = f'bytes */{size}'
+    return response
+
+def send_upload(filename):
+    """Отдача загруженного файла: ETag, 304, Range/206 и опциональная разгрузка на прокси"""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+
+    encrypted_path = safe_join(upload_folder, filename + '.enc')
+    if encrypted_path and os.path.isfile(encrypted_path):
+        return send_encrypted_file(encrypted_path, filename)
+
+    path = safe_join(upload_folder, filename)
+    if not path or not os.path.isfile(path):
+        return Response(status=404)
+
+    stat = os.stat(path)
+    etag = _file_etag(filename, stat)
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), tz=timezone.utc)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return _not_modified(etag, last_modified, filename)
+
+    mode = current_app.config.get('MEDIA_SENDFILE', '').lower()
+    if mode in ('x-accel-redirect', 'x-sendfile'):
+        # Приложение только проверяет доступ, байты отдает фронтовой прокси
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        if mode == 'x-accel-redirect':
+            prefix = current_app.config.get('MEDIA_ACCEL_PREFIX', '/protected-uploads/')
+            response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + filename.lstrip('/')
+        else:
+            response.headers['X-Sendfile'] = path
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        return _cache_control(response, filename)
+
+    byte_range = _byte_range(stat.st_size, etag)
+    if byte_range is False:
+        return _range_not_satisfiable(stat.st_size)
+    # Единственный диапазон разбирает send_file, остальные запросы получают файл целиком
+    response = send_file(path, conditional=byte_range is not None, etag=etag, last_modified=last_modified)
+    response.headers.setdefault('Accept-Ranges', 'bytes')
+    return _cache_control(response, filename)
+
+def send_encrypted_file(encrypted_path, filename):
+    """Отдача зашифрованного файла с расшифровкой на лету и поддержкой Range"""
+    size = encryption_manager.stream_plaintext_size(encrypted_path)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    # Соль в заголовке уникальна для каждого зашифрованного файла - сильный ETag
+    stat = os.stat(encrypted_path)
+    etag = f'{encryption_manager.stream_salt(encrypted_path).hex()[:16]}-{size:x}'
+    last_modified = datetime.fromtimestamp(int(stat.st_mtime), tz=timezone.utc)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return _not_modified(etag, last_modified, filename)
+
+    byte_range = _byte_range(size, etag)
+    if byte_range is False:
+        return _range_not_satisfiable(size)
+
+    start, stop = byte_range or (0, size)
+    response = Response(
+        encryption_manager.decrypt_stream(encrypted_path, start, stop),
+        status=206 if byte_range else 200,
+        mimetype=mimetype,
+        direct_passthrough=True
+    )
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Length'] = str(stop - start)
+    if byte_range:
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return _cache_control(response, filename)
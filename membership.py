@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+from flask_login import current_user
+from models import db, ChatMember
+from cluster import cluster_bus
+
+# Сколько пользователей держать в кэше членства
+MEMBERSHIP_CACHE_USERS = 10000
+# Срок жизни записи: страховка, если сброс из другого процесса потерялся
+MEMBERSHIP_CACHE_TTL = 30
+
+class MembershipCache:
+    """Кэш членства в чатах: user_id -> {chat_id: role}.
+
+    Все членства пользователя загружаются одним запросом при первом обращении.
+    После добавления/удаления участников или смены роли нужно вызвать
+    invalidate_members - он сбрасывает кэш и в остальных процессах.
+    Сброс увеличивает поколение пользователя: результат запроса, начатого
+    до сброса, в кэш не попадает. Записи живут не дольше ttl секунд.
+    """
+
+    def __init__(self, max_users=MEMBERSHIP_CACHE_USERS, ttl=MEMBERSHIP_CACHE_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        # user_id -> (expires_at, {chat_id: role})
+        self._users = OrderedDict()
+        # user_id -> число сбросов; _epoch растет при clear
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def memberships(self, user_id):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._users.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = (self._epoch, self._generations.get(user_id, 0))
+
+        chats = dict(db.session.query(ChatMember.chat_id, ChatMember.role).filter(
+            ChatMember.user_id == user_id
+        ).all())
+
+        with self._lock:
+            # Сброс во время запроса: результат мог устареть
+            if generation != (self._epoch, self._generations.get(user_id, 0)):
+                return chats
+            self._users[user_id] = (time.monotonic() + self.ttl, chats)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return chats
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._users.pop(user_id, None)
+                self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._generations.clear()
+            self._epoch += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'users': len(self._users)}
+
+membership_cache = MembershipCache()
+
+def _chat_key(chat_id):
+    try:
+        return int(chat_id)
+    except (TypeError, ValueError):
+        return None
+
+def get_membership(chat_id, user_id):
+    """Роль пользователя в чате или None, если он не участник"""
+    chat_id = _chat_key(chat_id)
+    if chat_id is None:
+        return None
+    return membership_cache.memberships(user_id).get(chat_id)
+
+def require_member(chat_id, role=None):
+    """Проверка членства текущего пользователя в чате.
+
+    role - допустимая роль или набор ролей. Возвращает роль или None,
+    если пользователь не участник или его роль недостаточна.
+    """
+    if not current_user.is_authenticated:
+        return None
+    member_role = get_membership(chat_id, current_user.id)
+    if member_role is None:
+        return None
+    if role is not None:
+        allowed = (role,) if isinstance(role, str) else tuple(role)
+        if member_role not in allowed:
+            return None
+    return member_role
+
+def member_chat_ids(user_id):
+    """Идентификаторы всех чатов пользователя"""
+    return list(membership_cache.memberships(user_id).keys())
+
+def invalidate_members(*user_ids):
+    """Сброс кэша после изменения состава чата или ролей (во всех процессах)"""
+    cluster_bus.publish('membership', list(user_ids))
+
+cluster_bus.on('membership', lambda user_ids: membership_cache.invalidate(*user_ids))
@@ -0,0 +1,248 @@
+import threading
+from collections import OrderedDict
+from sqlalchemy import func, or_, and_, case
+from models import db, Chat, ChatMember, Message
+from encryption import encryption_manager
+
+# Максимальная длина превью последнего сообщения в списке чатов
+PREVIEW_LENGTH = 120
+
+# Размер страницы истории сообщений
+HISTORY_PAGE_SIZE = 50
+
+# Кэш превью цитируемых сообщений: message_id -> (updated_at, текст)
+REPLY_PREVIEW_CACHE_SIZE = 4096
+_reply_preview_cache = OrderedDict()
+_reply_preview_lock = threading.Lock()
+
+def stored_content(message):
+    """Шифротекст сообщения: бинарный (content_blob) или старый Fernet-токен.
+
+    Строки шагов миграций могут не содержать content_blob - тогда только старый формат.
+    """
+    blob = getattr(message, 'content_blob', None)
+    return blob if blob is not None else message.content
+
+def message_text(message):
+    """Расшифрованный текст сообщения"""
+    content = stored_content(message)
+    if not message.is_encrypted and isinstance(content, str):
+        return content
+    try:
+        return encryption_manager.decrypt_message(content)
+    except Exception:
+        return '[Ошибка расшифровки]'
+
+def encrypted_content(text):
+    """Значения колонок сообщения для нового текста"""
+    return {'content': '', 'content_blob': encryption_manager.encrypt_message(text), 'is_encrypted': True}
+
+def set_message_text(message, text):
+    """Замена текста сообщения (правка, удаление) с очисткой кэша расшифровки"""
+    encryption_manager.invalidate(stored_content(message))
+    for column, value in encrypted_content(text).items():
+        setattr(message, column, value)
+
+def reply_preview(original):
+    """Превью цитируемого сообщения с кэшированием по версии"""
+    with _reply_preview_lock:
+        cached = _reply_preview_cache.get(original.id)
+        if cached and cached[0] == original.updated_at:
+            _reply_preview_cache.move_to_end(original.id)
+            text = cached[1]
+        else:
+            text = None
+
+    if text is None:
+        text = message_text(original)[:PREVIEW_LENGTH]
+        with _reply_preview_lock:
+            _reply_preview_cache[original.id] = (original.updated_at, text)
+            _reply_preview_cache.move_to_end(original.id)
+            while len(_reply_preview_cache) > REPLY_PREVIEW_CACHE_SIZE:
+                _reply_preview_cache.popitem(last=False)
+
+    return {
+        'id': original.id,
+        'sender_id': original.sender_id,
+        'content': text
+    }
+
+def reply_previews(messages, chat_id):
+    """Превью ответов для страницы сообщений одним IN-запросом"""
+    reply_ids = {message.reply_to_id for message in messages if message.reply_to_id}
+    if not reply_ids:
+        return {}
+
+    originals = Message.query.filter(
+        Message.id.in_(reply_ids),
+        Message.chat_id == chat_id
+    ).all()
+    return {original.id: reply_preview(original) for original in originals}
+
+def forget_reply_preview(message_id):
+    """Удаление превью из кэша после изменения сообщения"""
+    with _reply_preview_lock:
+        _reply_preview_cache.pop(message_id, None)
+
+def record_message_sent(message, content):
+    """Обновление сводки чата и счетчиков непрочитанных после отправки"""
+    # Сводка только движется вперед: параллельная отправка или повтор
+    # пайплайна не вернут в нее более старое сообщение
+    Chat.query.filter(
+        Chat.id == message.chat_id,
+        or_(Chat.last_message_id.is_(None), Chat.last_message_id < message.id)
+    ).update({
+        'last_message_id': message.id,
+        'last_message_preview': None,
+        'last_message_preview_blob': encryption_manager.encrypt_message(content[:PREVIEW_LENGTH]),
+        'last_message_sender_id': message.sender_id,
+        'last_message_at': message.created_at
+    }, synchronize_session=False)
+
+    ChatMember.query.filter(
+        ChatMember.chat_id == message.chat_id,
+        ChatMember.user_id != message.sender_id
+    ).update({'unread_count': ChatMember.unread_count + 1}, synchronize_session=False)
+
+    # Отправитель прочитал чат до своего сообщения включительно
+    ChatMember.query.filter_by(chat_id=message.chat_id, user_id=message.sender_id).update({
+        'last_read_message_id': message.id,
+        'unread_count': 0
+    }, synchronize_session=False)
+
+def record_message_changed(message, content):
+    """Обновление превью, если изменено последнее сообщение чата"""
+    forget_reply_preview(message.id)
+    Chat.query.filter_by(id=message.chat_id, last_message_id=message.id).update({
+        'last_message_preview': None,
+        'last_message_preview_blob': encryption_manager.encrypt_message(content[:PREVIEW_LENGTH])
+    }, synchronize_session=False)
+
+def mark_chat_read(chat_id, user_id, message_id=None):
+    """Продвижение курсора прочтения участника.
+
+    Без message_id чат считается прочитанным до последнего сообщения.
+    Курсор только растет; возвращает новый курсор или None, если он не сдвинулся.
+    """
+    last_message_id = db.session.query(Chat.last_message_id).filter_by(id=chat_id).scalar() or 0
+    member = ChatMember.query.filter(
+        ChatMember.chat_id == chat_id,
+        ChatMember.user_id == user_id
+    )
+
+    if message_id is None or message_id >= last_message_id:
+        cursor = last_message_id
+        updated = member.filter(or_(
+            ChatMember.last_read_message_id < cursor,
+            ChatMember.unread_count != 0
+        )).update({
+            'last_read_message_id': cursor,
+            'unread_count': 0
+        }, synchronize_session=False)
+    else:
+        cursor = message_id
+        unread_count = Message.query.filter(
+            Message.chat_id == chat_id,
+            Message.id > cursor,
+            Message.sender_id != user_id
+        ).count()
+        updated = member.filter(ChatMember.last_read_message_id < cursor).update({
+            'last_read_message_id': cursor,
+            'unread_count': unread_count
+        }, synchronize_session=False)
+
+    return cursor if updated else None
+
+def read_cursors(chat_id, user_id):
+    """Курсор прочтения участника и максимальный курсор остальных участников"""
+    own, peers = db.session.query(
+        func.max(case((ChatMember.user_id == user_id, ChatMember.last_read_message_id), else_=0)),
+        func.max(case((ChatMember.user_id != user_id, ChatMember.last_read_message_id), else_=0))
+    ).filter(ChatMember.chat_id == chat_id).one()
+    return own or 0, peers or 0
+
+def fetch_history(chat_id, before_id=None, after_id=None, limit=HISTORY_PAGE_SIZE):
+    """Страница истории чата с keyset-пагинацией по (created_at, id).
+
+    Без курсора возвращает последние сообщения. before_id листает к более
+    старым, after_id - к более новым. Результат: (сообщения по возрастанию,
+    next_cursor для более старых, prev_cursor для более новых).
+    Якорь не найден - возвращает None.
+    """
+    query = Message.query.filter(Message.chat_id == chat_id)
+    anchor_id = after_id or before_id
+
+    if anchor_id:
+        anchor = db.session.query(Message.created_at).filter_by(id=anchor_id, chat_id=chat_id).first()
+        if not anchor:
+            return None
+        anchor_at = anchor.created_at
+
+    if after_id:
+        query = query.filter(or_(
+            Message.created_at > anchor_at,
+            and_(Message.created_at == anchor_at, Message.id > anchor_id)
+        )).order_by(Message.created_at.asc(), Message.id.asc())
+    else:
+        if before_id:
+            query = query.filter(or_(
+                Message.created_at < anchor_at,
+                and_(Message.created_at == anchor_at, Message.id < anchor_id)
+            ))
+        query = query.order_by(Message.created_at.desc(), Message.id.desc())
+
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if after_id:
+        messages = rows
+        older = bool(messages)
+        newer = has_more
+    else:
+        messages = rows[::-1]
+        older = has_more
+        newer = bool(before_id) and bool(messages)
+
+    next_cursor = messages[0].id if older and messages else None
+    prev_cursor = messages[-1].id if newer and messages else None
+    return messages, next_cursor, prev_cursor
+
+def list_chats(user_id):
+    """Список чатов пользователя одним запросом, по последней активности"""
+    rows = db.session.query(Chat, ChatMember.unread_count).join(
+        ChatMember, ChatMember.chat_id == Chat.id
+    ).filter(
+        ChatMember.user_id == user_id
+    ).order_by(
+        func.coalesce(Chat.last_message_at, Chat.created_at).desc(),
+        Chat.id.desc()
+    ).all()
+
+    chats_data = []
+    for chat, unread_count in rows:
+        last_message = None
+        if chat.last_message_id:
+            try:
+                preview = encryption_manager.decrypt_message(
+                    chat.last_message_preview_blob if chat.last_message_preview_blob is not None
+                    else chat.last_message_preview
+                )
+            except Exception:
+                preview = '[Зашифрованное сообщение]'
+            last_message = {
+                'content': preview,
+                'sender_id': chat.last_message_sender_id,
+                'created_at': chat.last_message_at.isoformat() if chat.last_message_at else None
+            }
+
+        chats_data.append({
+            'id': chat.id,
+            'name': chat.name,
+            'is_group': chat.is_group,
+            'avatar': chat.avatar,
+            'last_message': last_message,
+            'unread_count': unread_count or 0
+        })
+
+    return chats_data
@@ -0,0 +1,311 @@
+"""
+Метрики процесса в текстовом формате Prometheus (0.0.4), без внешних зависимостей.
+
+Собираются:
+- время HTTP-запросов по маршрутам (шаблон правила, а не URL) и статусам,
+  число и время SQL-запросов на HTTP-запрос (из профиля sql_profiler);
+- время обработчиков событий Socket.IO;
+- операции шифрования/расшифровки сообщений (число и время);
+- подключенные сокеты, размеры комнат, рассылки и их охват;
+- задержка хаба eventlet (насколько позже срока просыпается фоновая задача).
+
+Наблюдение - это блокировка и бинарный поиск по границам корзин, поэтому
+сбор можно не выключать в продакшене. Каждый процесс отдает свои метрики.
+"""
+
+import bisect
+import math
+import threading
+import time
+from flask import g, request
+from sql_profiler import sql_profiler
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+# Период проверки задержки хаба eventlet
+HUB_LAG_INTERVAL = 0.5
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [
+            f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}' for labels, value in values
+        ]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики корзин (+Inf последней), сумма]
+        self._values = {}
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def render(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        lines = self.header()
+        names = self.labelnames + ('le',)
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(names, labels + (_number(bound),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+class Gauge(Metric):
+    """Значение, вычисляемое при чтении метрик: число или {labels: число}.
+
+    kind='counter' - для накопленных значений, которые считает сам компонент.
+    """
+
+    def __init__(self, name, documentation, callback, labelnames=(), kind='gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.kind = kind
+
+    def render(self):
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return self.header() + [
+            f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}'
+            for labels, value in values.items() if value is not None
+        ]
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback, labelnames=(), kind='gauge'):
+        return self.register(Gauge(name, documentation, callback, labelnames, kind))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+def _room_kind(room):
+    """Комнаты приложения (chat_<id>, user_<id>); личные комнаты sid не считаются"""
+    if isinstance(room, str):
+        prefix = room.split('_', 1)[0]
+        if prefix in ('chat', 'user'):
+            return prefix
+    return None
+
+class Metrics:
+    """Реестр метрик приложения и подключение к Flask, SQLAlchemy и Socket.IO"""
+
+    def __init__(self):
+        self.registry = Registry()
+        self.socketio = None
+        registry = self.registry
+        self.http_duration = registry.histogram(
+            'http_request_duration_seconds', 'Время обработки HTTP-запроса', ('method', 'route', 'status'))
+        self.http_queries = registry.histogram(
+            'http_request_db_queries', 'SQL-запросов на HTTP-запрос', ('route',), COUNT_BUCKETS)
+        self.http_db_time = registry.histogram(
+            'http_request_db_seconds', 'Время SQL-запросов на HTTP-запрос', ('route',), DB_BUCKETS)
+        self.db_query = registry.histogram(
+            'db_query_duration_seconds', 'Время одного SQL-запроса', ('engine',), DB_BUCKETS)
+        self.socket_event = registry.histogram(
+            'socketio_event_duration_seconds', 'Время обработчика события Socket.IO', ('event',))
+        self.socket_errors = registry.counter(
+            'socketio_event_errors_total', 'Необработанные ошибки в обработчиках событий', ('event',))
+        self.emits = registry.counter(
+            'socketio_emits_total', 'Рассылки событий сервером', ('event',))
+        self.emit_recipients = registry.counter(
+            'socketio_emit_recipients_total', 'Получатели рассылок среди сокетов этого процесса', ('event',))
+        self.crypto = registry.histogram(
+            'encryption_operation_seconds', 'Шифрование и расшифровка сообщений', ('operation',), DB_BUCKETS)
+        self.hub_lag = registry.histogram(
+            'eventlet_hub_lag_seconds', 'Опоздание пробуждения фоновой задачи хаба eventlet',
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+        self.last_hub_lag = 0.0
+
+    # ---------- Flask и SQLAlchemy ----------
+
+    def init_app(self, app, db, engines=()):
+        """Запросы к базе считает sql_profiler; engines - для занятости пулов"""
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        sql_profiler.observe(lambda engine, seconds: self.db_query.observe(seconds, (engine,)))
+        with app.app_context():
+            main_engines = list(db.engines.values())
+        self.registry.gauge(
+            'db_pool_checked_out', 'Соединений пула, занятых сейчас',
+            lambda: {('main',): sum(engine.pool.checkedout() for engine in main_engines)} | {
+                ('reader',): sum(engine.pool.checkedout() for engine in engines)
+            }, ('engine',))
+
+    def _before_request(self):
+        g.metrics_started = time.perf_counter()
+
+    def _after_request(self, response):
+        started = g.get('metrics_started')
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            self.http_duration.observe(time.perf_counter() - started,
+                                       (request.method, route, str(response.status_code)))
+            profile = g.get('sql_profile')
+            if profile is not None:
+                self.http_queries.observe(profile.count, (route,))
+                self.http_db_time.observe(profile.seconds, (route,))
+        return response
+
+    def track_stats(self, prefix, stats, counters=()):
+        """Метрики из словаря stats() компонента: <prefix>_<ключ>; ключи counters - счетчики"""
+        for key in (stats() or {}):
+            counter = key in counters
+            suffix = '_total' if counter and not key.endswith('_total') else ''
+            self.registry.gauge(
+                f'{prefix}_{key}{suffix}', f'{prefix}: {key}',
+                lambda key=key: (stats() or {}).get(key),
+                kind='counter' if counter else 'gauge'
+            )
+
+    # ---------- Socket.IO ----------
+
+    def instrument_socketio(self, socketio):
+        """Замер обработчиков событий и рассылок; вызывать после регистрации обработчиков"""
+        self.socketio = socketio
+        server = socketio.server
+        for handlers in server.handlers.values():
+            for name, handler in list(handlers.items()):
+                handlers[name] = self._timed_handler(name, handler)
+        server.emit = self._counted_emit(server.emit)
+
+        self.registry.gauge('socketio_connected_sockets', 'Подключенные сокеты этого процесса',
+                            lambda: len(server.eio.sockets))
+        self.registry.gauge('socketio_rooms', 'Комнаты приложения по видам', self._room_counts, ('kind',))
+        self.registry.gauge('socketio_room_members_max', 'Размер самой большой комнаты',
+                            self._room_max, ('kind',))
+        self.registry.gauge('eventlet_hub_lag_last_seconds', 'Последнее измеренное опоздание хаба',
+                            lambda: self.last_hub_lag)
+        socketio.start_background_task(self._watch_hub)
+
+    def _timed_handler(self, name, handler):
+        labels = (name,)
+
+        def timed(*args):
+            started = time.perf_counter()
+            try:
+                return handler(*args)
+            except Exception:
+                self.socket_errors.inc(labels=labels)
+                raise
+            finally:
+                self.socket_event.observe(time.perf_counter() - started, labels)
+        return timed
+
+    def _counted_emit(self, emit):
+        def counted(event_name, data=None, to=None, room=None, skip_sid=None, namespace=None, **kwargs):
+            labels = (event_name,)
+            self.emits.inc(labels=labels)
+            self.emit_recipients.inc(self._audience(to if to is not None else room, namespace), labels)
+            return emit(event_name, data, to=to, room=room, skip_sid=skip_sid, namespace=namespace, **kwargs)
+        return counted
+
+    def _audience(self, target, namespace):
+        rooms = self.socketio.server.manager.rooms.get(namespace or '/', {})
+        if target is None:
+            return len(rooms.get(None, ()))
+        targets = target if isinstance(target, (list, tuple, set)) else [target]
+        return sum(len(rooms.get(room, ())) for room in targets)
+
+    def _app_rooms(self):
+        rooms = self.socketio.server.manager.rooms.get('/', {})
+        for room, members in list(rooms.items()):
+            kind = _room_kind(room)
+            if kind:
+                yield kind, len(members)
+
+    def _room_counts(self):
+        counts = {('chat',): 0, ('user',): 0}
+        for kind, _ in self._app_rooms():
+            counts[(kind,)] += 1
+        return counts
+
+    def _room_max(self):
+        sizes = {('chat',): 0, ('user',): 0}
+        for kind, size in self._app_rooms():
+            sizes[(kind,)] = max(sizes[(kind,)], size)
+        return sizes
+
+    def _watch_hub(self):
+        while True:
+            started = time.monotonic()
+            self.socketio.sleep(HUB_LAG_INTERVAL)
+            lag = max(time.monotonic() - started - HUB_LAG_INTERVAL, 0.0)
+            self.last_hub_lag = lag
+            self.hub_lag.observe(lag)
+
+    def render(self):
+        return self.registry.render()
+
+metrics = Metrics()
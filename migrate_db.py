@@ -1,35 +1,36 @@
 #!/usr/bin/env python3
 """
 Database Migration Script for Little Kitten Chat
-Fixes relationship conflicts and recreates tables
+Applies pending versioned schema migrations without dropping data
 """
 
-import os
 import sys
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-from app import app, db
-from models import User, Chat, Message, Contact, ChatMember, File
+from app import app
+from migrations import run_migrations, current_version, LATEST_VERSION, MIGRATIONS
 
-def migrate_database():
-    """Migrate database to fix relationship conflicts"""
+def migrate_database(status_only=False):
+    """Apply pending migrations (or only report the schema version)"""
     with app.app_context():
         try:
-            print("Starting database migration...")
+            version = current_version()
+            print(f"Current schema version: {version} (latest: {LATEST_VERSION})")
             
-            # Drop all tables to avoid conflicts
-            print("Dropping existing tables...")
-            db.drop_all()
+            if status_only:
+                for step_version, description, _ in MIGRATIONS:
+                    mark = 'x' if step_version <= version else ' '
+                    print(f"  [{mark}] {step_version}: {description}")
+                return True
             
-            # Create all tables with new schema
-            print("Creating new tables...")
-            db.create_all()
-            
-            print("Database migration completed successfully!")
-            print("All tables have been recreated with fixed relationships.")
+            applied = run_migrations()
+            if applied:
+                print(f"Applied migrations: {', '.join(str(v) for v in applied)}")
+            else:
+                print("Schema is up to date.")
             
         except Exception as e:
             print(f"Migration error: {str(e)}")
@@ -38,9 +39,9 @@ def migrate_database():
     return True
 
 if __name__ == "__main__":
-    if migrate_database():
+    if migrate_database(status_only='--status' in sys.argv):
         print("\n✅ Migration successful!")
         print("You can now start the application normally.")
     else:
         print("\n❌ Migration failed!")
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -0,0 +1,296 @@
+"""
+Версионированные миграции схемы базы данных.
+
+Каждый шаг применяется один раз и записывается в таблицу schema_version.
+Новая база создается целиком через create_all и сразу помечается последней
+версией; существующая база без schema_version считается исходной схемой
+(версия 1) и догоняется по шагам. Холодный старт при актуальной схеме -
+один запрос версии.
+
+Миграции применяет один процесс за раз (pg_advisory_lock в PostgreSQL,
+файл блокировки рядом с базой SQLite); остальные воркеры ждут и после
+блокировки заново читают версию.
+"""
+
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import inspect, text, func
+from models import db, Chat, ChatMember, Message, SchemaVersion
+from encryption import encryption_manager
+
+logger = logging.getLogger(__name__)
+
+# Размер партии для фонового заполнения данных
+BACKFILL_BATCH_SIZE = 500
+
+# Ключ pg_advisory_lock для миграций
+MIGRATION_LOCK_KEY = 0x4C4B4300
+
+# ---------- Онлайн-безопасные операции ----------
+
+def _is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+def table_exists(table):
+    return inspect(db.engine).has_table(table)
+
+def column_exists(table, column):
+    return column in {col['name'] for col in inspect(db.engine).get_columns(table)}
+
+def add_column(column, server_default=None):
+    """Добавление колонки модели, если ее еще нет (без перестроения таблицы)"""
+    table = column.table.name
+    if column_exists(table, column.name):
+        return
+    ddl = f'ALTER TABLE "{table}" ADD COLUMN "{column.name}" {column.type.compile(db.engine.dialect)}'
+    if server_default is not None:
+        ddl += f' DEFAULT {server_default}'
+        if not column.nullable:
+            ddl += ' NOT NULL'
+    db.session.execute(text(ddl))
+    db.session.commit()
+
+def create_table(model):
+    """Создание таблицы модели вместе с ее индексами"""
+    model.__table__.create(db.engine, checkfirst=True)
+
+def create_index(name, table, columns, unique=False):
+    """Построение индекса без долгой блокировки записи.
+
+    В PostgreSQL используется CREATE INDEX CONCURRENTLY вне транзакции,
+    в SQLite индекс строится одним проходом и сразу фиксируется.
+    """
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    unique_sql = 'UNIQUE ' if unique else ''
+    if _is_postgres():
+        db.session.commit()
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text(
+                f'CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS "{name}" ON "{table}" ({column_list})'
+            ))
+    else:
+        db.session.execute(text(f'CREATE {unique_sql}INDEX IF NOT EXISTS "{name}" ON "{table}" ({column_list})'))
+        db.session.commit()
+
+def backfill(columns, process, batch_size=BACKFILL_BATCH_SIZE):
+    """Заполнение данных партиями по первичному ключу, с commit после каждой.
+
+    Шаги выбирают только явно перечисленные колонки: модель может содержать
+    колонки более поздних версий, которых в базе еще нет.
+    """
+    key = columns[0]
+    last_id = 0
+    processed = 0
+    while True:
+        batch = db.session.query(*columns).filter(key > last_id).order_by(key.asc()).limit(batch_size).all()
+        if not batch:
+            break
+        for row in batch:
+            process(row)
+        db.session.commit()
+        last_id = batch[-1][0]
+        processed += len(batch)
+    return processed
+
+def delete_duplicates(model, columns):
+    """Удаление дубликатов перед уникальным индексом (остается самая ранняя запись)"""
+    keep = db.session.query(func.min(model.id)).group_by(*[getattr(model, column) for column in columns])
+    removed = model.query.filter(~model.id.in_(keep)).delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
+# ---------- Шаги миграций ----------
+
+def _initial_schema():
+    """Исходная схема (существующие базы уже ее содержат)"""
+    db.create_all()
+
+def _chat_summaries():
+    add_column(Chat.__table__.c.last_message_id)
+    add_column(Chat.__table__.c.last_message_preview)
+    add_column(Chat.__table__.c.last_message_sender_id)
+    add_column(Chat.__table__.c.last_message_at)
+    add_column(ChatMember.__table__.c.unread_count, server_default=0)
+
+    from messaging import message_text, PREVIEW_LENGTH
+
+    def summarize(chat):
+        last_message = db.session.query(
+            Message.id, Message.sender_id, Message.content, Message.is_encrypted, Message.created_at
+        ).filter(Message.chat_id == chat.id).order_by(
+            Message.created_at.desc(), Message.id.desc()
+        ).first()
+        if last_message:
+            Chat.query.filter_by(id=chat.id).update({
+                'last_message_id': last_message.id,
+                'last_message_preview': encryption_manager.encrypt_legacy(message_text(last_message)[:PREVIEW_LENGTH]),
+                'last_message_sender_id': last_message.sender_id,
+                'last_message_at': last_message.created_at
+            }, synchronize_session=False)
+
+    backfill([Chat.id], summarize)
+
+def _read_cursors():
+    add_column(ChatMember.__table__.c.last_read_message_id, server_default=0)
+
+    def move_cursor(member):
+        # Старый флаг is_read переносится в курсор: последнее прочитанное или свое сообщение
+        cursor = db.session.query(func.max(Message.id)).filter(
+            Message.chat_id == member.chat_id,
+            (Message.sender_id == member.user_id) | (Message.is_read == True)
+        ).scalar() or 0
+        unread_count = db.session.query(func.count(Message.id)).filter(
+            Message.chat_id == member.chat_id,
+            Message.id > cursor,
+            Message.sender_id != member.user_id
+        ).scalar()
+        ChatMember.query.filter_by(id=member.id).update({
+            'last_read_message_id': cursor,
+            'unread_count': unread_count
+        }, synchronize_session=False)
+
+    backfill([ChatMember.id, ChatMember.chat_id, ChatMember.user_id], move_cursor)
+
+def _search_index():
+    from models import SearchToken
+    import search_index
+
+    create_table(SearchToken)
+    search_index.rebuild_index(batch_size=BACKFILL_BATCH_SIZE)
+
+def _hot_path_indexes():
+    from models import Contact
+
+    delete_duplicates(ChatMember, ['chat_id', 'user_id'])
+    delete_duplicates(Contact, ['user_id', 'contact_id'])
+    create_index('uq_chat_member_chat_user', 'chat_member', ['chat_id', 'user_id'], unique=True)
+    create_index('ix_chat_member_user', 'chat_member', ['user_id', 'chat_id'])
+    create_index('uq_contact_user_contact', 'contact', ['user_id', 'contact_id'], unique=True)
+    create_index('ix_message_chat_created', 'message', ['chat_id', 'created_at', 'id'])
+    create_index('ix_notification_user_created', 'notification', ['user_id', 'created_at'])
+
+def _upload_sessions():
+    from models import UploadSession
+
+    create_table(UploadSession)
+
+def _content_addressed_files():
+    from models import Blob, File
+
+    create_table(Blob)
+    add_column(File.__table__.c.blob_sha256)
+    create_index('ix_file_blob_sha256', 'file', ['blob_sha256'])
+
+def _presence_indexes():
+    create_index('ix_contact_contact', 'contact', ['contact_id', 'user_id'])
+
+def _binary_message_cipher():
+    # Старые Fernet-токены остаются читаемыми и перешифровываются в фоне (reencryption.py)
+    add_column(Message.__table__.c.content_blob)
+    add_column(Chat.__table__.c.last_message_preview_blob)
+
+# Порядок шагов менять нельзя: номер версии записывается в базу
+MIGRATIONS = [
+    (1, 'Исходная схема', _initial_schema),
+    (2, 'Сводки чатов и счетчики непрочитанных', _chat_summaries),
+    (3, 'Курсоры прочтения участников', _read_cursors),
+    (4, 'Слепой поисковый индекс', _search_index),
+    (5, 'Составные индексы горячих путей', _hot_path_indexes),
+    (6, 'Сессии возобновляемой загрузки', _upload_sessions),
+    (7, 'Хранилище файлов по SHA-256', _content_addressed_files),
+    (8, 'Индекс обратного поиска контактов', _presence_indexes),
+    (9, 'Бинарный формат шифрования сообщений', _binary_message_cipher),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# ---------- Запуск ----------
+
+def current_version():
+    """Текущая версия схемы (0 - пустая база, 1 - база без учета версий)"""
+    if table_exists(SchemaVersion.__tablename__):
+        return db.session.query(func.max(SchemaVersion.version)).scalar() or 0
+    if table_exists('user'):
+        return 1
+    return 0
+
+def _stamp(version, description):
+    db.session.add(SchemaVersion(version=version, description=description, applied_at=datetime.utcnow()))
+    db.session.commit()
+
+def _lock_file(f):
+    """Эксклюзивная блокировка открытого файла (ожидание, пока ее держит другой процесс)"""
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK сдается через ~10 секунд ожидания
+                continue
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+@contextmanager
+def migration_lock():
+    """Блокировка на время миграций, общая для всех процессов с этой базой"""
+    if _is_postgres():
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            try:
+                yield
+            finally:
+                conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        return
+
+    database = db.engine.url.database if db.engine.dialect.name == 'sqlite' else None
+    if not database or database == ':memory:':
+        # База в памяти принадлежит одному процессу
+        yield
+        return
+    with open(os.path.abspath(database) + '.migrate.lock', 'a+') as f:
+        # Блокировка снимается при закрытии файла
+        _lock_file(f)
+        yield
+
+def run_migrations():
+    """Применение недостающих шагов; возвращает список примененных версий"""
+    if current_version() == LATEST_VERSION:
+        return []
+
+    with migration_lock():
+        # Завершаем транзакцию чтения: версию могли поднять, пока мы ждали
+        db.session.rollback()
+        return _apply_migrations()
+
+def _apply_migrations():
+    version = current_version()
+    if version == LATEST_VERSION:
+        return []
+
+    if version == 0:
+        # Новая база: текущая схема целиком
+        db.create_all()
+        for step_version, description, _ in MIGRATIONS:
+            _stamp(step_version, description)
+        logger.info(f"Database schema created at version {LATEST_VERSION}")
+        return [step_version for step_version, _, _ in MIGRATIONS]
+
+    if not table_exists(SchemaVersion.__tablename__):
+        create_table(SchemaVersion)
+        _stamp(1, MIGRATIONS[0][1])
+
+    applied = []
+    for step_version, description, step in MIGRATIONS:
+        if step_version <= version:
+            continue
+        logger.info(f"Applying migration {step_version}: {description}")
+        step()
+        _stamp(step_version, description)
+        applied.append(step_version)
+
+    return applied
@@ -3,8 +3,9 @@ from flask_login import UserMixin
 from datetime import datetime
 import base64
 import os
+from sqlite_storage import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -34,6 +35,12 @@ class Contact(db.Model):
     
     # Отношения
     contact_user = db.relationship('User', foreign_keys=[contact_id], backref='contacted_by_users')
+    
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'contact_id', name='uq_contact_user_contact'),
+        # Обратный поиск: у кого пользователь в контактах (рассылка присутствия)
+        db.Index('ix_contact_contact', 'contact_id', 'user_id'),
+    )
 
 class Chat(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -43,6 +50,13 @@ class Chat(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
     
+    # Сводка по последнему сообщению (обновляется при каждой записи)
+    last_message_id = db.Column(db.Integer)
+    last_message_preview = db.Column(db.Text)  # зашифрованное превью в старом формате
+    last_message_preview_blob = db.Column(db.LargeBinary)  # зашифрованное превью
+    last_message_sender_id = db.Column(db.Integer)
+    last_message_at = db.Column(db.DateTime)
+    
     # Отношения
     messages = db.relationship('Message', backref='message_chat', lazy='dynamic')
     members = db.relationship('ChatMember', backref='member_chat', lazy='dynamic')
@@ -53,13 +67,21 @@ class ChatMember(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     role = db.Column(db.String(20), default='member')
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
+    unread_count = db.Column(db.Integer, default=0, nullable=False)
+    last_read_message_id = db.Column(db.Integer, default=0, nullable=False)  # курсор прочтения
+    
+    __table_args__ = (
+        db.UniqueConstraint('chat_id', 'user_id', name='uq_chat_member_chat_user'),
+        db.Index('ix_chat_member_user', 'user_id', 'chat_id'),
+    )
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=False)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    content = db.Column(db.Text, nullable=False)
+    content = db.Column(db.Text, nullable=False)  # старый Fernet-токен ('' в новых сообщениях)
+    content_blob = db.Column(db.LargeBinary)  # бинарный формат шифрования (encryption.py)
     content_type = db.Column(db.String(20), default='text')  # text, image, file, audio, video, voice
     file_path = db.Column(db.String(200))
     file_name = db.Column(db.String(200))
@@ -76,6 +98,31 @@ class Message(db.Model):
     
     # Отношения
     reply_to = db.relationship('Message', remote_side=[id], backref='replies')
+    
+    __table_args__ = (
+        db.Index('ix_message_chat_created', 'chat_id', 'created_at', 'id'),
+    )
+
+class SearchToken(db.Model):
+    """Слепой индекс для поиска: HMAC от нормализованных слов и префиксов"""
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(32), nullable=False)
+    chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=False)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_search_token_lookup', 'token', 'chat_id', 'message_id'),
+        db.Index('ix_search_token_message', 'message_id'),
+    )
+
+class Blob(db.Model):
+    """Содержимое файла, адресуемое по SHA-256, с подсчетом ссылок из File"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    file_path = db.Column(db.String(200), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, default=1, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -85,6 +132,20 @@ class File(db.Model):
     mime_type = db.Column(db.String(100))
     uploaded_by = db.Column(db.Integer, db.ForeignKey('user.id'))
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('blob.sha256'), index=True)
+    
+    blob = db.relationship('Blob')
+
+class UploadSession(db.Model):
+    """Сессия возобновляемой загрузки файла по частям"""
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(200), nullable=False)
+    mime_type = db.Column(db.String(100))
+    total_size = db.Column(db.Integer, nullable=False)
+    received = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
 
 class UserSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -142,4 +203,14 @@ class Notification(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Отношения
-    user = db.relationship('User', backref='notifications')
\ No newline at end of file
+    user = db.relationship('User', backref='notifications')
+    
+    __table_args__ = (
+        db.Index('ix_notification_user_created', 'user_id', 'created_at'),
+    )
+
+class SchemaVersion(db.Model):
+    """Примененные версии схемы базы данных"""
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(200))
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,131 @@
+"""
+Присутствие пользователей: онлайн/офлайн без шторма записей и рассылок.
+
+- пользователь в сети, пока у него есть хотя бы одно подключение (реестр
+  подключений общий для всех процессов);
+- после отключения последнего устройства офлайн наступает только через
+  PRESENCE_GRACE_SECONDS, поэтому переподключения мобильных клиентов
+  не видны собеседникам;
+- is_online/last_seen пишутся в базу пачкой раз в PRESENCE_FLUSH_SECONDS;
+- события user_online/user_offline получают только контакты и участники
+  общих чатов (в их комнаты user_<id>), а не все подключенные сокеты.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import update, select, union
+from models import db, User, Contact, ChatMember
+from cluster import user_room
+
+logger = logging.getLogger(__name__)
+
+# Период проверки истекших отсрочек
+PRESENCE_TICK_SECONDS = 1
+
+class Presence:
+    """Состояние присутствия процесса: отсрочки офлайна и очередь записей"""
+
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.connections = None
+        self.grace_seconds = 15
+        self.flush_seconds = 5
+        self._lock = threading.Lock()
+        # user_id -> момент (monotonic), когда пользователь уйдет в офлайн
+        self._offline_at = {}
+        # user_id -> (is_online, last_seen) для следующей пачки записей
+        self._writes = {}
+
+    def init_app(self, app, socketio, connections):
+        self.app = app
+        self.socketio = socketio
+        self.connections = connections
+        self.grace_seconds = app.config['PRESENCE_GRACE_SECONDS']
+        self.flush_seconds = app.config['PRESENCE_FLUSH_SECONDS']
+        socketio.start_background_task(self._run)
+
+    def connect(self, user_id, sid):
+        """Новое подключение; user_online рассылается только при реальном входе в сеть"""
+        count = self.connections.add(user_id, sid)
+        with self._lock:
+            # Переподключение в пределах отсрочки: для собеседников ничего не менялось
+            reconnected = self._offline_at.pop(user_id, None) is not None
+        self._queue_write(user_id, True)
+        if count == 1 and not reconnected:
+            self.announce(user_id, 'user_online')
+
+    def disconnect(self, user_id, sid):
+        """Отключение; офлайн наступит после отсрочки, если устройств не осталось"""
+        if self.connections.remove(user_id, sid) == 0:
+            with self._lock:
+                self._offline_at[user_id] = time.monotonic() + self.grace_seconds
+
+    def expire(self, now=None):
+        """Перевод в офлайн пользователей с истекшей отсрочкой; возвращает их список"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            due = [user_id for user_id, deadline in self._offline_at.items() if deadline <= now]
+            for user_id in due:
+                del self._offline_at[user_id]
+
+        offline = []
+        for user_id in due:
+            # Пользователь мог переподключиться к другому процессу
+            if self.connections.is_connected(user_id):
+                continue
+            self._queue_write(user_id, False)
+            self.announce(user_id, 'user_offline')
+            offline.append(user_id)
+        return offline
+
+    def flush(self):
+        """Запись накопленных изменений одним пакетным UPDATE (с commit)"""
+        with self._lock:
+            writes, self._writes = self._writes, {}
+        if not writes:
+            return 0
+        db.session.execute(update(User), [
+            {'id': user_id, 'is_online': is_online, 'last_seen': last_seen}
+            for user_id, (is_online, last_seen) in writes.items()
+        ])
+        db.session.commit()
+        return len(writes)
+
+    def audience(self, user_id):
+        """Кому интересен статус пользователя: его контакты и участники общих чатов"""
+        own_chats = select(ChatMember.chat_id).where(ChatMember.user_id == user_id)
+        query = union(
+            select(Contact.user_id).where(Contact.contact_id == user_id),
+            select(ChatMember.user_id).where(ChatMember.chat_id.in_(own_chats))
+        )
+        return {row[0] for row in db.session.execute(query)} - {user_id}
+
+    def announce(self, user_id, event):
+        rooms = [user_room(peer_id) for peer_id in self.audience(user_id)]
+        if rooms:
+            self.socketio.emit(event, {'user_id': user_id}, to=rooms)
+        return len(rooms)
+
+    def _queue_write(self, user_id, is_online):
+        with self._lock:
+            self._writes[user_id] = (is_online, datetime.utcnow())
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            self.socketio.sleep(PRESENCE_TICK_SECONDS)
+            try:
+                with self.app.app_context():
+                    self.expire()
+                    if time.monotonic() - last_flush >= self.flush_seconds:
+                        last_flush = time.monotonic()
+                        self.flush()
+            except Exception as e:
+                logger.error(f"Presence update error: {str(e)}")
+                with self.app.app_context():
+                    db.session.rollback()
+
+presence = Presence()
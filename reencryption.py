@@ -0,0 +1,137 @@
+"""
+Фоновое перешифрование старых сообщений из Fernet-токенов в бинарный формат.
+
+Сообщения и превью чатов обходятся партиями по первичному ключу, каждая
+партия - одна транзакция и пауза REENCRYPT_PAUSE_SECONDS, чтобы не мешать
+отправке. Строка обновляется только пока content_blob пуст, поэтому правка
+во время обхода не затирается, а несколько процессов не портят данные,
+делая одну работу. Ошибка партии не останавливает обход: она повторяется
+с растущей паузой. Задача завершается, когда старых строк не осталось.
+"""
+
+import logging
+import threading
+from sqlalchemy import bindparam
+from models import db, Chat, Message
+from encryption import encryption_manager
+
+logger = logging.getLogger(__name__)
+
+# Предельная пауза перед повтором после ошибки партии, секунды
+MAX_RETRY_DELAY = 300
+
+class LegacyReencryption:
+    """Курсоры обхода и счетчики перешифрования процесса"""
+
+    def __init__(self):
+        self.app = None
+        self.socketio = None
+        self.batch_size = 200
+        self.pause = 1.0
+        self._lock = threading.Lock()
+        self.last_message_id = 0
+        self.last_chat_id = 0
+        self.messages = 0
+        self.previews = 0
+        self.failures = 0
+        self.done = False
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.socketio = socketio
+        self.batch_size = app.config['REENCRYPT_BATCH_SIZE']
+        self.pause = app.config['REENCRYPT_PAUSE_SECONDS']
+        if app.config['REENCRYPT_LEGACY']:
+            socketio.start_background_task(self._run)
+
+    def _convert(self, rows, statement, key):
+        """Перешифрование строк (id, токен) одним executemany; возвращает число строк"""
+        values = []
+        for row_id, token in rows:
+            try:
+                values.append({key: row_id, 'blob': encryption_manager.reencrypt(token)})
+            except Exception:
+                # Токен другого ключа или поврежден - остается как есть
+                with self._lock:
+                    self.failures += 1
+        if values:
+            db.session.execute(statement, values)
+        return len(values)
+
+    def reencrypt_messages(self):
+        """Следующая партия сообщений; False - старых сообщений больше нет"""
+        rows = db.session.query(Message.id, Message.content).filter(
+            Message.id > self.last_message_id,
+            Message.content_blob.is_(None),
+            Message.is_encrypted == True
+        ).order_by(Message.id).limit(self.batch_size).all()
+        if not rows:
+            return False
+        table = Message.__table__
+        statement = table.update().where(
+            table.c.id == bindparam('message_id'),
+            table.c.content_blob.is_(None)
+        ).values(content='', content_blob=bindparam('blob'), updated_at=table.c.updated_at)
+        converted = self._convert(rows, statement, 'message_id')
+        db.session.commit()
+        with self._lock:
+            self.last_message_id = rows[-1].id
+            self.messages += converted
+        return True
+
+    def reencrypt_previews(self):
+        """Следующая партия превью чатов; False - старых превью больше нет"""
+        rows = db.session.query(Chat.id, Chat.last_message_preview).filter(
+            Chat.id > self.last_chat_id,
+            Chat.last_message_preview.isnot(None),
+            Chat.last_message_preview_blob.is_(None)
+        ).order_by(Chat.id).limit(self.batch_size).all()
+        if not rows:
+            return False
+        table = Chat.__table__
+        statement = table.update().where(
+            table.c.id == bindparam('chat_id'),
+            table.c.last_message_preview_blob.is_(None)
+        ).values(last_message_preview=None, last_message_preview_blob=bindparam('blob'))
+        converted = self._convert(rows, statement, 'chat_id')
+        db.session.commit()
+        with self._lock:
+            self.last_chat_id = rows[-1].id
+            self.previews += converted
+        return True
+
+    def run_batch(self):
+        """Одна партия сообщений или превью; False - перешифровывать больше нечего"""
+        return self.reencrypt_messages() or self.reencrypt_previews()
+
+    def _run(self):
+        delay = self.pause
+        while True:
+            self.socketio.sleep(delay)
+            try:
+                with self.app.app_context():
+                    if not self.run_batch():
+                        break
+                delay = self.pause
+            except Exception as e:
+                # Например, база занята или миграция 9 еще не применена -
+                # повторяем с растущей паузой, курсоры остаются на месте
+                with self.app.app_context():
+                    db.session.rollback()
+                delay = min(max(delay, 1) * 2, MAX_RETRY_DELAY)
+                logger.error(f"Legacy re-encryption error, retry in {delay:.0f}s: {str(e)}")
+        with self._lock:
+            self.done = True
+        if self.messages or self.previews:
+            logger.info(f"Legacy re-encryption finished: {self.messages} messages, {self.previews} previews")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'messages': self.messages,
+                'previews': self.previews,
+                'failures': self.failures,
+                'done': int(self.done),
+            }
+
+legacy_reencryption = LegacyReencryption()
@@ -105,11 +105,12 @@ def run_application():
         logger.info("Для остановки нажмите Ctrl+C")
         
         # Импортируем и запускаем приложение
-        from app import app, socketio, db
+        from app import app, socketio
+        from migrations import run_migrations
         
-        # Создаем таблицы базы данных
+        # Применяем недостающие миграции схемы
         with app.app_context():
-            db.create_all()
+            run_migrations()
             logger.info("База данных инициализирована")
         
         # Запускаем сервер
@@ -0,0 +1,136 @@
+import re
+import unicodedata
+from sqlalchemy import func
+from models import db, Message, SearchToken
+from encryption import encryption_manager
+from messaging import message_text
+from membership import member_chat_ids
+
+# Индексируются префиксы слов длиной от MIN_PREFIX до MAX_PREFIX символов
+MIN_PREFIX = 2
+MAX_PREFIX = 20
+
+# Размер страницы результатов поиска
+SEARCH_PAGE_SIZE = 50
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+def normalize_words(text):
+    """Нормализованные слова текста: NFKC, нижний регистр, ё -> е"""
+    text = unicodedata.normalize('NFKC', text or '').lower().replace('ё', 'е')
+    return [word for word in _word_re.findall(text) if len(word) >= MIN_PREFIX]
+
+def message_tokens(text):
+    """Множество токенов слепого индекса для текста сообщения"""
+    terms = set()
+    for word in normalize_words(text):
+        for length in range(MIN_PREFIX, min(len(word), MAX_PREFIX) + 1):
+            terms.add(word[:length])
+    return {encryption_manager.blind_index(term) for term in terms}
+
+def index_message(message, text):
+    """Добавление сообщения в поисковый индекс"""
+    tokens = message_tokens(text)
+    if tokens:
+        db.session.execute(SearchToken.__table__.insert(), [
+            {'token': token, 'chat_id': message.chat_id, 'message_id': message.id}
+            for token in tokens
+        ])
+
+def remove_message(message_id):
+    """Удаление сообщения из поискового индекса"""
+    SearchToken.query.filter_by(message_id=message_id).delete(synchronize_session=False)
+
+def reindex_message(message, text):
+    """Переиндексация сообщения после редактирования"""
+    remove_message(message.id)
+    index_message(message, text)
+
+def search(user_id, query, chat_id=None, before_id=None, limit=SEARCH_PAGE_SIZE):
+    """Поиск по слепому индексу.
+
+    Каждое слово запроса должно быть префиксом какого-либо слова сообщения.
+    Без chat_id поиск идет по всем чатам, где состоит пользователь.
+    Результат: (сообщения по убыванию id, next_cursor для следующей страницы).
+    """
+    words = normalize_words(query)
+    if not words:
+        return [], None
+
+    terms = {word[:MAX_PREFIX] for word in words}
+    truncated = any(len(word) > MAX_PREFIX for word in words)
+    tokens = [encryption_manager.blind_index(term) for term in terms]
+
+    if chat_id is not None:
+        chat_scope = SearchToken.chat_id == chat_id
+    else:
+        chat_ids = member_chat_ids(user_id)
+        if not chat_ids:
+            return [], None
+        chat_scope = SearchToken.chat_id.in_(chat_ids)
+
+    matches = db.session.query(SearchToken.message_id).filter(
+        SearchToken.token.in_(tokens),
+        chat_scope
+    )
+    if before_id:
+        matches = matches.filter(SearchToken.message_id < before_id)
+
+    message_ids = [row.message_id for row in matches.group_by(
+        SearchToken.message_id
+    ).having(
+        func.count(func.distinct(SearchToken.token)) == len(tokens)
+    ).order_by(
+        SearchToken.message_id.desc()
+    ).limit(limit + 1)]
+
+    next_cursor = message_ids[limit - 1] if len(message_ids) > limit else None
+    message_ids = message_ids[:limit]
+    if not message_ids:
+        return [], None
+
+    messages = Message.query.filter(
+        Message.id.in_(message_ids),
+        Message.is_deleted == False
+    ).order_by(Message.id.desc()).all()
+
+    if truncated:
+        # Длинные слова индексируются усеченными - проверяем полный префикс
+        messages = [
+            message for message in messages
+            if all(any(word.startswith(term) for word in normalize_words(message_text(message))) for term in words)
+        ]
+
+    return messages, next_cursor
+
+def rebuild_index(batch_size=500):
+    """Полное перестроение индекса партиями (для существующих сообщений).
+
+    Текст берется через message_text: новые сообщения хранятся в content_blob,
+    а на шаге миграции 4 этой колонки в базе еще нет.
+    """
+    from migrations import column_exists
+
+    SearchToken.query.delete(synchronize_session=False)
+    db.session.commit()
+
+    columns = [Message.id, Message.chat_id, Message.content, Message.is_encrypted]
+    if column_exists(Message.__tablename__, Message.content_blob.name):
+        columns.append(Message.content_blob)
+
+    last_id = 0
+    indexed = 0
+    while True:
+        batch = db.session.query(*columns).filter(
+            Message.id > last_id,
+            Message.is_deleted == False
+        ).order_by(Message.id.asc()).limit(batch_size).all()
+        if not batch:
+            break
+        for message in batch:
+            index_message(message, message_text(message))
+        db.session.commit()
+        last_id = batch[-1].id
+        indexed += len(batch)
+
+    return indexed
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Synthetic Data Generator for Little Kitten Chat
+Fills an empty database (DATABASE_URL) with users, contacts, private and
+group chats, messages with a skewed per-chat distribution, replies,
+reactions, read cursors and notifications. Messages go through the app's
+EncryptionManager and the search index; rows are written with bulk inserts
+
+Run the app on the seeded data with the same ENCRYPTION_KEY. Every seeded
+user is named seed_user_<n> and has the password SEED_PASSWORD
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+# Seeded rows must stay as written (--legacy-format), no background re-encryption
+os.environ.setdefault('REENCRYPT_LEGACY', 'False')
+
+from sqlalchemy import bindparam
+from werkzeug.security import generate_password_hash
+
+from app import app, db
+from models import User, Contact, Chat, ChatMember, Message, MessageReaction, Notification, SearchToken
+from encryption import encryption_manager
+from messaging import PREVIEW_LENGTH
+from migrations import run_migrations
+import search_index
+
+SEED_PASSWORD = 'secret1'
+# Хвост чата, в пределах которого участники могут не дочитать сообщения
+UNREAD_TAIL = 50
+# Доля участников, прочитавших чат целиком
+FULLY_READ_SHARE = 0.6
+REPLY_WINDOW = 20
+# Индексы, которые дешевле построить один раз после загрузки сообщений
+DEFERRED_INDEX_TABLES = (Message, SearchToken)
+
+WORDS = (
+    'привет как дела котик мурчит спит ест играет окно солнце дождь завтра сегодня вечером '
+    'встреча работа проект релиз база запрос индекс кэш сервер клиент сообщение фото видео '
+    'hello world cat kitten meow coffee lunch deploy review merge branch ticket fix bug '
+    'weekend music movie book travel photo link call later thanks sure okay'
+).split()
+EMOJIS = ('👍', '❤️', '😂', '😮', '😢', '🐱')
+
+class Seeder:
+    """Генерация данных пачками; id назначаются заранее, без обращений к базе"""
+
+    def __init__(self, conn, options, progress):
+        self.conn = conn
+        self.options = options
+        self.progress = progress
+        self.rng = random.Random(options.seed)
+        self.now = datetime.utcnow()
+        self.start = self.now - timedelta(days=options.days)
+        self.tokens = {}
+        self.counts = {}
+
+    def insert(self, model, rows):
+        for offset in range(0, len(rows), self.options.batch_size):
+            self.conn.execute(model.__table__.insert(), rows[offset:offset + self.options.batch_size])
+        self.counts[model.__tablename__] = self.counts.get(model.__tablename__, 0) + len(rows)
+
+    def encrypt(self, text):
+        """(Fernet-токен, бинарный шифротекст): заполнено одно из двух по --legacy-format"""
+        if self.options.legacy_format:
+            return encryption_manager.encrypt_legacy(text), None
+        return None, encryption_manager.encrypt_message(text)
+
+    def random_time(self):
+        return self.start + timedelta(seconds=self.rng.uniform(0, self.options.days * 86400))
+
+    def text(self):
+        return ' '.join(self.rng.choices(WORDS, k=self.rng.randint(3, 15)))
+
+    def message_tokens(self, text):
+        """Токены слепого индекса (как search_index.message_tokens) с кэшем по термам"""
+        tokens = set()
+        for word in search_index.normalize_words(text):
+            for length in range(search_index.MIN_PREFIX, min(len(word), search_index.MAX_PREFIX) + 1):
+                term = word[:length]
+                token = self.tokens.get(term)
+                if token is None:
+                    token = self.tokens[term] = encryption_manager.blind_index(term)
+                tokens.add(token)
+        return tokens
+
+    def users(self):
+        password_hash = generate_password_hash(SEED_PASSWORD)
+        rows = []
+        for user_id in range(1, self.options.users + 1):
+            created_at = self.start - timedelta(days=1)
+            rows.append({
+                'id': user_id,
+                'username': f'seed_user_{user_id}',
+                'email': f'seed_user_{user_id}@seed.local',
+                'password_hash': password_hash,
+                'first_name': f'Кот {user_id}',
+                'is_online': self.rng.random() < 0.05,
+                'last_seen': self.random_time(),
+                'created_at': created_at
+            })
+        self.insert(User, rows)
+        self.conn.commit()
+
+    def chats(self):
+        """Контакты, личные чаты по контактам и группы; возвращает участников чатов"""
+        users = self.options.users
+        contact_rows = []
+        pairs = []
+        for user_id in range(1, users + 1):
+            others = self.rng.sample(range(1, users + 1), min(self.options.contacts + 1, users))
+            for contact_id in [other for other in others if other != user_id][:self.options.contacts]:
+                contact_rows.append({'user_id': user_id, 'contact_id': contact_id, 'created_at': self.start})
+                pairs.append((user_id, contact_id))
+        self.insert(Contact, contact_rows)
+
+        chat_rows = []
+        members = {}
+        created_at = self.start - timedelta(hours=1)
+        seen_pairs = set()
+        for user_id, contact_id in self.rng.sample(pairs, len(pairs)):
+            if len(chat_rows) >= self.options.direct_chats:
+                break
+            key = (min(user_id, contact_id), max(user_id, contact_id))
+            if key in seen_pairs:
+                continue
+            seen_pairs.add(key)
+            chat_id = len(chat_rows) + 1
+            chat_rows.append({
+                'id': chat_id, 'name': f'Чат с Кот {contact_id}', 'is_group': False,
+                'created_by': user_id, 'created_at': created_at
+            })
+            members[chat_id] = [(user_id, 'member'), (contact_id, 'member')]
+
+        low, high = self.options.group_size
+        for number in range(self.options.group_chats):
+            chat_id = len(chat_rows) + 1
+            group = self.rng.sample(range(1, users + 1), min(self.rng.randint(low, high), users))
+            chat_rows.append({
+                'id': chat_id, 'name': f'Группа {number + 1}', 'is_group': True,
+                'created_by': group[0], 'created_at': created_at
+            })
+            members[chat_id] = [(group[0], 'owner')] + [(user_id, 'member') for user_id in group[1:]]
+        self.insert(Chat, chat_rows)
+        self.conn.commit()
+        return members
+
+    def messages(self, members):
+        """Сообщения с распределением Ципфа по чатам; возвращает состояние чатов"""
+        chat_ids = list(members)
+        weights = [1 / (rank ** self.options.skew) for rank in range(1, len(chat_ids) + 1)]
+        self.rng.shuffle(weights)
+        cum_weights = []
+        total = 0
+        for weight in weights:
+            total += weight
+            cum_weights.append(total)
+
+        # chat_id -> (последнее сообщение, хвост (id, sender_id))
+        last = {}
+        tails = {chat_id: deque(maxlen=UNREAD_TAIL) for chat_id in chat_ids}
+        member_ids = {chat_id: [user_id for user_id, _ in chat_members] for chat_id, chat_members in members.items()}
+        step = self.options.days * 86400 / max(self.options.messages, 1)
+        batch = self.options.batch_size
+        started = time.time()
+
+        for offset in range(0, self.options.messages, batch):
+            count = min(batch, self.options.messages - offset)
+            message_rows, token_rows, reaction_rows = [], [], []
+            for index, chat_id in enumerate(self.rng.choices(chat_ids, cum_weights=cum_weights, k=count)):
+                message_id = offset + index + 1
+                # Время растет вместе с id, как у настоящих отправок
+                created_at = self.start + timedelta(seconds=(message_id - 1) * step)
+                sender_id = self.rng.choice(member_ids[chat_id])
+                text = self.text()
+                tail = tails[chat_id]
+                reply_to_id = None
+                if tail and self.rng.random() < self.options.reply_share:
+                    reply_to_id = self.rng.choice(list(tail)[-REPLY_WINDOW:])[0]
+                token, blob = self.encrypt(text)
+                message_rows.append({
+                    'id': message_id, 'chat_id': chat_id, 'sender_id': sender_id,
+                    'content': token or '', 'content_blob': blob, 'content_type': 'text',
+                    'is_encrypted': True, 'reply_to_id': reply_to_id,
+                    'created_at': created_at, 'updated_at': created_at
+                })
+                if self.options.search_index:
+                    token_rows.extend(
+                        {'token': token, 'chat_id': chat_id, 'message_id': message_id}
+                        for token in self.message_tokens(text)
+                    )
+                if self.rng.random() < self.options.reaction_share:
+                    reactors = self.rng.sample(member_ids[chat_id], min(self.rng.randint(1, 3), len(member_ids[chat_id])))
+                    reaction_rows.extend(
+                        {'message_id': message_id, 'user_id': user_id,
+                         'emoji': self.rng.choice(EMOJIS), 'created_at': created_at}
+                        for user_id in reactors
+                    )
+                tail.append((message_id, sender_id))
+                last[chat_id] = (message_id, sender_id, created_at, text)
+
+            self.insert(Message, message_rows)
+            self.insert(SearchToken, token_rows)
+            self.insert(MessageReaction, reaction_rows)
+            self.conn.commit()
+            done = offset + count
+            rate = done / max(time.time() - started, 1e-6)
+            self.progress(f"  messages: {done}/{self.options.messages} ({rate:.0f}/s)")
+        return last, tails
+
+    def summaries(self, members, last, tails):
+        """Сводки чатов, курсоры прочтения и счетчики непрочитанных"""
+        chat = Chat.__table__
+        summary = chat.update().where(chat.c.id == bindparam('chat_id')).values(
+            last_message_id=bindparam('message_id'),
+            last_message_preview=bindparam('preview'),
+            last_message_preview_blob=bindparam('preview_blob'),
+            last_message_sender_id=bindparam('sender_id'),
+            last_message_at=bindparam('message_at')
+        )
+        chat_rows = []
+        for chat_id, (message_id, sender_id, created_at, text) in last.items():
+            preview, preview_blob = self.encrypt(text[:PREVIEW_LENGTH])
+            chat_rows.append({
+                'chat_id': chat_id,
+                'message_id': message_id,
+                'preview': preview,
+                'preview_blob': preview_blob,
+                'sender_id': sender_id,
+                'message_at': created_at
+            })
+        for offset in range(0, len(chat_rows), self.options.batch_size):
+            self.conn.execute(summary, chat_rows[offset:offset + self.options.batch_size])
+
+        member_rows = []
+        for chat_id, chat_members in members.items():
+            tail = list(tails[chat_id])
+            for user_id, role in chat_members:
+                unread_tail = []
+                if tail and self.rng.random() >= FULLY_READ_SHARE:
+                    unread_tail = tail[-self.rng.randint(1, len(tail)):]
+                if not tail:
+                    cursor = 0
+                elif unread_tail:
+                    cursor = unread_tail[0][0] - 1
+                else:
+                    cursor = tail[-1][0]
+                member_rows.append({
+                    'chat_id': chat_id, 'user_id': user_id, 'role': role, 'joined_at': self.start,
+                    'last_read_message_id': cursor,
+                    'unread_count': sum(1 for _, sender_id in unread_tail if sender_id != user_id)
+                })
+        self.insert(ChatMember, member_rows)
+        self.conn.commit()
+
+    def notifications(self, members):
+        chats_by_user = {}
+        for chat_id, chat_members in members.items():
+            for user_id, _ in chat_members:
+                chats_by_user.setdefault(user_id, []).append(chat_id)
+
+        rows = []
+        for user_id in range(1, self.options.users + 1):
+            chat_ids = chats_by_user.get(user_id) or [None]
+            for _ in range(self.options.notifications):
+                rows.append({
+                    'user_id': user_id,
+                    'title': 'Новое сообщение',
+                    'message': self.text(),
+                    'type': 'message',
+                    'is_read': self.rng.random() < 0.7,
+                    'data': json.dumps({'chat_id': self.rng.choice(chat_ids)}),
+                    'created_at': self.random_time()
+                })
+        self.insert(Notification, rows)
+        self.conn.commit()
+
+    def run(self):
+        self.progress(f"Seeding {self.options.users} users")
+        self.users()
+        members = self.chats()
+        self.progress(f"Created {len(members)} chats, seeding {self.options.messages} messages")
+        indexes = [index for model in DEFERRED_INDEX_TABLES for index in model.__table__.indexes]
+        for index in indexes:
+            index.drop(self.conn)
+        last, tails = self.messages(members)
+        self.progress("Building indexes")
+        for index in indexes:
+            index.create(self.conn)
+        self.conn.commit()
+        self.summaries(members, last, tails)
+        self.notifications(members)
+        return self.counts
+
+def seed(options, progress=print):
+    """Заполнение пустой базы; возвращает число строк по таблицам"""
+    with app.app_context():
+        run_migrations()
+        if db.session.query(User.id).first() is not None:
+            raise RuntimeError('Database is not empty: seed a fresh DATABASE_URL')
+        db.session.remove()
+        with db.engine.connect() as conn:
+            if conn.dialect.name == 'sqlite':
+                # Сбой во время заполнения не страшен: базу проще создать заново
+                conn.exec_driver_sql('PRAGMA synchronous=OFF')
+            counts = Seeder(conn, options, progress).run()
+            if conn.dialect.name == 'sqlite':
+                conn.exec_driver_sql('PRAGMA synchronous=NORMAL')
+            return counts
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Fill an empty database with synthetic chat data')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--contacts', type=int, default=20, help='contacts per user')
+    parser.add_argument('--direct-chats', type=int, default=3000)
+    parser.add_argument('--group-chats', type=int, default=100)
+    parser.add_argument('--group-size', type=int, nargs=2, default=(3, 50), metavar=('MIN', 'MAX'))
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of chat activity')
+    parser.add_argument('--reply-share', type=float, default=0.05)
+    parser.add_argument('--reaction-share', type=float, default=0.1)
+    parser.add_argument('--notifications', type=int, default=20, help='notifications per user')
+    parser.add_argument('--days', type=int, default=365, help='time span of the history')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--no-search-index', dest='search_index', action='store_false')
+    parser.add_argument('--legacy-format', action='store_true',
+                        help='store messages as old Fernet tokens (to exercise re-encryption)')
+    parser.add_argument('--seed', type=int, default=42, help='random seed')
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    options = parse_args()
+    started = time.time()
+    try:
+        counts = seed(options, progress=lambda message: print(message, file=sys.stderr, flush=True))
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    print(f"✅ Seeded in {time.time() - started:.1f}s: " +
+          ', '.join(f'{table}={count}' for table, count in counts.items()))
@@ -0,0 +1,200 @@
+"""
+Профилировщик SQL на HTTP-запрос и событие Socket.IO.
+
+Единственный слушатель выполнения SQL в приложении: каждый HTTP-запрос
+получает профиль с числом и временем запросов к базе, из него строятся
+заголовок X-Query-Count (QUERY_COUNT_HEADER) и метрики запросов (metrics.py
+подписывается через observe).
+
+При SQL_PROFILE то же для событий Socket.IO, а запросы группируются по
+нормализованному тексту (литералы и списки IN заменены на ?). Одинаковый
+запрос, выполненный SQL_PROFILE_REPEAT_THRESHOLD и больше раз, считается N+1
+и пишется в лог. HTTP-ответ получает заголовки Server-Timing (время SQL) и
+X-SQL-Repeated.
+
+assert_query_budget - проверка бюджета запросов для проверок и CI
+(check_query_budgets.py); работает и без SQL_PROFILE.
+"""
+
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import g, request
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+QUERY_COUNT_HEADER = 'X-Query-Count'
+REPEATED_HEADER = 'X-SQL-Repeated'
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_value_lists = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_spaces = re.compile(r'\s+')
+
+# Активные профили текущего контекста (у каждого greenlet свой)
+_profiles = ContextVar('sql_profiles', default=())
+
+def normalize(statement):
+    """Форма запроса: без литералов, списки параметров IN (?, ?, ...) свернуты"""
+    shape = _literals.sub('?', statement)
+    shape = _value_lists.sub('(?, ...)', shape)
+    return _spaces.sub(' ', shape).strip()
+
+class Profile:
+    """SQL-запросы одного HTTP-запроса, события или проверяемого блока"""
+
+    def __init__(self, name, shapes=True):
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+        # форма запроса -> [число, время]; None - только общие число и время
+        self.shapes = {} if shapes else None
+        self._lock = threading.Lock()
+
+    def record(self, statement, seconds):
+        shape = normalize(statement) if self.shapes is not None else None
+        with self._lock:
+            self.count += 1
+            self.seconds += seconds
+            if shape is not None:
+                totals = self.shapes.setdefault(shape, [0, 0.0])
+                totals[0] += 1
+                totals[1] += seconds
+
+    def repeated(self, threshold):
+        """Формы, выполненные threshold и больше раз: [(форма, число, время)], самые частые первыми"""
+        with self._lock:
+            items = [(shape, count, seconds) for shape, (count, seconds) in (self.shapes or {}).items()
+                     if count >= threshold]
+        return sorted(items, key=lambda item: item[1], reverse=True)
+
+    def report(self, threshold):
+        lines = [f'{self.name}: {self.count} queries, {self.seconds * 1000:.1f} ms']
+        for shape, count, seconds in self.repeated(threshold):
+            lines.append(f'  N+1 x{count} ({seconds * 1000:.1f} ms): {shape}')
+        return '\n'.join(lines)
+
+class SqlProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.count_header = False
+        self.repeat_threshold = 3
+        # Вызываются на каждый запрос к базе: observer(имя движка, секунды)
+        self._observers = []
+
+    def init_app(self, app, db, engines=()):
+        """engines - дополнительные движки (пул читателей SQLite)"""
+        self.enabled = app.config['SQL_PROFILE']
+        self.count_header = app.config['QUERY_COUNT_HEADER']
+        self.repeat_threshold = app.config['SQL_PROFILE_REPEAT_THRESHOLD']
+        with app.app_context():
+            main_engines = list(db.engines.values())
+        for engine in main_engines:
+            self._watch_engine(engine, 'main')
+        for engine in engines:
+            self._watch_engine(engine, 'reader')
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def observe(self, observer):
+        """Подписка на каждый выполненный запрос: observer(engine, seconds)"""
+        self._observers.append(observer)
+
+    def _watch_engine(self, engine, name):
+        # Время начала хранится в контексте выполнения: у упавшего запроса
+        # after не вызывается, и стек в conn.info рос бы на соединениях пула
+        def before(conn, cursor, statement, parameters, context, executemany):
+            context._profiler_started = time.perf_counter()
+
+        def after(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - context._profiler_started
+            for observer in self._observers:
+                observer(name, elapsed)
+            for profile in _profiles.get():
+                profile.record(statement, elapsed)
+
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+
+    @contextmanager
+    def profile(self, name):
+        """Сбор запросов блока кода (и вложенных HTTP-запросов тестового клиента)"""
+        profile = Profile(name)
+        token = _profiles.set(_profiles.get() + (profile,))
+        try:
+            yield profile
+        finally:
+            _profiles.reset(token)
+
+    def finish(self, profile):
+        repeated = profile.repeated(self.repeat_threshold)
+        if repeated:
+            logger.warning('Repeated SQL (N+1) in ' + profile.report(self.repeat_threshold))
+        else:
+            logger.debug(profile.report(self.repeat_threshold))
+        return repeated
+
+    # ---------- Flask ----------
+
+    def _before_request(self):
+        rule = request.url_rule.rule if request.url_rule is not None else request.path
+        # Формы запросов разбираются только при SQL_PROFILE
+        g.sql_profile = Profile(f'{request.method} {rule}', shapes=self.enabled)
+        g.sql_profile_token = _profiles.set(_profiles.get() + (g.sql_profile,))
+
+    def _after_request(self, response):
+        profile = g.get('sql_profile')
+        if profile is None:
+            return response
+        if self.count_header:
+            response.headers[QUERY_COUNT_HEADER] = str(profile.count)
+        if self.enabled:
+            repeated = self.finish(profile)
+            response.headers.add('Server-Timing', f'db;dur={profile.seconds * 1000:.1f};desc="{profile.count} queries"')
+            response.headers[REPEATED_HEADER] = str(len(repeated))
+        return response
+
+    def _teardown_request(self, exc):
+        token = g.pop('sql_profile_token', None)
+        if token is not None:
+            _profiles.reset(token)
+
+    # ---------- Socket.IO ----------
+
+    def instrument_socketio(self, socketio):
+        """Профиль на каждое событие; вызывать после регистрации обработчиков"""
+        if not self.enabled:
+            return
+        for handlers in socketio.server.handlers.values():
+            for name, handler in list(handlers.items()):
+                handlers[name] = self._profiled_handler(name, handler)
+
+    def _profiled_handler(self, name, handler):
+        def profiled(*args):
+            with self.profile(f'socket {name}') as profile:
+                try:
+                    return handler(*args)
+                finally:
+                    self.finish(profile)
+        return profiled
+
+sql_profiler = SqlProfiler()
+
+@contextmanager
+def assert_query_budget(max_queries, name='block', repeat_threshold=None):
+    """Падает с AssertionError, если блок выполнил больше max_queries запросов
+    или повторил один запрос repeat_threshold раз (по умолчанию SQL_PROFILE_REPEAT_THRESHOLD)"""
+    threshold = repeat_threshold or sql_profiler.repeat_threshold
+    with sql_profiler.profile(name) as profile:
+        yield profile
+    problems = []
+    if profile.count > max_queries:
+        problems.append(f'{profile.count} queries, budget {max_queries}')
+    if profile.repeated(threshold):
+        problems.append('repeated queries (N+1)')
+    if problems:
+        raise AssertionError(f"{name}: {'; '.join(problems)}\n{profile.report(threshold)}")
@@ -0,0 +1,164 @@
+"""
+Режим хранения SQLite для одного узла.
+
+- на каждом соединении включаются WAL и настройки PRAGMA (sqlite_pragmas);
+- SELECT в GET-запросах идут через отдельный пул соединений только для
+  чтения (в WAL читатели не ждут писателя);
+- запись в базу ведет один писатель за раз: остальные ждут на зеленой
+  блокировке и отдают управление хабу eventlet, а не спят в busy_timeout
+  внутри драйвера, блокируя весь процесс;
+- время ожидания блокировки записи копится в stats().
+
+Для других баз модуль ничего не меняет.
+"""
+
+import logging
+import threading
+import time
+import sqlalchemy as sa
+from sqlalchemy import event
+from flask import has_request_context, request
+from flask_sqlalchemy.session import Session
+
+logger = logging.getLogger(__name__)
+
+# Ожидание записи дольше этого попадает в лог
+SLOW_LOCK_WAIT_SECONDS = 1
+
+def sqlite_pragmas(busy_timeout_ms):
+    """PRAGMA соединений писателя; busy_timeout - SQLITE_BUSY_TIMEOUT_MS"""
+    return (
+        ('journal_mode', 'WAL'),
+        # В WAL достаточно для сохранности после сбоя процесса
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', busy_timeout_ms),
+        ('cache_size', -16000),  # 16MB страничного кэша на соединение
+        ('temp_store', 'MEMORY'),
+        ('mmap_size', 128 * 1024 * 1024),
+    )
+
+def reader_pragmas(busy_timeout_ms):
+    """PRAGMA соединений только для чтения: journal_mode задается писателем и хранится в файле базы"""
+    return tuple(p for p in sqlite_pragmas(busy_timeout_ms) if p[0] not in ('journal_mode', 'synchronous')) + (
+        ('query_only', 1),
+    )
+
+READ_METHODS = ('GET', 'HEAD')
+
+def is_sqlite(url):
+    return str(url).startswith('sqlite')
+
+def engine_options(url, busy_timeout_ms):
+    """SQLALCHEMY_ENGINE_OPTIONS для базы по URL"""
+    if is_sqlite(url):
+        # pool_pre_ping и pool_recycle для файла на диске бесполезны
+        return {'connect_args': {'timeout': busy_timeout_ms / 1000}}
+    return {
+        'pool_pre_ping': True,
+        'pool_recycle': 300,
+    }
+
+def _apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas:
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+class SqliteStorage:
+    """Пул читателей и единственный писатель для базы SQLite"""
+
+    def __init__(self):
+        self.enabled = False
+        self.reader = None
+        # RLock: второе соединение того же гринлета (например, DDL через
+        # db.engine при незафиксированной сессии) не ждет само себя
+        self._write_lock = threading.RLock()
+        self._stats_lock = threading.Lock()
+        self.lock_waits = 0
+        self.lock_wait_total = 0.0
+        self.lock_wait_max = 0.0
+        self.waiting = 0
+
+    def init_app(self, app, db):
+        url = app.config['SQLALCHEMY_DATABASE_URI']
+        if not (app.config['SQLITE_PROFILE'] and is_sqlite(url)):
+            return
+        with app.app_context():
+            writer = db.engine
+        database = writer.url.database
+        if not database or database == ':memory:':
+            return
+
+        self.enabled = True
+        busy_timeout_ms = app.config['SQLITE_BUSY_TIMEOUT_MS']
+        writer_pragmas = sqlite_pragmas(busy_timeout_ms)
+        event.listen(writer, 'connect', lambda conn, record: _apply_pragmas(conn, writer_pragmas))
+        event.listen(writer, 'before_cursor_execute', self._before_execute)
+        event.listen(writer, 'commit', self._release)
+        event.listen(writer, 'rollback', self._release)
+        # Соединение, возвращенное в пул без commit/rollback
+        event.listen(writer.pool, 'checkin', lambda conn, record: self._release_record(record))
+
+        pool_size = app.config['SQLITE_READ_POOL_SIZE']
+        if pool_size > 0:
+            self.reader = sa.create_engine(
+                f'sqlite:///file:{database}?mode=ro&uri=true',
+                pool_size=pool_size,
+                max_overflow=pool_size,
+                connect_args={'timeout': busy_timeout_ms / 1000}
+            )
+            read_pragmas = reader_pragmas(busy_timeout_ms)
+            event.listen(self.reader, 'connect', lambda conn, record: _apply_pragmas(conn, read_pragmas))
+
+    def read_engine(self):
+        """Движок для чтения в текущем запросе или None"""
+        if self.reader is not None and has_request_context() and request.method in READ_METHODS:
+            return self.reader
+        return None
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'write_lock_waits': self.lock_waits,
+                'write_lock_wait_ms_total': round(self.lock_wait_total * 1000, 3),
+                'write_lock_wait_ms_max': round(self.lock_wait_max * 1000, 3),
+                'write_lock_waiting': self.waiting
+            }
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if conn.info.get('write_lock') or statement.lstrip()[:6].upper() in ('SELECT', 'PRAGMA'):
+            return
+        # Первая запись транзакции: ждем своей очереди, не блокируя хаб
+        with self._stats_lock:
+            self.waiting += 1
+        started = time.perf_counter()
+        self._write_lock.acquire()
+        waited = time.perf_counter() - started
+        conn.info['write_lock'] = True
+        with self._stats_lock:
+            self.waiting -= 1
+            self.lock_waits += 1
+            self.lock_wait_total += waited
+            self.lock_wait_max = max(self.lock_wait_max, waited)
+        if waited >= SLOW_LOCK_WAIT_SECONDS:
+            logger.warning(f"SQLite write lock wait: {waited:.2f}s")
+
+    def _release(self, conn):
+        # COMMIT выполняется сразу после события без переключения гринлетов
+        self._release_record(conn)
+
+    def _release_record(self, holder):
+        if holder.info.pop('write_lock', False):
+            self._write_lock.release()
+
+class RoutingSession(Session):
+    """Сессия, отправляющая чтение GET-запросов в пул читателей"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and clause is not None and getattr(clause, 'is_select', False):
+            reader = sqlite_storage.read_engine()
+            if reader is not None:
+                return reader
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+sqlite_storage = SqliteStorage()
@@ -7,6 +7,9 @@ class TelegramMessenger {
         this.contacts = [];
         this.isConnected = false;
         this.typingTimeout = null;
+        this.typingSentAt = 0;
+        this.typingUsers = new Map();
+        this.typingRenderTimeout = null;
         
         this.initializeApp();
     }
@@ -258,12 +261,12 @@ class TelegramMessenger {
             this.handleNewMessage(data);
         });
 
-        this.socket.on('user_typing', (data) => {
-            this.showTypingIndicator(data.user_id);
+        this.socket.on('messages_read', (data) => {
+            this.handleMessagesRead(data);
         });
 
-        this.socket.on('user_stopped_typing', (data) => {
-            this.hideTypingIndicator(data.user_id);
+        this.socket.on('typing_update', (data) => {
+            this.handleTypingUpdate(data);
         });
 
         this.socket.on('user_online', (data) => {
@@ -391,6 +394,7 @@ class TelegramMessenger {
                     `<img src="${this.currentChat.avatar || '/static/images/default-chat.svg'}" alt="${this.currentChat.name}">`;
             }
         }
+        this.renderTypingIndicator();
         
         await this.loadChatMessages(chatId);
         
@@ -518,20 +522,41 @@ class TelegramMessenger {
                 messagesList.appendChild(messageElement);
                 this.scrollToBottom();
             }
+            
+            if (data.sender_id !== this.currentUser.id && this.socket) {
+                this.socket.emit('mark_read', { chat_id: data.chat_id, message_id: data.id });
+            }
         }
         
         this.loadChats();
     }
 
+    handleMessagesRead(data) {
+        if (data.chat_id !== this.currentChat?.id || data.user_id === this.currentUser.id) return;
+        
+        document.querySelectorAll(`.message.sent`).forEach(element => {
+            if (Number(element.dataset.messageId) <= data.last_read_message_id) {
+                const status = element.querySelector('.message-status');
+                if (status) status.textContent = '✓✓';
+            }
+        });
+    }
+
     handleMessageInput(e) {
         this.adjustTextareaHeight(e.target);
         
         if (this.currentChat && this.socket) {
-            this.socket.emit('typing_start', { chat_id: this.currentChat.id });
+            // Сервер держит состояние набора несколько секунд - повторяем не чаще раза в 2 секунды
+            const now = Date.now();
+            if (now - this.typingSentAt > 2000) {
+                this.socket.emit('typing_start', { chat_id: this.currentChat.id });
+                this.typingSentAt = now;
+            }
             
             clearTimeout(this.typingTimeout);
             this.typingTimeout = setTimeout(() => {
                 this.socket.emit('typing_stop', { chat_id: this.currentChat.id });
+                this.typingSentAt = 0;
             }, 1000);
         }
     }
@@ -541,24 +566,52 @@ class TelegramMessenger {
         textarea.style.height = Math.min(textarea.scrollHeight, 120) + 'px';
     }
 
-    showTypingIndicator(userId) {
+    handleTypingUpdate(data) {
+        // Каждый печатающий держится ttl секунд, если сервер не повторит его раньше
+        const typers = this.typingUsers.get(data.chat_id) || new Map();
+        const expires = Date.now() + data.ttl * 1000;
+        data.typing.forEach(user => {
+            if (!this.currentUser || user.user_id !== this.currentUser.id) {
+                typers.set(user.user_id, { username: user.username, expires });
+            }
+        });
+        data.stopped.forEach(userId => typers.delete(userId));
+        this.typingUsers.set(data.chat_id, typers);
+        this.renderTypingIndicator();
+    }
+
+    renderTypingIndicator() {
         const typingText = document.getElementById('typingText');
         const typingIndicator = document.getElementById('typingIndicator');
         
         if (!typingText || !typingIndicator) return;
         
-        const user = this.contacts.find(contact => contact.id === userId);
-        if (user) {
-            typingText.textContent = `${user.first_name} печатает...`;
-            typingIndicator.style.display = 'flex';
+        clearTimeout(this.typingRenderTimeout);
+        const typers = this.currentChat ? this.typingUsers.get(this.currentChat.id) : null;
+        const now = Date.now();
+        const names = [];
+        let nextExpiry = Infinity;
+        if (typers) {
+            typers.forEach((typer, userId) => {
+                if (typer.expires <= now) {
+                    typers.delete(userId);
+                } else {
+                    names.push(typer.username);
+                    nextExpiry = Math.min(nextExpiry, typer.expires);
+                }
+            });
         }
-    }
-
-    hideTypingIndicator(userId) {
-        const typingIndicator = document.getElementById('typingIndicator');
-        if (typingIndicator) {
+        
+        if (names.length === 0) {
             typingIndicator.style.display = 'none';
+            return;
         }
+        
+        typingText.textContent = names.length === 1
+            ? `${names[0]} печатает...`
+            : `${names.slice(0, 3).join(', ')}${names.length > 3 ? ' и другие' : ''} печатают...`;
+        typingIndicator.style.display = 'flex';
+        this.typingRenderTimeout = setTimeout(() => this.renderTypingIndicator(), nextExpiry - now);
     }
 
     showNewChatModal() {
@@ -0,0 +1,114 @@
+"""
+Агрегация индикаторов набора текста.
+
+Вместо пересылки каждого typing_start/typing_stop всей комнате сервер хранит,
+кто печатает в каждом чате (с TTL), и раз в TYPING_INTERVAL_SECONDS отправляет
+в комнату одно событие typing_update. Клиент, не приславший typing_stop,
+выпадает из списка по истечении TYPING_TTL_SECONDS.
+
+typing_update содержит тех, кто печатает, по данным этого процесса, и тех,
+кто перестал; клиент держит каждого печатающего ttl секунд, поэтому обновления
+разных процессов не затирают друг друга. Пока кто-то печатает, список
+повторяется раз в половину TTL.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TYPING_TTL_SECONDS = 6
+TYPING_INTERVAL_SECONDS = 1
+
+def chat_room(chat_id):
+    return f'chat_{chat_id}'
+
+class TypingAggregator:
+    """Состояние набора текста процесса: chat_id -> {user_id: (имя, срок)}"""
+
+    def __init__(self, ttl=TYPING_TTL_SECONDS, interval=TYPING_INTERVAL_SECONDS):
+        self.ttl = ttl
+        self.interval = interval
+        self.socketio = None
+        self._lock = threading.Lock()
+        self._chats = {}
+        # Чаты с изменениями с прошлой рассылки: chat_id -> ушедшие user_id
+        self._changed = {}
+        # chat_id -> момент последней рассылки
+        self._sent_at = {}
+
+    def init_app(self, socketio):
+        self.socketio = socketio
+        socketio.start_background_task(self._run)
+
+    def start(self, chat_id, user_id, username, now=None):
+        """Пользователь печатает; повтор только продлевает срок без рассылки"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            typers = self._chats.setdefault(chat_id, {})
+            if user_id not in typers:
+                # Новый печатающий: чат попадает в ближайшую рассылку
+                self._changed.setdefault(chat_id, set()).discard(user_id)
+            typers[user_id] = (username, now + self.ttl)
+
+    def stop(self, chat_id, user_id):
+        with self._lock:
+            typers = self._chats.get(chat_id)
+            if typers and typers.pop(user_id, None):
+                self._changed.setdefault(chat_id, set()).add(user_id)
+                if not typers:
+                    del self._chats[chat_id]
+                    self._sent_at.pop(chat_id, None)
+
+    def collect(self, now=None):
+        """Снятие истекших и сбор обновлений: [(chat_id, payload)]"""
+        now = time.monotonic() if now is None else now
+        updates = []
+        with self._lock:
+            for chat_id in list(self._chats):
+                typers = self._chats[chat_id]
+                expired = [user_id for user_id, (_, deadline) in typers.items() if deadline <= now]
+                for user_id in expired:
+                    del typers[user_id]
+                if expired:
+                    self._changed.setdefault(chat_id, set()).update(expired)
+                if not typers:
+                    del self._chats[chat_id]
+                    self._sent_at.pop(chat_id, None)
+                elif now - self._sent_at.get(chat_id, now) >= self.ttl / 2:
+                    # Продление на клиентах, пока набор продолжается
+                    self._changed.setdefault(chat_id, set())
+
+            for chat_id, stopped in self._changed.items():
+                typers = self._chats.get(chat_id, {})
+                updates.append((chat_id, {
+                    'chat_id': chat_id,
+                    'typing': [
+                        {'user_id': user_id, 'username': username}
+                        for user_id, (username, _) in typers.items()
+                    ],
+                    'stopped': sorted(stopped - typers.keys()),
+                    'ttl': self.ttl
+                }))
+                if typers:
+                    self._sent_at[chat_id] = now
+            self._changed = {}
+        return updates
+
+    def flush(self, now=None):
+        """Рассылка накопленных обновлений: не больше одного события на чат"""
+        updates = self.collect(now)
+        for chat_id, payload in updates:
+            self.socketio.emit('typing_update', payload, to=chat_room(chat_id))
+        return len(updates)
+
+    def _run(self):
+        while True:
+            self.socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Typing update error: {str(e)}")
+
+typing_aggregator = TypingAggregator()
@@ -0,0 +1,375 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+from models import db, Blob, Chat, File, Message, UploadSession, User
+from encryption import encryption_manager
+from images import remove_variants
+
+# Рекомендуемый размер части для возобновляемой загрузки
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Время жизни незавершенной сессии загрузки
+UPLOAD_SESSION_TTL = timedelta(hours=24)
+# Размер блока при записи на диск
+COPY_BLOCK_SIZE = 64 * 1024
+# Папка блобов, адресуемых по SHA-256 (внутри UPLOAD_FOLDER)
+BLOB_DIR = 'blobs'
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Инкрементальные хэши активных сессий: upload_id -> (смещение, sha256).
+# После перезапуска процесса хэш пересчитывается по уже записанной части.
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+def sessions_dir():
+    path = current_app.config['UPLOAD_SESSIONS_FOLDER']
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def part_path(upload_id):
+    return os.path.join(sessions_dir(), f'{upload_id}.part')
+
+def blob_name(sha256, filename):
+    """Имя блоба относительно папки загрузок: blobs/ab/<sha256>.<ext>"""
+    ext = os.path.splitext(secure_filename(filename))[1].lower()
+    return f'{BLOB_DIR}/{sha256[:2]}/{sha256}{ext}'
+
+def file_url(file_record):
+    """Адрес для скачивания файла"""
+    if file_record.blob is None:
+        return f'/uploads/files/{file_record.filename}'
+    return f'/uploads/{file_record.blob.name}'
+
+def _file_record(blob, filename, mime_type, user_id):
+    file_record = File(
+        filename=secure_filename(filename),
+        file_path=blob.file_path,
+        file_size=blob.size,
+        mime_type=mime_type,
+        uploaded_by=user_id,
+        blob=blob
+    )
+    db.session.add(file_record)
+    return file_record
+
+def _add_reference(sha256, size=None):
+    """Атомарное увеличение счетчика ссылок; False, если блоба нет"""
+    query = Blob.query.filter_by(sha256=sha256)
+    if size is not None:
+        query = query.filter_by(size=size)
+    return query.update(
+        {'ref_count': Blob.ref_count + 1}, synchronize_session=False
+    ) > 0
+
+def link_existing(sha256, size, filename, mime_type, user_id):
+    """Новая ссылка на уже сохраненное содержимое без передачи байтов.
+
+    Только для содержимого, которое пользователь уже загружал сам: знание
+    хэша чужого файла не дает к нему доступа.
+    Возвращает File (без commit) или None, если такого блоба у пользователя нет.
+    """
+    if not SHA256_RE.match(sha256 or ''):
+        return None
+    owned = db.session.query(File.id).filter_by(blob_sha256=sha256, uploaded_by=user_id).first()
+    if owned is None or not _add_reference(sha256, size):
+        return None
+    blob = db.session.get(Blob, sha256)
+    return _file_record(blob, filename, mime_type, user_id)
+
+def _move_into_place(temp_path, disk_path):
+    try:
+        os.replace(temp_path, disk_path)
+    except OSError:
+        # Папка сессий на другом разделе - копируем через временный файл рядом
+        copy_path = f'{disk_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            shutil.copyfile(temp_path, copy_path)
+            os.replace(copy_path, disk_path)
+        finally:
+            if os.path.exists(copy_path):
+                os.remove(copy_path)
+        os.remove(temp_path)
+
+def _write_blob(temp_path, disk_path, encrypted=False):
+    if encrypted:
+        # Временный файл уже в потоковом формате (store_file)
+        disk_path += '.enc'
+        _move_into_place(temp_path, disk_path)
+    elif current_app.config['ENCRYPT_UPLOADS']:
+        # Шифруем на лету блоками, не читая файл в память целиком
+        # Сначала во временный файл рядом: параллельная запись того же
+        # содержимого или сбой не оставят обрезанный блоб по его адресу
+        disk_path += '.enc'
+        encrypted_path = f'{disk_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(temp_path, 'rb') as source, open(encrypted_path, 'wb') as destination:
+                encryption_manager.encrypt_stream(source, destination)
+            os.replace(encrypted_path, disk_path)
+        finally:
+            if os.path.exists(encrypted_path):
+                os.remove(encrypted_path)
+        os.remove(temp_path)
+    else:
+        _move_into_place(temp_path, disk_path)
+    return disk_path
+
+def store_spooled(temp_path, sha256, size, filename, mime_type, user_id, encrypted=False):
+    """Перенос полностью записанного временного файла в хранилище блобов.
+
+    encrypted - временный файл уже зашифрован потоковым форматом.
+    Если содержимое уже есть, временный файл удаляется и добавляется ссылка.
+    Возвращает File (без commit).
+    """
+    if _add_reference(sha256):
+        os.remove(temp_path)
+        blob = db.session.get(Blob, sha256)
+        return _file_record(blob, filename, mime_type, user_id)
+
+    name = blob_name(sha256, filename)
+    disk_path = os.path.join(current_app.config['UPLOAD_FOLDER'], name)
+    os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+    disk_path = _write_blob(temp_path, disk_path, encrypted)
+
+    blob = Blob(sha256=sha256, name=name, file_path=disk_path, size=size, ref_count=1)
+    try:
+        with db.session.begin_nested():
+            db.session.add(blob)
+    except IntegrityError:
+        # Параллельная загрузка того же содержимого успела раньше
+        _add_reference(sha256)
+        blob = db.session.get(Blob, sha256)
+    return _file_record(blob, filename, mime_type, user_id)
+
+class _HashingReader:
+    """Поток-обертка: считает SHA-256 и размер всего прочитанного"""
+
+    def __init__(self, source):
+        self.source = source
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size):
+        # encrypt_stream считает короткий блок последним - дочитываем до полного
+        blocks = []
+        remaining = size
+        while remaining > 0:
+            block = self.source.read(min(COPY_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            blocks.append(block)
+            remaining -= len(block)
+        data = b''.join(blocks)
+        self.hasher.update(data)
+        self.size += len(data)
+        return data
+
+def store_file(source, filename, mime_type, user_id):
+    """Сохранение файла из потока с дедупликацией по SHA-256 (без commit).
+
+    Поток пишется во временный файл вне UPLOAD_FOLDER за один проход: с
+    ENCRYPT_UPLOADS сразу шифруется, так что открытый текст на диск не попадает.
+    """
+    encrypted = current_app.config['ENCRYPT_UPLOADS']
+    temp_path = os.path.join(sessions_dir(), f'{uuid.uuid4().hex}.tmp')
+    reader = _HashingReader(source)
+    try:
+        with open(temp_path, 'wb') as destination:
+            if encrypted:
+                encryption_manager.encrypt_stream(reader, destination)
+            else:
+                while True:
+                    block = reader.read(COPY_BLOCK_SIZE)
+                    if not block:
+                        break
+                    destination.write(block)
+        return store_spooled(
+            temp_path, reader.hasher.hexdigest(), reader.size, filename, mime_type, user_id, encrypted
+        )
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def file_in_use(file_record):
+    """Адрес файла еще указан во вложении сообщения или в аватаре.
+
+    Если на блоб ссылаются другие записи File, он переживет удаление и адрес
+    не сломается - проверять нечего.
+    """
+    if file_record.blob is not None and file_record.blob.ref_count > 1:
+        return False
+    url = file_url(file_record)
+    for column in (Message.file_path, User.avatar, Chat.avatar):
+        if db.session.query(column).filter(column == url).first() is not None:
+            return True
+    return False
+
+def release_file(file_record):
+    """Удаление записи File; блоб удаляется вместе с последней ссылкой (без commit)"""
+    sha256 = file_record.blob_sha256
+    db.session.delete(file_record)
+
+    if sha256 is None:
+        # Файлы, загруженные до хранилища блобов, принадлежат одной записи
+        _remove_path(file_record.file_path)
+        return True
+
+    Blob.query.filter_by(sha256=sha256).update(
+        {'ref_count': Blob.ref_count - 1}, synchronize_session=False
+    )
+    blob = db.session.get(Blob, sha256, populate_existing=True)
+    if blob.ref_count > 0:
+        return False
+    path, name = blob.file_path, blob.name
+    # Условие на счетчик защищает от ссылки, добавленной параллельно
+    if Blob.query.filter(Blob.sha256 == sha256, Blob.ref_count <= 0).delete(synchronize_session=False):
+        db.session.expunge(blob)
+        _remove_path(path)
+        remove_variants(current_app.config['UPLOAD_FOLDER'], name)
+        return True
+    return False
+
+def _remove_path(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def create_session(user_id, filename, total_size, mime_type=None):
+    """Новая сессия возобновляемой загрузки"""
+    upload = UploadSession(
+        id=uuid.uuid4().hex,
+        user_id=user_id,
+        filename=secure_filename(filename),
+        mime_type=mime_type,
+        total_size=total_size,
+        received=0,
+        expires_at=datetime.utcnow() + UPLOAD_SESSION_TTL
+    )
+    db.session.add(upload)
+    open(part_path(upload.id), 'wb').close()
+    return upload
+
+def _hasher_for(upload):
+    """Хэш уже принятой части файла сессии.
+
+    Из кэша возвращается копия: если запись части прервется, кэш не должен
+    содержать байты, не учтенные в upload.received.
+    """
+    with _hashers_lock:
+        state = _hashers.get(upload.id)
+    if state and state[0] == upload.received:
+        return state[1].copy()
+
+    hasher = hashlib.sha256()
+    with open(part_path(upload.id), 'rb') as part:
+        remaining = upload.received
+        while remaining > 0:
+            block = part.read(min(COPY_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+def _try_lock(f):
+    """Неблокирующая эксклюзивная блокировка файла (между запросами и процессами)"""
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+def append_chunk(upload, stream, offset, length):
+    """Дозапись части с позиции offset с обновлением хэша (с commit).
+
+    Пишется не больше length байт. Файл сессии на время записи блокируется,
+    а received сдвигается условным UPDATE ... WHERE received = offset.
+    Возвращает новое смещение или None, если offset уже не текущий или
+    другой запрос пишет часть той же загрузки.
+    """
+    with open(part_path(upload.id), 'r+b') as part:
+        if not _try_lock(part):
+            return None
+        # Смещение могла сдвинуть часть, записанная до получения блокировки
+        received = db.session.query(UploadSession.received).filter_by(id=upload.id).scalar()
+        if received != offset:
+            return None
+
+        try:
+            hasher = _hasher_for(upload)
+            written = 0
+            # Отбрасываем хвост от прерванной записи, не учтенной в базе
+            part.truncate(offset)
+            part.seek(offset)
+            while written < length:
+                block = stream.read(min(COPY_BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                part.write(block)
+                hasher.update(block)
+                written += len(block)
+            part.flush()
+
+            moved = UploadSession.query.filter_by(id=upload.id, received=offset).update({
+                'received': offset + written,
+                'expires_at': datetime.utcnow() + UPLOAD_SESSION_TTL
+            }, synchronize_session=False)
+            if not moved:
+                db.session.rollback()
+                return None
+            db.session.commit()
+        except Exception:
+            with _hashers_lock:
+                _hashers.pop(upload.id, None)
+            raise
+
+    with _hashers_lock:
+        _hashers[upload.id] = (offset + written, hasher)
+    return offset + written
+
+def complete_session(upload):
+    """Завершение загрузки: перенос в хранилище и создание записи File (без commit).
+
+    Файл сессии переименовывается в блоб без повторного копирования.
+    Возвращает (File, sha256 в hex).
+    """
+    digest = _hasher_for(upload).hexdigest()
+    file_record = store_spooled(
+        part_path(upload.id), digest, upload.received, upload.filename, upload.mime_type, upload.user_id
+    )
+    discard_session(upload)
+    return file_record, digest
+
+def discard_session(upload):
+    """Удаление сессии и ее временного файла"""
+    with _hashers_lock:
+        _hashers.pop(upload.id, None)
+    try:
+        os.remove(part_path(upload.id))
+    except FileNotFoundError:
+        pass
+    db.session.delete(upload)
+
+def cleanup_expired_sessions():
+    """Удаление просроченных сессий загрузки (с commit)"""
+    expired = UploadSession.query.filter(UploadSession.expires_at < datetime.utcnow()).all()
+    for upload in expired:
+        discard_session(upload)
+    if expired:
+        db.session.commit()
+    return len(expired)
@@ -0,0 +1,131 @@
+"""
+Групповая фиксация записей (group commit).
+
+Параллельные отправители ставят задания в очередь, фоновый поток собирает их
+в пачку (до WRITE_PIPELINE_MAX_BATCH заданий или WRITE_PIPELINE_MAX_DELAY_MS
+миллисекунд) и выполняет одной транзакцией с одним commit. Отправитель получает
+результат только после того, как commit пачки завершился. Если пачка не
+зафиксировалась, задания повторяются по одному, и ошибку получает только
+виновное задание.
+
+Задание - функция без аргументов, которая пишет через db.session и возвращает
+простые значения (объекты ORM после commit устаревают). Без WRITE_PIPELINE
+задание выполняется сразу с отдельным commit.
+"""
+
+import logging
+import queue
+import threading
+import time
+from models import db
+
+logger = logging.getLogger(__name__)
+
+class PendingWrite:
+    """Задание в очереди и ожидание его фиксации"""
+
+    def __init__(self, job):
+        self.job = job
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+class WritePipeline:
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self.max_batch = 64
+        self.max_delay = 0.005
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+        self.fallbacks = 0
+
+    def init_app(self, app, socketio):
+        self.app = app
+        self.enabled = app.config['WRITE_PIPELINE']
+        self.max_batch = app.config['WRITE_PIPELINE_MAX_BATCH']
+        self.max_delay = app.config['WRITE_PIPELINE_MAX_DELAY_MS'] / 1000
+        if self.enabled:
+            socketio.start_background_task(self._run)
+
+    def submit(self, job):
+        """Выполнение задания в ближайшей пачке; возвращает его результат после commit"""
+        if not self.enabled:
+            result = job()
+            db.session.commit()
+            return result
+
+        # Ожидающий запрос не должен держать соединение из пула: иначе при
+        # большом числе отправителей фоновому потоку не хватит соединения
+        db.session.close()
+        pending = PendingWrite(job)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self.batches,
+                'writes': self.writes,
+                'fallbacks': self.fallbacks,
+                'queued': self._queue.qsize()
+            }
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                with self.app.app_context():
+                    self._commit(batch)
+            except Exception as e:
+                # Ни одно задание не должно ждать вечно
+                logger.error(f"Write pipeline error: {str(e)}")
+                for pending in batch:
+                    if not pending.done.is_set():
+                        pending.finish(error=e)
+
+    def _commit(self, batch):
+        try:
+            results = [pending.job() for pending in batch]
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0].finish(error=e)
+                return
+            with self._lock:
+                self.fallbacks += 1
+            for pending in batch:
+                self._commit([pending])
+            return
+
+        with self._lock:
+            self.batches += 1
+            self.writes += len(batch)
+        for pending, result in zip(batch, results):
+            pending.finish(result)
+
+write_pipeline = WritePipeline()
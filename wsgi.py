@@ -14,17 +14,18 @@ load_dotenv()
 # Add the current directory to Python path
 sys.path.insert(0, os.path.dirname(__file__))
 
-from app import app, socketio, db
+from app import app, socketio
+from migrations import run_migrations
 
-# Create database tables
+# Apply pending schema migrations (a version check when up to date)
 with app.app_context():
     try:
-        # Drop and recreate tables to fix relationship conflicts
-        db.drop_all()
-        db.create_all()
-        print("Database tables created successfully")
+        applied = run_migrations()
+        if applied:
+            print(f"Database migrated to version {applied[-1]}")
     except Exception as e:
-        print(f"Database initialization error: {str(e)}")
+        print(f"Database migration error: {str(e)}")
+        raise
 
 # For deployment platforms
 application = app